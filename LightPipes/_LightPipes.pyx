@@ -5,54 +5,298 @@ cimport numpy as np
 from libcpp.vector cimport vector
 import webbrowser
 import math
-
-cdef extern from "lpspy.h" namespace "std":
+import os
+import itertools
+import tempfile
+import threading
+import time
+
+cdef extern from "fftw3.h":
+    unsigned FFTW_ESTIMATE
+    unsigned FFTW_MEASURE
+    unsigned FFTW_PATIENT
+    unsigned FFTW_EXHAUSTIVE
+
+cdef extern from "fresnl.h":
+    int    FRESNL_EXACT
+    int    FRESNL_FAST
+    void   fresnl_batch(const double*, int, double*, double*, int)
+
+cdef extern from "lpspy.h" namespace "std" nogil:
+    enum:
+        FUSE_AXICON
+        FUSE_CIRC_APERTURE
+        FUSE_CIRC_SCREEN
+        FUSE_GAIN
+        FUSE_GAUSS_APERTURE
+        FUSE_GAUSS_SCREEN
+        FUSE_INT_ATTENUATOR
+        FUSE_LENS
+        FUSE_RECT_APERTURE
+        FUSE_RECT_SCREEN
+        FUSE_TILT
+        FUSE_ZERNIKE
+    cdef struct lpop:
+        int    kind
+        double p[6]
     cdef cppclass lpspy:
-        LightPipes() except +
-        vector[vector[complex]] Axicon(double, double, double, double, vector[vector[complex]])
-        vector[vector[complex]] BeamMix(vector[vector[complex]], vector[vector[complex]])      
-        vector[vector[complex]] Begin(double, double, int)
-        vector[vector[complex]] CircAperture(double, double, double, vector[vector[complex]])
-        vector[vector[complex]] CircScreen(double, double, double, vector[vector[complex]])
-        vector[vector[complex]] Convert(vector[vector[complex]])
-        vector[vector[complex]] Forward(double, double, int, vector[vector[complex]])
-        vector[vector[complex]] Forvard(double, vector[vector[complex]])
-        vector[vector[complex]] Fresnel(double, vector[vector[complex]])
-        vector[vector[complex]] Gain(double, double, double, vector[vector[complex]])
-        vector[vector[complex]] GaussAperture(double, double, double, double, vector[vector[complex]])      
-        vector[vector[complex]] GaussScreen(double, double, double, double, vector[vector[complex]])
-        vector[vector[complex]] GaussHermite(int, int, double, double, vector[vector[complex]])
-        vector[vector[complex]] GaussLaguerre(int, int, double, double, vector[vector[complex]])
-        vector[vector[complex]] IntAttenuator(double, vector[vector[complex]])               
-        vector[vector[complex]] Lens(double, double, double, vector[vector[complex]])
-        vector[vector[complex]] LensForvard(double, double, vector[vector[complex]])
-        vector[vector[complex]] LensFresnel(double, double, vector[vector[complex]])
-        vector[vector[complex]] MultIntensity(vector[vector[double]], vector[vector[complex]])
-        vector[vector[complex]] MultPhase(vector[vector[double]], vector[vector[complex]])
-        vector[vector[complex]] Normal(vector[vector[complex]])                   
-        vector[vector[double]]  Intensity(int, vector[vector[complex]])
-        vector[vector[complex]] Interpol(double, int, double, double, double, double, vector[vector[complex]])
-        vector[vector[double]]  Phase(vector[vector[complex]])
-        vector[vector[double]]  PhaseUnwrap(vector[vector[double]])        
-        vector[vector[complex]] PipFFT(int, vector[vector[complex]])       
-        double   				Power(vector[vector[complex]]);
-        vector[vector[complex]] RandomIntensity(double, double, vector[vector[complex]]) 
-        vector[vector[complex]] RandomPhase(double, double, vector[vector[complex]])                          
-        vector[vector[complex]] RectAperture(double, double, double, double, double, vector[vector[complex]]) 
-        vector[vector[complex]] RectScreen(double, double, double, double, double, vector[vector[complex]])
-        vector[vector[complex]] Steps(double, int, vector[vector[complex]], vector[vector[complex]])
-        double                  Strehl(vector[vector[complex]])
-        vector[vector[complex]] SubIntensity(vector[vector[double]], vector[vector[complex]])
-        vector[vector[complex]] SubPhase(vector[vector[double]], vector[vector[complex]])
-        vector[vector[complex]] Tilt(double ,double, vector[vector[complex]])
-        vector[vector[complex]] Zernike(int, int, double ,double, vector[vector[complex]])
+        lpspy() except +
+        void   newEngine() except +
+        int    N
+        int    int1
+        double size
+        double wavelength "lambda"
+        double doub1
+        unsigned planflags
+        int    nthreads
+        int    fresnlaccuracy
+        void   prePlan(int) except +
+        int    importWisdom(const char*)
+        int    exportWisdom(const char*)
+        void   setCacheSize(double)
+        double getCacheSize()
+        void   clearCache()
+        void   Axicon(double, double, double, double, double complex*)
+        void   Axicon(double, double, double, double, float complex*)
+        void   BeamMix(double complex*, double complex*)
+        void   BeamMix(float complex*, float complex*)
+        void   Begin(double, double, int, double complex*)
+        void   Begin(double, double, int, float complex*)
+        void   CircAperture(double, double, double, double complex*)
+        void   CircAperture(double, double, double, float complex*)
+        void   CircScreen(double, double, double, double complex*)
+        void   CircScreen(double, double, double, float complex*)
+        void   Convert(double complex*)
+        void   Convert(float complex*)
+        void   FarField(double, double, int, double, double, double complex*, double complex*) except +
+        void   FarField(double, double, int, double, double, float complex*, float complex*) except +
+        void   ForwardMatrix(double, double, int, int, int, double complex*)
+        void   Forvard(double, double complex*, int) except +
+        void   Forvard(double, float complex*, int) except +
+        void   ForvardScan(int, const double*, double complex*, double complex*, double*) except +
+        void   ForvardScan(int, const double*, float complex*, float complex*, double*) except +
+        void   Fresnel(double, double complex*, int) except +
+        void   Fresnel(double, float complex*, int) except +
+        void   Fuse(int, const lpop*, double complex*)
+        void   Fuse(int, const lpop*, float complex*)
+        void   Gain(double, double, double, double complex*)
+        void   Gain(double, double, double, float complex*)
+        void   GaussAperture(double, double, double, double, double complex*)
+        void   GaussAperture(double, double, double, double, float complex*)
+        void   GaussScreen(double, double, double, double, double complex*)
+        void   GaussScreen(double, double, double, double, float complex*)
+        void   GaussHermite(int, int, double, double, double complex*)
+        void   GaussHermite(int, int, double, double, float complex*)
+        void   GaussLaguerre(int, int, double, double, double complex*)
+        void   GaussLaguerre(int, int, double, double, float complex*)
+        void   IntAttenuator(double, double complex*)
+        void   IntAttenuator(double, float complex*)
+        void   Lens(double, double, double, double complex*)
+        void   Lens(double, double, double, float complex*)
+        void   LensForvard(double, double, double complex*) except +
+        void   LensForvard(double, double, float complex*) except +
+        void   LensFresnel(double, double, double complex*) except +
+        void   LensFresnel(double, double, float complex*) except +
+        void   MultIntensity(double*, int, int, double complex*)
+        void   MultIntensity(double*, int, int, float complex*)
+        void   MultPhase(double*, int, int, double complex*)
+        void   MultPhase(double*, int, int, float complex*)
+        void   Normal(double complex*)
+        void   Normal(float complex*)
+        void   Intensity(int, double complex*, double*)
+        void   Intensity(int, float complex*, double*)
+        void   Interpol(double, int, double, double, double, double, double complex*, double complex*)
+        void   Interpol(double, int, double, double, double, double, float complex*, float complex*)
+        void   Phase(double complex*, double*)
+        void   Phase(float complex*, double*)
+        void   PhaseUnwrap(double*, double*)
+        void   PipFFT(int, double complex*, int) except +
+        void   PipFFT(int, float complex*, int) except +
+        double Power(double complex*)
+        double Power(float complex*)
+        void   Propagate(double, double complex*, int) except +
+        void   Propagate(double, float complex*, int) except +
+        void   RandomIntensity(double, double, double complex*)
+        void   RandomIntensity(double, double, float complex*)
+        void   RandomPhase(double, double, double complex*)
+        void   RandomPhase(double, double, float complex*)
+        void   RectAperture(double, double, double, double, double, double complex*)
+        void   RectAperture(double, double, double, double, double, float complex*)
+        void   RectScreen(double, double, double, double, double, double complex*)
+        void   RectScreen(double, double, double, double, double, float complex*)
+        void   ScaledFresnel(double, double, int, double complex*, double complex*) except +
+        void   ScaledFresnel(double, double, int, float complex*, float complex*) except +
+        void   Steps(double, int, double complex*, double complex*)
+        void   Steps(double, int, double complex*, float complex*)
+        double Strehl(double complex*)
+        double Strehl(float complex*)
+        void   SubIntensity(double*, int, int, double complex*)
+        void   SubIntensity(double*, int, int, float complex*)
+        void   SubPhase(double*, int, int, double complex*)
+        void   SubPhase(double*, int, int, float complex*)
+        void   Tilt(double ,double, double complex*)
+        void   Tilt(double ,double, float complex*)
+        void   Zernike(int, int, double ,double, double complex*)
+        void   Zernike(int, int, double ,double, float complex*)
+        void   ZernikeSum(int, const double*, double, double complex*)
+        void   ZernikeSum(int, const double*, double, float complex*)
         void test()
         double getGridSize()
         void setGridSize(double newGridSize)
         double getWavelength()
         void setWavelength(double newWavelength)
         int getGridDimension()
-     
+
+_LP_ALIGN = 64
+
+def _empty(shape, dtype=np.complex128):
+    """
+    Uninitialized array, aligned on _LP_ALIGN bytes so that FFTW can
+    transform it in place with its SIMD code.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(nbytes + _LP_ALIGN, dtype=np.uint8)
+    offset = (-buf.ctypes.data) % _LP_ALIGN
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def _dtype(F):
+    """
+    complex64 for a complex64 array, complex128 for anything else.
+    """
+    if getattr(F, 'dtype', None) == np.complex64:
+        return np.complex64
+    return np.complex128
+
+_PLANNING_EFFORT = {
+    'estimate': FFTW_ESTIMATE,
+    'measure': FFTW_MEASURE,
+    'patient': FFTW_PATIENT,
+    'exhaustive': FFTW_EXHAUSTIVE,
+}
+
+_FRESNEL_ACCURACY = {
+    'exact': FRESNL_EXACT,
+    'fast': FRESNL_FAST,
+}
+
+# the elementwise commands Fuse can apply: (kind, number of arguments)
+_FUSE_OPS = {
+    'Axicon': (FUSE_AXICON, 4),
+    'CircAperture': (FUSE_CIRC_APERTURE, 3),
+    'CircScreen': (FUSE_CIRC_SCREEN, 3),
+    'Gain': (FUSE_GAIN, 3),
+    'GaussAperture': (FUSE_GAUSS_APERTURE, 4),
+    'GaussScreen': (FUSE_GAUSS_SCREEN, 4),
+    'IntAttenuator': (FUSE_INT_ATTENUATOR, 1),
+    'Lens': (FUSE_LENS, 3),
+    'RectAperture': (FUSE_RECT_APERTURE, 5),
+    'RectScreen': (FUSE_RECT_SCREEN, 5),
+    'Tilt': (FUSE_TILT, 2),
+    'Zernike': (FUSE_ZERNIKE, 4),
+}
+
+cdef object _flat(object F):
+    # the data of a C-contiguous array (a field or a stack of fields) as
+    # a 1-D view, never a copy
+    if not F.flags.c_contiguous:
+        raise ValueError('ndarray is not C-contiguous')
+    return F.reshape(-1)
+
+cdef double complex *_cptr(object F) except? NULL:
+    # pointer to the data of a C-contiguous complex128 array, NULL for
+    # a complex64 array
+    if F.dtype == np.complex64:
+        return NULL
+    cdef double complex[::1] v = _flat(F)
+    return &v[0]
+
+cdef float complex *_sptr(object F) except? NULL:
+    # pointer to the data of a C-contiguous complex64 array, NULL for
+    # any other array
+    if F.dtype != np.complex64:
+        return NULL
+    cdef float complex[::1] v = _flat(F)
+    return &v[0]
+
+# the order in which Fields are made and setGridSize and setWavelength
+# are called, see Init._field
+_stamps = itertools.count(1)
+
+cdef double *_dptr(object A) except NULL:
+    # pointer to the data of a C-contiguous float64 array
+    cdef double[:, ::1] v = A
+    return &v[0, 0]
+
+class Field(np.ndarray):
+    """
+    F = Field(F, gridsize, wavelength, curvature=0.0, fftstate=0)
+
+    A N x N array of complex numbers that carries its grid. All commands
+    return Fields and take the grid from a Field input instead of from
+    the LightPipes instance, so simulations with different grids can be
+    mixed, and run in threads. Plain arrays get the grid of the instance,
+    as set by Begin. Numpy operations keep the grid of their (first)
+    Field operand, which is wrong for slices. setGridSize and
+    setWavelength change the grid of the Fields made before they are
+    called too, for all threads that use the instance, so they are not
+    thread safe: in threads, make Fields with their own grid (Begin,
+    Field) instead.
+
+    A complex64 field is computed in single precision (with the sums of
+    Power, Normal and Strehl in double), which halves the memory; the
+    commands keep the precision of their input field.
+
+    A K x N x N Field is a stack of K fields with the same grid, which
+    Forvard, Fresnel and PipFFT propagate in one go. F[k] is the k-th
+    field of the stack.
+
+    Args::
+
+        F: N x N array of complex numbers, or a K x N x N stack, complex64
+            arrays stay single precision, others are converted to
+            complex128
+        gridsize: size of the grid
+        wavelength: wavelength of the field
+        curvature: 1/R of the spherical coordinates of LensForvard and
+            LensFresnel, 0.0 for plane coordinates (see Convert)
+        fftstate: number of forward minus inverse transforms of PipFFT
+
+    Returns::
+
+        F: Field, with the attributes gridsize, wavelength, curvature,
+            fftstate and N.
+
+    """
+    def __new__(cls, F, gridsize, wavelength, curvature=0.0, fftstate=0):
+        F = np.asarray(F, dtype=_dtype(F))
+        if F.ndim not in (2, 3) or F.shape[-2] != F.shape[-1]:
+            raise ValueError('field must be a square array of complex numbers')
+        F = F.view(cls)
+        F.gridsize = float(gridsize)
+        F.wavelength = float(wavelength)
+        F.curvature = float(curvature)
+        F.fftstate = int(fftstate)
+        F._stamp = next(_stamps)
+        return F
+    def __array_finalize__(self, obj):
+        self._stamp = getattr(obj, '_stamp', 0)
+        self.gridsize = getattr(obj, 'gridsize', None)
+        self.wavelength = getattr(obj, 'wavelength', None)
+        self.curvature = getattr(obj, 'curvature', 0.0)
+        self.fftstate = getattr(obj, 'fftstate', 0)
+    def __reduce__(self):
+        cls, args, state = np.ndarray.__reduce__(self)
+        grid = (self.gridsize, self.wavelength, self.curvature, self.fftstate)
+        return cls, args, (state, grid)
+    def __setstate__(self, state):
+        np.ndarray.__setstate__(self, state[0])
+        self.gridsize, self.wavelength, self.curvature, self.fftstate = state[1]
+        self._stamp = next(_stamps)
+    @property
+    def N(self):
+        return self.shape[-1]
+
 cdef class Init:
     """
         LP = LightPipes.Init()
@@ -73,13 +317,88 @@ cdef class Init:
     """
     
     cdef lpspy *thisptr      # hold a C++ instance which we're wrapping
+    cdef object _gridsizeset   # (stamp, value) of the last setGridSize
+    cdef object _wavelengthset # (stamp, value) of the last setWavelength
     def __cinit__(self):
         self.thisptr = new lpspy()
+        with nogil:
+            self.thisptr.newEngine()
+        self.thisptr.nthreads = os.cpu_count() or 1
     def __dealloc__(self):
-        del self.thisptr
-    def Axicon(self, phi, n1, x_shift, y_shift, Fin):
-        """
-        Fout = Axicon(phi, n1, x_shift, y_shift, Fin)
+        # the last owner of the engine destroys its plans, under the planner lock
+        with nogil:
+            del self.thisptr
+    cdef object _field(self, Fin, lpspy *lp, bint copy=True, out=None, bint stack=False):
+        # Returns Fin as a C-contiguous N x N complex128 array, or complex64
+        # for a complex64 Fin. lp is a copy
+        # of the instance, it gets the grid of Fin if that is a Field, a
+        # plain array keeps the grid of the instance. A setGridSize or
+        # setWavelength after Fin was made overrides its grid size or
+        # wavelength (as it did when the grid was global). The C++ commands work
+        # in place, so by default Fin is copied first, to out if given.
+        # With stack, Fin may also be a K x N x N stack of fields.
+        if isinstance(Fin, Field) and Fin.gridsize is not None:
+            lp.N = Fin.shape[-1]
+            lp.size = Fin.gridsize
+            lp.wavelength = Fin.wavelength
+            if self._gridsizeset is not None and self._gridsizeset[0] > Fin._stamp:
+                lp.size = self._gridsizeset[1]
+            if self._wavelengthset is not None and self._wavelengthset[0] > Fin._stamp:
+                lp.wavelength = self._wavelengthset[1]
+            lp.doub1 = Fin.curvature
+            lp.int1 = Fin.fftstate
+        F = np.asarray(Fin, dtype=_dtype(Fin))
+        N = lp.N
+        shape = (F.shape[0], N, N) if stack and F.ndim == 3 else (N, N)
+        if F.shape != shape:
+            if stack:
+                raise ValueError('field must be a {0} x {0} array, or a K x {0} x {0} stack, of complex numbers'.format(N))
+            raise ValueError('field must be a {0} x {0} array of complex numbers'.format(N))
+        if out is not None:
+            if (not isinstance(out, np.ndarray) or out.dtype != F.dtype
+                    or out.shape != shape or not out.flags.c_contiguous
+                    or not out.flags.writeable):
+                raise ValueError('out must be a writeable, C-contiguous {0} array of {1}'.format(
+                    ' x '.join(str(n) for n in shape), F.dtype))
+            if out.ctypes.data != F.ctypes.data or not F.flags.c_contiguous:
+                out[...] = F
+            return out
+        if copy:
+            Fout = _empty(shape, F.dtype)
+            Fout[...] = F
+            return Fout
+        return np.ascontiguousarray(F)
+    cdef object _result(self, Fout, lpspy *lp):
+        # Returns Fout as a Field with the grid of lp. The grid is also
+        # kept by the instance, for getGridSize() etc. and plain arrays.
+        self.thisptr.N = lp.N
+        self.thisptr.size = lp.size
+        self.thisptr.wavelength = lp.wavelength
+        self.thisptr.doub1 = lp.doub1
+        self.thisptr.int1 = lp.int1
+        F = Fout if isinstance(Fout, Field) else Fout.view(Field)
+        F.gridsize = lp.size
+        F.wavelength = lp.wavelength
+        F.curvature = lp.doub1
+        F.fftstate = lp.int1
+        F._stamp = next(_stamps)
+        return F
+    cdef object _real(self, A):
+        # Returns A as a C-contiguous 2-D float64 array (not copied if possible).
+        A = np.ascontiguousarray(A, dtype=np.float64)
+        if A.ndim != 2:
+            raise ValueError('array must be a square array of real numbers')
+        return A
+    cdef object _forward_matrix(self, lpspy *lp, double z, double sizenew, int Nnew, int i0, int i1):
+        # Fresnel-integral matrix of Forward for the old pixels i0 .. i1-1
+        M = np.empty((Nnew, i1 - i0), dtype=np.complex128)
+        cdef double complex *pM = _cptr(M)
+        with nogil:
+            lp.ForwardMatrix(z, sizenew, Nnew, i0, i1, pM)
+        return M
+    def Axicon(self, double phi, double n1, double x_shift, double y_shift, Fin, out=None):
+        """
+        Fout = Axicon(phi, n1, x_shift, y_shift, Fin, out=None)
        
         :ref:`Propagates the field through an axicon. <Axicon>`
 
@@ -89,6 +408,7 @@ cdef class Init:
             n1: refractive index of the axicon material
             x_shift, y_shift: shift from the center
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
           
@@ -99,16 +419,26 @@ cdef class Init:
         :ref:`Bessel beam with axicon <BesselBeam>`
 
         """
-        return self.thisptr.Axicon(phi, n1, x_shift, y_shift, Fin)
-    def BeamMix(self, Fin1, Fin2):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Axicon(phi, n1, x_shift, y_shift, sFout)
+            else:
+                lp.Axicon(phi, n1, x_shift, y_shift, pFout)
+        return self._result(Fout, &lp)
+    def BeamMix(self, Fin1, Fin2, out=None):
         """
-        Fout = BeamMix(F1, F2)
+        Fout = BeamMix(F1, F2, out=None)
 
         :ref:`Addition of the fields F1 and F2. <BeamMix>`
 
         Args::
         
-            F1, F2: input fields
+            F1, F2: input fields, with the same N, grid size and wavelength
+            out: array for the result, may be F2 itself (optional)
             
         Returns::
           
@@ -119,10 +449,28 @@ cdef class Init:
         :ref:`Two holes interferometer <Young>`
         
         """
-        return self.thisptr.BeamMix(Fin1, Fin2)
-    def Begin(self,size,labda,N):
-        """
-        F = Begin(GridSize, Wavelength, N)
+        cdef lpspy lp1 = self.thisptr[0]
+        cdef lpspy lp = self.thisptr[0]
+        F1 = self._field(Fin1, &lp1, False)
+        if out is not None and np.may_share_memory(F1, out):
+            F1 = F1.copy()
+        Fout = self._field(Fin2, &lp, True, out)
+        if lp1.N != lp.N or lp1.size != lp.size or lp1.wavelength != lp.wavelength:
+            raise ValueError('BeamMix: F1 and F2 must have the same N, grid size and wavelength')
+        F1 = F1.astype(Fout.dtype, copy=False)
+        cdef double complex *pF1 = _cptr(F1)
+        cdef float complex *sF1 = _sptr(F1)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.BeamMix(sF1, sFout)
+            else:
+                lp.BeamMix(pF1, pFout)
+        return self._result(Fout, &lp)
+    def Begin(self, double size, double labda, int N, dtype=np.complex128):
+        """
+        F = Begin(GridSize, Wavelength, N, dtype=np.complex128)
         
         :ref:`Creates a plane wave (phase = 0.0, amplitude = 1.0). <Begin>`
 
@@ -131,6 +479,8 @@ cdef class Init:
             GridSize: size of the grid
             Wavelength: wavelength of the field
             N: N x N grid points (N must be even)
+            dtype: np.complex128, or np.complex64 for a single precision
+                field (optional)
             
         Returns::
          
@@ -141,10 +491,21 @@ cdef class Init:
         :ref:`Diffraction from a circular aperture <Diffraction>`
         
         """
-        return self.thisptr.Begin(size, labda, N)
-    def CircAperture(self, R, x_shift, y_shift, Fin):
+        if np.dtype(dtype) not in (np.complex64, np.complex128):
+            raise ValueError('dtype must be complex64 or complex128')
+        cdef lpspy lp = self.thisptr[0]
+        Fout = _empty((N, N), dtype)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Begin(size, labda, N, sFout)
+            else:
+                lp.Begin(size, labda, N, pFout)
+        return self._result(Fout, &lp)
+    def CircAperture(self, double R, double x_shift, double y_shift, Fin, out=None):
         """
-        Fout = CircAperture(R, x_shift, y_shift, Fin)
+        Fout = CircAperture(R, x_shift, y_shift, Fin, out=None)
         
         :ref:`Propagates the field through a circular aperture. <CircAperture>`
 
@@ -153,6 +514,7 @@ cdef class Init:
             R: radius of the aperture
             x_shift, y_shift: shift from the center
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
@@ -163,10 +525,19 @@ cdef class Init:
         :ref:`Diffraction from a circular aperture <circ_aperture>`
         
         """
-        return self.thisptr.CircAperture(R, x_shift, y_shift, Fin)
-    def CircScreen(self, R, x_shift, y_shift, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.CircAperture(R, x_shift, y_shift, sFout)
+            else:
+                lp.CircAperture(R, x_shift, y_shift, pFout)
+        return self._result(Fout, &lp)
+    def CircScreen(self, double R, double x_shift, double y_shift, Fin, out=None):
         """
-        Fout = CircScreen(R, x_shift, y_shift, Fin)
+        Fout = CircScreen(R, x_shift, y_shift, Fin, out=None)
                     
         :ref:`Diffracts the field by a circular screen. <CircScreen>`
 
@@ -175,6 +546,7 @@ cdef class Init:
             R: radius of the screen
             x_shift, y_shift: shift from the center
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
@@ -185,16 +557,26 @@ cdef class Init:
         :ref:`Spot of Poisson <Poisson>`
         
         """
-        return self.thisptr.CircScreen(R, x_shift, y_shift, Fin)
-    def Convert(self, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.CircScreen(R, x_shift, y_shift, sFout)
+            else:
+                lp.CircScreen(R, x_shift, y_shift, pFout)
+        return self._result(Fout, &lp)
+    def Convert(self, Fin, out=None):
         """
-        Fout = Convert(Fin)
+        Fout = Convert(Fin, out=None)
 
         :ref:`Converts the field from a spherical variable coordinate to a normal coordinate system. <Convert>`
 
         Args::
         
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
@@ -205,73 +587,328 @@ cdef class Init:
         :ref:`Unstable resonator <Unstab>`
         
         """
-        return self.thisptr.Convert( Fin)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Convert(sFout)
+            else:
+                lp.Convert(pFout)
+        return self._result(Fout, &lp)
+    def FarField(self, double f, double sizenew, int Nnew, double x_shift, double y_shift, Fin):
+        """
+        Fout = FarField(f, sizenew, Nnew, x_shift, y_shift, Fin)
+
+        Computes the field in the focal plane of a lens with focal length
+        f placed at the plane of the input field (the Fraunhofer
+        diffraction pattern), on a window of Nnew x Nnew points with a
+        size of sizenew, centred at (x_shift, y_shift). The result equals
+        Lens(f) followed by propagation over f, but only the window is
+        computed, at any resolution, with chirp-z (zoom FFT) transforms
+        in O(N^2 log N) operations. Handy to look at the central lobe of
+        a focus without a large grid.
+
+        Args::
+        
+            f: focal length of the lens
+            sizenew: size of the window
+            Nnew: grid dimension of the window
+            x_shift, y_shift: centre of the window
+            Fin: input field
+            
+        Returns::
+         
+            Fout: output field (Nnew x Nnew square array of complex numbers).
+
+        """
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        Fout = _empty((Nnew, Nnew), F.dtype)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.FarField(f, sizenew, Nnew, x_shift, y_shift, sF, sFout)
+            else:
+                lp.FarField(f, sizenew, Nnew, x_shift, y_shift, pF, pFout)
+        return self._result(Fout, &lp)
     def Forward(self, z, sizenew, Nnew, Fin):
         """
         Fout = Forward(z, sizenew, Nnew, Fin)
 
         :ref:`Propagates the field using direct integration. <Forward>`
 
+        The integral is separable and is evaluated as the matrix products
+        -0.5i M Fin M^T, with M a 1-D matrix of Fresnel integrals. Only the
+        bounding box of the nonzero pixels of Fin is integrated.
+
         Args::
         
             z: propagation distance
+            sizenew: size of the new grid
+            Nnew: new grid dimension
             Fin: input field
             
         Returns::
          
-            Fout: output field (N x N square array of complex numbers).
+            Fout: output field (Nnew x Nnew square array of complex numbers).
                 
         Example:
         
         :ref:`Diffraction from a circular aperture <Diffraction>`
         
         """
-        return self.thisptr.Forward(z, sizenew, Nnew, Fin)
-    def Forvard(self, z, Fin):
-        """
-        Fout = Forvard(z, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        rows = np.flatnonzero(F.any(axis=1))
+        cols = np.flatnonzero(F.any(axis=0))
+        Fout = _empty((Nnew, Nnew), F.dtype)
+        if rows.size == 0:
+            Fout[:] = 0
+        else:
+            r0, r1 = rows[0], rows[-1] + 1
+            c0, c1 = cols[0], cols[-1] + 1
+            Mx = self._forward_matrix(&lp, z, sizenew, Nnew, r0, r1)
+            if (c0, c1) == (r0, r1):
+                My = Mx
+            else:
+                My = self._forward_matrix(&lp, z, sizenew, Nnew, c0, c1)
+            Mx = Mx.astype(F.dtype, copy=False)
+            My = My.astype(F.dtype, copy=False)
+            np.matmul(np.matmul(Mx, F[r0:r1, c0:c1]), My.T, out=Fout)
+            Fout *= -0.5j
+        lp.size = sizenew
+        lp.N = Nnew
+        return self._result(Fout, &lp)
+    def Forvard(self, double z, Fin, out=None):
+        """
+        Fout = Forvard(z, Fin, out=None)
 
         :ref:`Propagates the field using a FFT algorithm. <Forvard>`
 
         Args::
         
             z: propagation distance
-            Fin: input field
+            Fin: input field, or a K x N x N stack of fields with the same
+                grid, which are propagated with one FFTW plan
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
-            Fout: output field (N x N square array of complex numbers).
+            Fout: output field (N x N square array of complex numbers),
+                or a K x N x N stack.
                 
         Example:
         
         :ref:`Diffraction from a circular aperture <Diffraction>`
         
         """
-        return self.thisptr.Forvard(z, Fin)
-    def Fresnel(self, z, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out, True)
+        cdef int K = Fout.shape[0] if Fout.ndim == 3 else 1
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Forvard(z, sFout, K)
+            else:
+                lp.Forvard(z, pFout, K)
+        return self._result(Fout, &lp)
+    def ForvardScan(self, z, Fin, intensity=False, out=None):
         """
-        Fout = Fresnel(z, Fin)
+        Fout = ForvardScan(z, Fin, intensity=False, out=None)
+
+        Propagates the field to a series of distances with the FFT
+        algorithm of Forvard. The spectrum of Fin is computed once, each
+        distance costs one filter pass and one inverse FFT, so a scan
+        through a focus costs about half of calling Forvard for every z.
+
+        Args::
+        
+            z: sequence of Nz propagation distances
+            Fin: input field
+            intensity: if True, return the intensities (as Intensity(0, F))
+                instead of the fields (optional)
+            out: Nz x N x N array for the result, of the dtype of Fin, or
+                of float64 for intensities; may be a np.memmap to write a
+                long scan straight to disk (optional)
+            
+        Returns::
+         
+            Fout: Nz x N x N stack of fields, Fout[k] at distance z[k], or
+                Nz x N x N array of intensities.
+                
+        """
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        zs = np.ascontiguousarray(z, dtype=np.float64).reshape(-1)
+        cdef int nz = zs.shape[0]
+        shape = (nz, lp.N, lp.N)
+        dtype = np.float64 if intensity else F.dtype
+        if out is None:
+            out = np.empty(shape) if intensity else _empty(shape, dtype)
+        elif (not isinstance(out, np.ndarray) or out.dtype != dtype
+                or out.shape != shape or not out.flags.c_contiguous
+                or not out.flags.writeable):
+            raise ValueError('out must be a writeable, C-contiguous {0} array of {1}'.format(
+                ' x '.join(str(n) for n in shape), np.dtype(dtype)))
+        if nz == 0:
+            return out if intensity else self._result(out, &lp)
+        cdef double[::1] zv = zs
+        cdef const double *pz = &zv[0]
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double complex *pFout = NULL
+        cdef float complex *sFout = NULL
+        cdef double *pI = NULL
+        cdef double[::1] Iv
+        if intensity:
+            Iv = _flat(out)
+            pI = &Iv[0]
+        else:
+            pFout = _cptr(out)
+            sFout = _sptr(out)
+        with nogil:
+            if sF != NULL:
+                lp.ForvardScan(nz, pz, sF, sFout, pI)
+            else:
+                lp.ForvardScan(nz, pz, pF, pFout, pI)
+        return out if intensity else self._result(out, &lp)
+    def Fresnel(self, double z, Fin, out=None):
+        """
+        Fout = Fresnel(z, Fin, out=None)
 
         :ref:`Propagates the field using a convolution method. <Fresnel>`
 
         Args::
         
             z: propagation distance
-            Fin: input field
+            Fin: input field, or a K x N x N stack of fields with the same
+                grid, which are propagated with one FFTW plan
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
-            Fout: output field (N x N square array of complex numbers).
+            Fout: output field (N x N square array of complex numbers),
+                or a K x N x N stack.
                 
         Example:
         
         :ref:`Two holes interferometer <Young>`
 
         """
-        return self.thisptr.Fresnel(z, Fin)  
-    def Gain(self, Isat, alpha0, Lgain, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out, True)
+        cdef int K = Fout.shape[0] if Fout.ndim == 3 else 1
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Fresnel(z, sFout, K)
+            else:
+                lp.Fresnel(z, pFout, K)
+        return self._result(Fout, &lp)
+    def FresnelIntegrals(self, x, accuracy='exact'):
         """
-        Fout = Gain(Isat, alpha0, Lgain, Fin)
+        S, C = FresnelIntegrals(x, accuracy='exact')
+
+        Fresnel integrals S(x) = int_0^x sin(pi/2 t^2) dt and
+        C(x) = int_0^x cos(pi/2 t^2) dt, as used by Forward and Fresnel.
+
+        Args::
+        
+            x: number or array of numbers
+            accuracy: 'exact' (relative error ~1e-15) or 'fast' (table
+                interpolation, absolute error < 1e-10)
+            
+        Returns::
+         
+            S, C: arrays with the shape of x.
+
+        """
+        cdef double[::1] xv, Sv, Cv
+        try:
+            acc = _FRESNEL_ACCURACY[accuracy.lower()]
+        except (KeyError, AttributeError):
+            raise ValueError("accuracy must be 'exact' or 'fast'")
+        x = np.asarray(x, dtype=np.float64)
+        S = np.empty(x.shape)
+        C = np.empty(x.shape)
+        if x.size > 0:
+            xv = np.ascontiguousarray(x).reshape(-1)
+            Sv = S.reshape(-1)
+            Cv = C.reshape(-1)
+            fresnl_batch(&xv[0], x.size, &Sv[0], &Cv[0], acc)
+        return S, C
+    def Fuse(self, ops, Fin, out=None):
+        """
+        Fout = Fuse(ops, Fin, out=None)
+
+        Applies a chain of elementwise commands in one sweep over the
+        field, instead of one sweep per command. ops is a sequence of
+        tuples of a command and its arguments without Fin, e.g.::
+
+            F = Fuse([(CircAperture, R, 0, 0), (Lens, f, 0, 0),
+                      (Tilt, tx, ty)], F)
+
+        gives the same field as CircAperture, Lens and Tilt one after
+        the other: the commands apply the same cached masks and
+        transmissions, Fuse applies them to one row of the field after
+        the other instead of to the whole field. The command may also be
+        given by its name, 'Lens'.
+
+        The commands that can be fused are Axicon, CircAperture,
+        CircScreen, Gain, GaussAperture, GaussScreen, IntAttenuator,
+        Lens, RectAperture, RectScreen, Tilt and Zernike.
+
+        Args::
+        
+            ops: sequence of (command, arguments...) tuples
+            Fin: input field
+            out: array for the result, may be Fin itself (optional)
+            
+        Returns::
+         
+            Fout: output field (N x N square array of complex numbers).
+
+        """
+        cdef vector[lpop] cops
+        cdef lpop op
+        for item in ops:
+            name = item[0] if isinstance(item[0], str) else getattr(item[0], '__name__', None)
+            if name not in _FUSE_OPS:
+                raise ValueError('Fuse cannot apply {0!r}, only {1}'.format(
+                    item[0], ', '.join(sorted(_FUSE_OPS))))
+            kind, nargs = _FUSE_OPS[name]
+            args = item[1:]
+            if len(args) != nargs:
+                raise ValueError('{0} takes {1} arguments in Fuse, {2} given'.format(
+                    name, nargs, len(args)))
+            if name == 'Zernike' and (args[0] < 0 or abs(args[1]) > args[0]
+                                      or (args[0] - args[1]) % 2 != 0):
+                raise ValueError('Zernike: n must be larger than zero, |m| <= n and n-|m| must be even')
+            op.kind = kind
+            for k in range(nargs):
+                op.p[k] = args[k]
+            cops.push_back(op)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        cdef int nops = cops.size()
+        with nogil:
+            if sFout != NULL:
+                lp.Fuse(nops, cops.data(), sFout)
+            else:
+                lp.Fuse(nops, cops.data(), pFout)
+        return self._result(Fout, &lp)
+    def Gain(self, double Isat, double alpha0, double Lgain, Fin, out=None):
+        """
+        Fout = Gain(Isat, alpha0, Lgain, Fin, out=None)
 
         :ref:`Propagates the field through a thin saturable gain sheet. <Gain>`
             
@@ -297,6 +934,7 @@ cdef class Init:
             alpha0: small signal gain
             Lgain: length of the gain sheet
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
@@ -307,10 +945,19 @@ cdef class Init:
         :ref:`Unstable resonator <Unstab>`
 
         """
-        return self.thisptr.Gain(Isat, alpha0, Lgain, Fin)
-    def GaussAperture(self, w, x_shift, y_shift, T, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Gain(Isat, alpha0, Lgain, sFout)
+            else:
+                lp.Gain(Isat, alpha0, Lgain, pFout)
+        return self._result(Fout, &lp)
+    def GaussAperture(self, double w, double x_shift, double y_shift, double T, Fin, out=None):
         """
-        Fout = GaussAperture(w, x_shift, y_shift, T, Fin)
+        Fout = GaussAperture(w, x_shift, y_shift, T, Fin, out=None)
         
         :ref:`Inserts an aperture with a Gaussian shape in the field. <GaussAperture>`
         
@@ -322,16 +969,26 @@ cdef class Init:
             x_shift, y_shift: shift from center
             T: center intensity transmission
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
         
         Returns::
         
             Fout: output field (N x N square array of complex numbers).
 
         """   
-        return self.thisptr.GaussAperture( w, x_shift, y_shift, T, Fin)
-    def GaussScreen(self, w, x_shift, y_shift, T, Fin):
-        """
-        Fout = GaussScreen(w, x_shift, y_shift, T, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.GaussAperture(w, x_shift, y_shift, T, sFout)
+            else:
+                lp.GaussAperture(w, x_shift, y_shift, T, pFout)
+        return self._result(Fout, &lp)
+    def GaussScreen(self, double w, double x_shift, double y_shift, double T, Fin, out=None):
+        """
+        Fout = GaussScreen(w, x_shift, y_shift, T, Fin, out=None)
         
         :ref:`Inserts a screen with a Gaussian shape in the field. <GaussScreen>`
     
@@ -343,16 +1000,26 @@ cdef class Init:
             x_shift, y_shift: shift from center
             T: center intensity transmission
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
         
         Returns::
         
             Fout: output field (N x N square array of complex numbers).
 
         """   
-        return self.thisptr.GaussScreen( w, x_shift, y_shift, T, Fin)
-    def GaussHermite(self, m, n, A, w0, Fin):
-        """
-        Fout = GaussHermite(m, n, A, w0, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.GaussScreen(w, x_shift, y_shift, T, sFout)
+            else:
+                lp.GaussScreen(w, x_shift, y_shift, T, pFout)
+        return self._result(Fout, &lp)
+    def GaussHermite(self, int m, int n, double A, double w0, Fin, out=None):
+        """
+        Fout = GaussHermite(m, n, A, w0, Fin, out=None)
         
         :ref:`Substitutes a Gauss-Hermite mode (beam waist) in the field. <GaussHermite>`
     
@@ -364,6 +1031,7 @@ cdef class Init:
             A: Amplitude
             w0: Guaussian spot size parameter in the beam waist (1/e amplitude point)
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
         
@@ -374,10 +1042,19 @@ cdef class Init:
             A. Siegman, "Lasers", p. 642
 
         """
-        return self.thisptr.GaussHermite( m, n, A, w0, Fin)
-    def GaussLaguerre(self, p, m, A, w0, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.GaussHermite(m, n, A, w0, sFout)
+            else:
+                lp.GaussHermite(m, n, A, w0, pFout)
+        return self._result(Fout, &lp)
+    def GaussLaguerre(self, int p, int m, double A, double w0, Fin, out=None):
         """
-        Fout = GaussLaguerre(p, m, A, w0, Fin)
+        Fout = GaussLaguerre(p, m, A, w0, Fin, out=None)
 
         :ref:`Substitutes a Gauss-Laguerre mode (beam waist) in the field. <GaussLaguerre>`
     
@@ -391,6 +1068,7 @@ cdef class Init:
             A: Amplitude
             w0: Guaussian spot size parameter in the beam waist (1/e amplitude point)
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
         
@@ -402,10 +1080,19 @@ cdef class Init:
 
         """
             
-        return self.thisptr.GaussLaguerre( p, m, A, w0, Fin)
-    def IntAttenuator(self, att, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.GaussLaguerre(p, m, A, w0, sFout)
+            else:
+                lp.GaussLaguerre(p, m, A, w0, pFout)
+        return self._result(Fout, &lp)
+    def IntAttenuator(self, double att, Fin, out=None):
         """
-        Fout = IntAttenuator(att, Fin)
+        Fout = IntAttenuator(att, Fin, out=None)
         
         :ref:`Attenuates the intensity of the field. <IntAttenuator>`
             
@@ -415,14 +1102,24 @@ cdef class Init:
         
             att: intensity attenuation factor
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
         
             Fout: output field (N x N square array of complex numbers).
    
         """    
-        return self.thisptr.IntAttenuator( att, Fin)
-    def Intensity(self,flag,Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.IntAttenuator(att, sFout)
+            else:
+                lp.IntAttenuator(att, pFout)
+        return self._result(Fout, &lp)
+    def Intensity(self, int flag, Fin):
         """
         I=Intensity(flag,Fin)
         
@@ -440,8 +1137,19 @@ cdef class Init:
             I: intensity distribution (N x N square array of doubles)
 
         """
-        return self.thisptr.Intensity(flag,Fin)                
-    def Interpol(self, new_size, new_number, x_shift, y_shift, angle, magnif, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        I = np.empty(F.shape, dtype=np.float64)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double *pI = _dptr(I)
+        with nogil:
+            if sF != NULL:
+                lp.Intensity(flag, sF, pI)
+            else:
+                lp.Intensity(flag, pF, pI)
+        return I
+    def Interpol(self, double new_size, int new_number, double x_shift, double y_shift, double angle, double magnif, Fin):
         """
         Fout = Interpol(NewSize, NewN, x_shift, y_shift, angle, magnif, Fin)
         
@@ -461,10 +1169,22 @@ cdef class Init:
             Fout: output field (Nnew x Nnew square array of complex numbers).
   
         """
-        return self.thisptr.Interpol(new_size, new_number, x_shift, y_shift, angle, magnif, Fin)                        
-    def Lens(self, f, x_shift, y_shift, Fin):
-        """
-        Fout = Lens(f, x_shift, y_shift, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        Fout = _empty((new_number, new_number), F.dtype)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Interpol(new_size, new_number, x_shift, y_shift, angle, magnif, sF, sFout)
+            else:
+                lp.Interpol(new_size, new_number, x_shift, y_shift, angle, magnif, pF, pFout)
+        return self._result(Fout, &lp)
+    def Lens(self, double f, double x_shift, double y_shift, Fin, out=None):
+        """
+        Fout = Lens(f, x_shift, y_shift, Fin, out=None)
 
         :ref:`Propagates the field through an ideal, thin lens. <Lens>`
 
@@ -476,16 +1196,26 @@ cdef class Init:
             f: focal length
             x_shift, y_shift: shift from center
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
         
             Fout: output field (N x N square array of complex numbers).
     
         """
-        return self.thisptr.Lens(f, x_shift, y_shift, Fin)
-    def LensForvard(self, f, z, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Lens(f, x_shift, y_shift, sFout)
+            else:
+                lp.Lens(f, x_shift, y_shift, pFout)
+        return self._result(Fout, &lp)
+    def LensForvard(self, double f, double z, Fin, out=None):
         """
-        Fout = LensForvard(f, z, Fin)
+        Fout = LensForvard(f, z, Fin, out=None)
 
         :ref:`Propagates the field in a variable spherical coordinate system. <LensForvard>`
             
@@ -494,6 +1224,7 @@ cdef class Init:
             f: focal length
             z: propagation distance
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
@@ -504,10 +1235,19 @@ cdef class Init:
         :ref:`Spherical coordinates <SphericalCoordinates>`
             
         """
-        return self.thisptr.LensForvard(f, z, Fin)
-    def LensFresnel(self, f, z, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.LensForvard(f, z, sFout)
+            else:
+                lp.LensForvard(f, z, pFout)
+        return self._result(Fout, &lp)
+    def LensFresnel(self, double f, double z, Fin, out=None):
         """
-        Fout = LensFresnel(f, z, Fin)
+        Fout = LensFresnel(f, z, Fin, out=None)
 
         :ref:`Propagates the field in a variable spherical coordinate system. <LensFresnel>`
             
@@ -516,6 +1256,7 @@ cdef class Init:
             f: focal length
             z: propagation distance
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
@@ -526,10 +1267,19 @@ cdef class Init:
         :ref:`Spherical coordinates <SphericalCoordinates>`
             
         """
-        return self.thisptr.LensFresnel(f, z, Fin)
-    def MultIntensity(self, Intens, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.LensFresnel(f, z, sFout)
+            else:
+                lp.LensFresnel(f, z, pFout)
+        return self._result(Fout, &lp)
+    def MultIntensity(self, Intens, Fin, out=None):
         """
-        Fout = MultIntensity(Intens, Fin)
+        Fout = MultIntensity(Intens, Fin, out=None)
 
         :ref:`Multiplies the field with a given intensity distribution. <MultIntensity>`
             
@@ -537,16 +1287,30 @@ cdef class Init:
             
             Intens: N x N square array of real numbers
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.MultIntensity( Intens, Fin)
-    def MultPhase(self, Phase, Fin):
-        """
-        Fout = MultPhase(Phase, Fin)
+        A = self._real(Intens)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double *pA = _dptr(A)
+        cdef int nx = A.shape[0]
+        cdef int ny = A.shape[1]
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.MultIntensity(pA, nx, ny, sFout)
+            else:
+                lp.MultIntensity(pA, nx, ny, pFout)
+        return self._result(Fout, &lp)
+    def MultPhase(self, Phase, Fin, out=None):
+        """
+        Fout = MultPhase(Phase, Fin, out=None)
 
         :ref:`Multiplies the field with a given phase distribution. <MultPhase>`
             
@@ -554,30 +1318,54 @@ cdef class Init:
             
             Phase: N x N square array of real numbers
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.MultPhase( Phase, Fin)
-    def Normal(self, Fin):
-        """
-        Fout = Normal(Fin)
+        A = self._real(Phase)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double *pA = _dptr(A)
+        cdef int nx = A.shape[0]
+        cdef int ny = A.shape[1]
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.MultPhase(pA, nx, ny, sFout)
+            else:
+                lp.MultPhase(pA, nx, ny, pFout)
+        return self._result(Fout, &lp)
+    def Normal(self, Fin, out=None):
+        """
+        Fout = Normal(Fin, out=None)
 
         :ref:`Normalizes the field. <Normal>`
             
         Args::
             
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.Normal(Fin)        
-    def Phase(self,Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Normal(sFout)
+            else:
+                lp.Normal(pFout)
+        return self._result(Fout, &lp)
+    def Phase(self, Fin):
         """
         Phi=Phase(Fin)
         
@@ -593,8 +1381,19 @@ cdef class Init:
             Phi: phase distribution (N x N square array of doubles)
 
         """
-        return self.thisptr.Phase(Fin)    
-    def PhaseUnwrap(self,Phi):
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        Phi = np.empty(F.shape, dtype=np.float64)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double *pPhi = _dptr(Phi)
+        with nogil:
+            if sF != NULL:
+                lp.Phase(sF, pPhi)
+            else:
+                lp.Phase(pF, pPhi)
+        return Phi
+    def PhaseUnwrap(self, Phi):
         """
         PhiOut=PhaseUnwrap(PhiIn)
         
@@ -610,24 +1409,48 @@ cdef class Init:
             PhiOut: unwrapped phase distribution (N x N square array of doubles)
 
         """
-        return self.thisptr.PhaseUnwrap(Phi)        
-    def PipFFT(self, index, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        PhiIn = self._real(Phi)
+        N = PhiIn.shape[0]
+        if PhiIn.shape != (N, N):
+            raise ValueError('Phi must be a square array of real numbers')
+        lp.N = N
+        PhiOut = np.zeros((N, N), dtype=np.float64)
+        cdef double *pPhiIn = _dptr(PhiIn)
+        cdef double *pPhiOut = _dptr(PhiOut)
+        with nogil:
+            lp.PhaseUnwrap(pPhiIn, pPhiOut)
+        return PhiOut
+    def PipFFT(self, int index, Fin, out=None):
         """
-        Fout = PipFFT(index, Fin)
+        Fout = PipFFT(index, Fin, out=None)
 
         :ref:`Performs a 2D Fourier transform of the field. <PipFFT>`
             
         Args::
             
             index: +1 = forward transform, -1 = back transform
-            Fin: input field
+            Fin: input field, or a K x N x N stack of fields with the same
+                grid, which are transformed with one FFTW plan
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
-            Fout: output field (N x N square array of complex numbers).
+            Fout: output field (N x N square array of complex numbers),
+                or a K x N x N stack.
   
         """
-        return self.thisptr.PipFFT(index, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out, True)
+        cdef int K = Fout.shape[0] if Fout.ndim == 3 else 1
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.PipFFT(index, sFout, K)
+            else:
+                lp.PipFFT(index, pFout, K)
+        return self._result(Fout, &lp)
     def Power(self, Fin):
         """
         P = Power(Fin)
@@ -643,10 +1466,72 @@ cdef class Init:
             P: output power (real number).
   
         """
-        return self.thisptr.Power(Fin)
-    def RandomIntensity(self, seed, noise, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double result
+        with nogil:
+            if sF != NULL:
+                result = lp.Power(sF)
+            else:
+                result = lp.Power(pF)
+        return result
+    def Propagate(self, double z, Fin, out=None):
+        """
+        Fout = Propagate(z, Fin, out=None)
+
+        Propagates the field with the band-limited angular spectrum method.
+
+        Unlike Forvard this is not paraxial, so it also holds for short
+        distances and high-NA fields. The transfer function
+        exp(i 2 pi z sqrt(1/lambda^2 - fx^2 - fy^2)) is cut off at the
+        spatial frequencies where it would be undersampled (Matsushima
+        and Shimobaba, Opt. Express 17, 19662 (2009)), and it removes the
+        evanescent waves. It uses the FFT plans of Forvard and its
+        transfer functions are cached.
+
+        The field is not zero-padded: like Forvard, Propagate treats it as
+        periodic, and light that leaves the grid comes back in on the
+        opposite side. Keep the light well inside the grid, i.e. the
+        beam plus its spread over z (about lambda*z/dx for features of
+        size dx) within the grid size, or pad the field first, e.g. to
+        twice its size::
+
+            n = N//2
+            G = Propagate(z, Field(np.pad(F, n), 2*size, wavelength))
+            F = Field(G[n:n+N, n:n+N], size, wavelength)
+
+        For paraxial fields that spread beyond the grid use Fresnel, which
+        pads the field itself; Forvard wraps around like Propagate.
+
+        Args::
+        
+            z: propagation distance
+            Fin: input field, or a K x N x N stack of fields with the same
+                grid, which are propagated with one FFTW plan
+            out: array for the result, may be Fin itself (optional)
+            
+        Returns::
+         
+            Fout: output field (N x N square array of complex numbers),
+                or a K x N x N stack.
+
+        """
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out, True)
+        cdef int K = Fout.shape[0] if Fout.ndim == 3 else 1
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Propagate(z, sFout, K)
+            else:
+                lp.Propagate(z, pFout, K)
+        return self._result(Fout, &lp)
+    def RandomIntensity(self, double seed, double noise, Fin, out=None):
         """
-        Fout = RandomIntensity(seed, noise, Fin)
+        Fout = RandomIntensity(seed, noise, Fin, out=None)
 
         :ref:`Adds random intensity to the field <RandomIntensity>`
             
@@ -655,16 +1540,24 @@ cdef class Init:
             seed: seed number for the random noise generator
             noise: level of the noise
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.RandomIntensity(seed, noise, Fin)
-    def RandomPhase(self, seed, maxPhase, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        # rand() is shared by all threads: keep the GIL, so a seed gives one result
+        if Fout.dtype == np.complex64:
+            lp.RandomIntensity(seed, noise, _sptr(Fout))
+        else:
+            lp.RandomIntensity(seed, noise, _cptr(Fout))
+        return self._result(Fout, &lp)
+    def RandomPhase(self, double seed, double maxPhase, Fin, out=None):
         """
-        Fout = RandomPhase(seed, maxPhase, Fin)
+        Fout = RandomPhase(seed, maxPhase, Fin, out=None)
 
         :ref:`Adds random phase to the field <RandomPhase>`
             
@@ -673,16 +1566,24 @@ cdef class Init:
             seed: seed number for the random noise generator
             maxPhase: maximum phase in radians
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.RandomPhase(seed, maxPhase, Fin)                
-    def RectAperture(self, sx, sy, x_shift, y_shift, angle, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        # rand() is shared by all threads: keep the GIL, so a seed gives one result
+        if Fout.dtype == np.complex64:
+            lp.RandomPhase(seed, maxPhase, _sptr(Fout))
+        else:
+            lp.RandomPhase(seed, maxPhase, _cptr(Fout))
+        return self._result(Fout, &lp)
+    def RectAperture(self, double sx, double sy, double x_shift, double y_shift, double angle, Fin, out=None):
         """
-        Fout = RectAperture(w, h, x_shift, y_shift, angle, Fin)
+        Fout = RectAperture(w, h, x_shift, y_shift, angle, Fin, out=None)
         
         :ref:`Propagates the field through a rectangular aperture. <RectAperture>`
 
@@ -693,16 +1594,26 @@ cdef class Init:
             x_shift, y_shift: shift from the center
             angle: rotation angle in degrees 
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
             Fout: output field (N x N square array of complex numbers).
 
         """
-        return self.thisptr.RectAperture(sx, sy, x_shift, y_shift, angle, Fin)
-    def RectScreen(self, sx, sy, x_shift, y_shift, angle, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.RectAperture(sx, sy, x_shift, y_shift, angle, sFout)
+            else:
+                lp.RectAperture(sx, sy, x_shift, y_shift, angle, pFout)
+        return self._result(Fout, &lp)
+    def RectScreen(self, double sx, double sy, double x_shift, double y_shift, double angle, Fin, out=None):
         """
-        Fout = RectScreen(w, h, x_shift, y_shift, angle, Fin)
+        Fout = RectScreen(w, h, x_shift, y_shift, angle, Fin, out=None)
         
         :ref:`Diffracts the field by a rectangular screen. <RectScreen>`
 
@@ -713,16 +1624,68 @@ cdef class Init:
             x_shift, y_shift: shift from the center
             angle: rotation angle in degrees 
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
          
             Fout: output field (N x N square array of complex numbers).
 
         """    
-        return self.thisptr.RectScreen(sx, sy, x_shift, y_shift, angle, Fin)
-    def Steps(self, z, nstep, refr, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.RectScreen(sx, sy, x_shift, y_shift, angle, sFout)
+            else:
+                lp.RectScreen(sx, sy, x_shift, y_shift, angle, pFout)
+        return self._result(Fout, &lp)
+    def ScaledFresnel(self, double z, double sizenew, int Nnew, Fin):
+        """
+        Fout = ScaledFresnel(z, sizenew, Nnew, Fin)
+
+        Propagates the field to a new grid of Nnew x Nnew points with a
+        size of sizenew, like Forward, but in O(N^2 log N) operations with
+        chirp-z (Bluestein) transforms.
+
+        If the Fresnel number of the grid, N dx^2/(lambda z) with
+        dx = GridSize/N, is larger than 1 (near field), the Fresnel
+        transfer function is applied to the spectrum of the field, as in
+        Forvard, and the new grid is sampled with a scaled inverse DFT;
+        there the result is periodic with the size of the input grid.
+        Otherwise the Fresnel integral is evaluated as a scaled DFT
+        between two chirps. Both use the grid x = (i - N/2) dx of the
+        other commands.
+
+        Args::
+        
+            z: propagation distance
+            sizenew: size of the new grid
+            Nnew: new grid dimension
+            Fin: input field
+            
+        Returns::
+         
+            Fout: output field (Nnew x Nnew square array of complex numbers).
+
         """
-        Fout = Steps(z, nstep, refr, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, True)
+        Fout = _empty((Nnew, Nnew), F.dtype)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.ScaledFresnel(z, sizenew, Nnew, sF, sFout)
+            else:
+                lp.ScaledFresnel(z, sizenew, Nnew, pF, pFout)
+        return self._result(Fout, &lp)
+    def Steps(self, double z, int nstep, refr, Fin, out=None):
+        """
+        Fout = Steps(z, nstep, refr, Fin, out=None)
                      
         :ref:`Propagates the field a distance, nstep x z, in nstep steps in a
         medium with a complex refractive index stored in the
@@ -734,6 +1697,7 @@ cdef class Init:
             nstep: number of steps
             refr: refractive index (N x N array of complex numbers)
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
           
@@ -744,7 +1708,18 @@ cdef class Init:
         :ref:`Propagation through a lens like medium <lenslikemedium>`
         
         """
-        return self.thisptr.Steps(z, nstep, refr, Fin)  
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        R = self._field(np.asarray(refr, dtype=np.complex128), &lp, False)
+        cdef double complex *pR = _cptr(R)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Steps(z, nstep, pR, sFout)
+            else:
+                lp.Steps(z, nstep, pR, pFout)
+        return self._result(Fout, &lp)
     def Strehl(self, Fin):
         """
         S = Strehl( Fin)
@@ -760,10 +1735,20 @@ cdef class Init:
             S: Strehl value (real number).
   
         """
-        return self.thisptr.Strehl(Fin)
-    def SubIntensity(self, Intens, Fin):
-        """
-        Fout = SubIntensity(Intens, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        F = self._field(Fin, &lp, False)
+        cdef double complex *pF = _cptr(F)
+        cdef float complex *sF = _sptr(F)
+        cdef double result
+        with nogil:
+            if sF != NULL:
+                result = lp.Strehl(sF)
+            else:
+                result = lp.Strehl(pF)
+        return result
+    def SubIntensity(self, Intens, Fin, out=None):
+        """
+        Fout = SubIntensity(Intens, Fin, out=None)
 
         :ref:`Substitutes  a given intensity distribution in the field with. <SubIntensity>`
             
@@ -771,16 +1756,30 @@ cdef class Init:
             
             Intens: N x N square array of real numbers
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.SubIntensity( Intens, Fin)
-    def SubPhase(self, Phase, Fin):
-        """
-        Fout = SubPhase(Phase, Fin)
+        A = self._real(Intens)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double *pA = _dptr(A)
+        cdef int nx = A.shape[0]
+        cdef int ny = A.shape[1]
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.SubIntensity(pA, nx, ny, sFout)
+            else:
+                lp.SubIntensity(pA, nx, ny, pFout)
+        return self._result(Fout, &lp)
+    def SubPhase(self, Phase, Fin, out=None):
+        """
+        Fout = SubPhase(Phase, Fin, out=None)
 
         :ref:`Substitutes  a given phase distribution in the field with. <SubPhase>`
             
@@ -788,16 +1787,30 @@ cdef class Init:
             
             Phase: N x N square array of real numbers
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
             
             Fout: output field (N x N square array of complex numbers).
   
         """
-        return self.thisptr.SubPhase( Phase, Fin)       
-    def Tilt(self, tx, ty, Fin):
-        """
-        Fout = Tilt(tx, ty, Fin)
+        A = self._real(Phase)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double *pA = _dptr(A)
+        cdef int nx = A.shape[0]
+        cdef int ny = A.shape[1]
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.SubPhase(pA, nx, ny, sFout)
+            else:
+                lp.SubPhase(pA, nx, ny, pFout)
+        return self._result(Fout, &lp)
+    def Tilt(self, double tx, double ty, Fin, out=None):
+        """
+        Fout = Tilt(tx, ty, Fin, out=None)
 
         :ref:`Tilts the field. <Tilt>`
 
@@ -805,16 +1818,26 @@ cdef class Init:
         
             tx, ty: tilt in radians
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
         
             Fout: output field (N x N square array of complex numbers).
     
         """
-        return self.thisptr.Tilt( tx, ty, Fin)  
-    def Zernike(self, n, m, R, A, Fin):
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Tilt(tx, ty, sFout)
+            else:
+                lp.Tilt(tx, ty, pFout)
+        return self._result(Fout, &lp)
+    def Zernike(self, int n, int m, double R, double A, Fin, out=None):
         """
-        Fout = Zernike(n, m, R, A, Fin)
+        Fout = Zernike(n, m, R, A, Fin, out=None)
 
         :ref:`Substitutes a Zernike aberration phase distribution in the field. <Zernike>`
             
@@ -844,6 +1867,7 @@ cdef class Init:
             R: radius of the aberrated aperture
             A: size of the aberration
             Fin: input field
+            out: array for the result, may be Fin itself (optional)
             
         Returns::
           
@@ -857,7 +1881,51 @@ cdef class Init:
  
 
         """
-        return self.thisptr.Zernike(n, m, R, A, Fin)
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.Zernike(n, m, R, A, sFout)
+            else:
+                lp.Zernike(n, m, R, A, pFout)
+        return self._result(Fout, &lp)
+    def ZernikeSum(self, double R, A, Fin, out=None):
+        """
+        Fout = ZernikeSum(R, A, Fin, out=None)
+
+        Substitutes a sum of Zernike aberrations in the field, in one pass.
+        A[j-1] is the size of the aberration with Noll index j, see
+        noll_to_zern, so the result is that of Zernike(n, m, R, A[j-1], Fin)
+        for all (n, m) = noll_to_zern(j), j = 1, ..., len(A). Terms with a
+        zero coefficient are skipped.
+
+        Args::
+        
+            R: radius of the aberrated aperture
+            A: sequence of the sizes of the aberrations, in Noll order
+            Fin: input field
+            out: array for the result, may be Fin itself (optional)
+            
+        Returns::
+          
+            Fout: ouput field (N x N square array of complex numbers).
+
+        """
+        cdef double[::1] Av = np.ascontiguousarray(A, dtype=np.float64).reshape(-1)
+        cdef int nterms = Av.shape[0]
+        cdef const double *pA = &Av[0] if nterms > 0 else NULL
+        cdef lpspy lp = self.thisptr[0]
+        Fout = self._field(Fin, &lp, True, out)
+        cdef double complex *pFout = _cptr(Fout)
+        cdef float complex *sFout = _sptr(Fout)
+        with nogil:
+            if sFout != NULL:
+                lp.ZernikeSum(nterms, pA, R, sFout)
+            else:
+                lp.ZernikeSum(nterms, pA, R, pFout)
+        return self._result(Fout, &lp)
     def noll_to_zern(self,j):
         """
         Convert linear Noll index to tuple of Zernike indices.
@@ -923,6 +1991,8 @@ cdef class Init:
     def LPtest(self):
         """
         Performs a test to check if the installation of the LightPipes package was successful.
+        Also checks that the caches, FFT plans, single precision, stacks and
+        the other fast paths give the results of the plain commands.
         
         Args::
         
@@ -958,8 +2028,11 @@ cdef class Init:
         '(0.0019701 + -0.0485514i)',
         '(0.0013726 + -0.0346812i)'
         ]
-        if Fa==Faa:
+        failed = [name for name, check in _LPCHECKS if not check(Init())]
+        if Fa==Faa and not failed:
             self.thisptr.test()
+        elif failed:
+            print('Test failed: ' + ', '.join(failed))
         else:
             print('Test failed')
 
@@ -991,7 +2064,10 @@ cdef class Init:
         """
         setGridSize(newGridSize)
         
-        Changes the value of the grid size.
+        Changes the value of the grid size. It applies to the following
+        commands, also on the Fields made before it; later Fields carry
+        their own grid size again. Not thread safe: it also changes the
+        Fields that other threads are using with this instance.
         
         Args::
         
@@ -1003,6 +2079,7 @@ cdef class Init:
 
         """
         self.thisptr.setGridSize(newSize)
+        self._gridsizeset = (next(_stamps), self.thisptr.getGridSize())
     def getWavelength(self):
         """
         wavelength = getWavelength()
@@ -1023,7 +2100,16 @@ cdef class Init:
         """
         setWavelength(newWavelength)
         
-        Changes the value of the wavelength.
+        Changes the value of the wavelength. It applies to the following
+        commands, also on the Fields made before, e.g.::
+
+            F = Begin(size, wavelength, N)
+            setWavelength(newWavelength)
+            F = Forvard(z, F)
+
+        propagates at newWavelength; later Fields carry their own
+        wavelength again. Not thread safe: it also changes the Fields
+        that other threads are using with this instance.
         
         Args::
         
@@ -1035,6 +2121,7 @@ cdef class Init:
 
         """ 
         self.thisptr.setWavelength(newWavelength)
+        self._wavelengthset = (next(_stamps), self.thisptr.getWavelength())
     def getGridDimension(self):
         """
         grid-dimension = getGridDimension()
@@ -1052,6 +2139,241 @@ cdef class Init:
 
         """
         return self.thisptr.getGridDimension()
+    def setPlanningEffort(self, effort):
+        """
+        setPlanningEffort(effort)
+        
+        Sets how much time FFTW spends on finding fast FFT plans. Plans are
+        made once per grid dimension and kept, so in long loops (e.g. laser
+        resonators) 'measure' or 'patient' can pay off. Plans that already
+        exist are kept.
+        
+        Args::
+        
+            effort: 'estimate' (default), 'measure', 'patient' or 'exhaustive'
+            
+        Returns::
+        
+            -
+
+        """
+        try:
+            self.thisptr.planflags = _PLANNING_EFFORT[effort.lower()]
+        except (KeyError, AttributeError):
+            raise ValueError("effort must be one of 'estimate', 'measure', 'patient' or 'exhaustive'")
+    def getPlanningEffort(self):
+        """
+        effort = getPlanningEffort()
+        
+        Returns the FFTW planning effort, see setPlanningEffort.
+        
+        Args::
+        
+            -
+            
+        Returns::
+        
+            effort: 'estimate', 'measure', 'patient' or 'exhaustive'
+
+        """
+        for effort, flags in _PLANNING_EFFORT.items():
+            if flags == self.thisptr.planflags:
+                return effort
+    def setFresnelAccuracy(self, accuracy):
+        """
+        setFresnelAccuracy(accuracy)
+        
+        Sets the accuracy of the Fresnel integrals in Forward and Fresnel,
+        see FresnelIntegrals. 'fast' interpolates them in a table, which
+        makes the kernels faster to compute.
+        
+        Args::
+        
+            accuracy: 'exact' (default) or 'fast'
+            
+        Returns::
+        
+            -
+
+        """
+        try:
+            self.thisptr.fresnlaccuracy = _FRESNEL_ACCURACY[accuracy.lower()]
+        except (KeyError, AttributeError):
+            raise ValueError("accuracy must be 'exact' or 'fast'")
+    def getFresnelAccuracy(self):
+        """
+        accuracy = getFresnelAccuracy()
+        
+        Returns the accuracy of the Fresnel integrals, see setFresnelAccuracy.
+        
+        Args::
+        
+            -
+            
+        Returns::
+        
+            accuracy: 'exact' or 'fast'
+
+        """
+        for accuracy, acc in _FRESNEL_ACCURACY.items():
+            if acc == self.thisptr.fresnlaccuracy:
+                return accuracy
+    def setThreads(self, n):
+        """
+        setThreads(n)
+        
+        Sets the number of threads FFTW uses for the transforms in Forvard,
+        Fresnel and PipFFT. The default is the number of CPUs.
+        
+        Args::
+        
+            n: number of threads (>= 1)
+            
+        Returns::
+        
+            -
+
+        """
+        if n < 1:
+            raise ValueError('the number of threads must be at least 1')
+        self.thisptr.nthreads = n
+    def getThreads(self):
+        """
+        n = getThreads()
+        
+        Returns the number of threads used for the FFTs, see setThreads.
+        
+        Args::
+        
+            -
+            
+        Returns::
+        
+            n: number of threads (integer).
+
+        """
+        return self.thisptr.nthreads
+    def setCacheSize(self, size):
+        """
+        setCacheSize(size)
+        
+        Sets the memory for the cache of transfer functions and kernels of
+        Forvard and Fresnel, so that repeated propagations over the same
+        distance skip their computation. The least recently used ones are
+        dropped when the cache is full. The default is 256 MB.
+        
+        Args::
+        
+            size: size of the cache in MB (0 switches the cache off)
+            
+        Returns::
+        
+            -
+
+        """
+        if size < 0:
+            raise ValueError('the cache size cannot be negative')
+        self.thisptr.setCacheSize(size*1024.0*1024.0)
+    def getCacheSize(self):
+        """
+        size = getCacheSize()
+        
+        Returns the size of the cache, see setCacheSize.
+        
+        Args::
+        
+            -
+            
+        Returns::
+        
+            size: size of the cache in MB.
+
+        """
+        return self.thisptr.getCacheSize()/(1024.0*1024.0)
+    def clearCache(self):
+        """
+        clearCache()
+        
+        Empties the cache of transfer functions and kernels, see setCacheSize.
+        
+        Args::
+        
+            -
+            
+        Returns::
+        
+            -
+
+        """
+        self.thisptr.clearCache()
+    def prePlan(self, N):
+        """
+        prePlan(N)
+        
+        Makes the FFT plans for Forvard, PipFFT and Fresnel in advance, with
+        the current planning effort, for fields of complex128 and of
+        complex64.
+        
+        Args::
+        
+            N: grid dimension, or a list of grid dimensions
+            
+        Returns::
+        
+            -
+
+        """
+        cdef int n
+        for NN in np.atleast_1d(N):
+            n = int(NN)
+            with nogil:
+                self.thisptr.prePlan(n)
+    def importWisdom(self, filename):
+        """
+        importWisdom(filename)
+        
+        Reads FFTW wisdom, saved before with exportWisdom, so that plans
+        found on an earlier run are made without measuring again.
+        
+        Args::
+        
+            filename: name of the wisdom file
+            
+        Returns::
+        
+            -
+
+        """
+        cdef bytes name = os.fsencode(filename)
+        cdef const char *cname = name
+        cdef int ok
+        with nogil:
+            ok = self.thisptr.importWisdom(cname)
+        if not ok:
+            raise IOError('cannot read FFTW wisdom from {}'.format(filename))
+    def exportWisdom(self, filename):
+        """
+        exportWisdom(filename)
+        
+        Saves the FFTW wisdom of all plans made so far, double and single
+        precision, see importWisdom.
+        
+        Args::
+        
+            filename: name of the wisdom file
+            
+        Returns::
+        
+            -
+
+        """
+        cdef bytes name = os.fsencode(filename)
+        cdef const char *cname = name
+        cdef int ok
+        with nogil:
+            ok = self.thisptr.exportWisdom(cname)
+        if not ok:
+            raise IOError('cannot write FFTW wisdom to {}'.format(filename))
     def GaussBeam(self,size,labda,N,w,tx,ty):
         """
         F=GaussBeam(GridSize, Wavelength, N, w, tx,ty)
@@ -1167,3 +2489,328 @@ cdef class Init:
         print('on a ' + platform.system() + ' ' + platform.release() + ' ' + platform.machine() +' machine')
         plt.show()
 
+# The checks of LPtest: each compares a faster path of the commands (a
+# cache, a plan, another precision, a batch) with the plain command it
+# stands for, on a new instance, and returns True if they agree.
+
+def _agree(A, B, tol):
+    # A equals B to tol, relative to the largest value of B
+    A = np.asarray(A)
+    B = np.asarray(B)
+    return A.shape == B.shape and np.abs(A - B).max() <= tol*np.abs(B).max()
+
+def _testfield(LP, N=64, dtype=np.complex128):
+    # a shifted, tilted Gaussian beam behind an aperture, no symmetries
+    F = LP.Begin(10e-3, 1e-6, N, dtype)
+    F = LP.GaussAperture(2e-3, 2e-4, -1e-4, 1.0, F)
+    F = LP.CircAperture(3e-3, -3e-4, 2e-4, F)
+    return LP.Tilt(1e-4, -5e-5, F)
+
+def _check_plans(LP):
+    # the result does not depend on how the FFT plans were found
+    F = _testfield(LP)
+    F64 = _testfield(LP, dtype=np.complex64)
+    A = LP.Forvard(0.5, F)
+    A64 = LP.Forvard(0.5, F64)
+    LP2 = Init()
+    LP2.setPlanningEffort('measure')
+    LP2.prePlan(F.N)
+    B = LP2.Forvard(0.5, F)
+    B64 = LP2.Forvard(0.5, F64)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        LP2.exportWisdom(path)
+        LP3 = Init()
+        LP3.setPlanningEffort('measure')
+        LP3.importWisdom(path)
+        C = LP3.Forvard(0.5, F)
+        C64 = LP3.Forvard(0.5, F64)
+    finally:
+        os.remove(path)
+    return (_agree(B, A, 1e-12) and _agree(C, A, 1e-12)
+            and _agree(B64, A64, 1e-5) and _agree(C64, A64, 1e-5))
+
+def _check_cache(LP):
+    # the cached filters and kernels of Forvard and Fresnel give the
+    # same result as without cache
+    F = _testfield(LP)
+    ref = Init()
+    ref.setCacheSize(0)
+    for cmd in (LP.Forvard, LP.Fresnel):
+        A = getattr(ref, cmd.__name__)(0.5, F)
+        if not (np.array_equal(cmd(0.5, F), A) and np.array_equal(cmd(0.5, F), A)):
+            return False
+    return True
+
+def _check_out(LP):
+    # out=, also in place, gives the same result as a new field
+    F = _testfield(LP)
+    for cmd, args in ((LP.CircAperture, (2e-3, 0, 0)), (LP.Lens, (1.0, 0, 0)),
+                      (LP.Forvard, (0.5,)), (LP.Fresnel, (0.5,))):
+        A = cmd(*args, F)
+        out = np.empty_like(np.asarray(F))
+        B = cmd(*args, F, out=out)
+        C = F.copy()
+        cmd(*args, C, out=C)
+        if not (np.array_equal(B, A) and np.array_equal(out, A) and np.array_equal(C, A)):
+            return False
+    return True
+
+def _check_single(LP):
+    # a complex64 field gives the complex128 result to single precision
+    F = _testfield(LP)
+    F32 = _testfield(LP, dtype=np.complex64)
+    for cmd, args in ((LP.Lens, (1.0, 0, 0)), (LP.Forvard, (0.5,)),
+                      (LP.Fresnel, (0.5,)), (LP.PipFFT, (1,))):
+        A = cmd(*args, F)
+        B = cmd(*args, F32)
+        if B.dtype != np.complex64 or not _agree(B, A, 1e-5):
+            return False
+    return True
+
+def _check_stack(LP):
+    # a stack of fields gives the results of the fields one by one
+    F = _testfield(LP)
+    S = Field(np.array([F, LP.Lens(1.0, 0, 0, F)]), F.gridsize, F.wavelength)
+    for cmd, arg in ((LP.Forvard, 0.5), (LP.Fresnel, 0.5), (LP.PipFFT, 1)):
+        B = cmd(arg, S)
+        for k in range(S.shape[0]):
+            if not _agree(B[k], cmd(arg, S[k]), 1e-12):
+                return False
+    return True
+
+def _check_forvardscan(LP):
+    # ForvardScan gives the fields and intensities of Forvard
+    F = _testfield(LP)
+    z = [0.1, 0.5, -0.3]
+    S = LP.ForvardScan(z, F)
+    I = LP.ForvardScan(z, F, intensity=True)
+    for k in range(len(z)):
+        A = LP.Forvard(z[k], F)
+        if not (_agree(S[k], A, 1e-12) and _agree(I[k], LP.Intensity(0, A), 1e-12)):
+            return False
+    return True
+
+def _check_propagate(LP):
+    # Propagate is Forvard for a paraxial beam, with or without cache
+    F = LP.Begin(10e-3, 1e-6, 64)
+    F = LP.GaussAperture(1e-3, 2e-4, -1e-4, 1.0, F)
+    A = LP.Forvard(0.1, F)
+    B = LP.Propagate(0.1, F)
+    ref = Init()
+    ref.setCacheSize(0)
+    return (_agree(B, A, 1e-3) and np.array_equal(LP.Propagate(0.1, F), B)
+            and np.array_equal(ref.Propagate(0.1, F), B))
+
+def _check_scaledfresnel(LP):
+    # ScaledFresnel is Forvard on the same grid in the near field, and
+    # the sum of the Fresnel integral in the far field
+    F = _testfield(LP)
+    if not _agree(LP.ScaledFresnel(0.5, F.gridsize, F.N, F), LP.Forvard(0.5, F), 1e-8):
+        return False
+    z, sizenew, Nnew = 20.0, 30e-3, 80
+    x = (np.arange(F.N) - F.N//2)*F.gridsize/F.N
+    xnew = (np.arange(Nnew) - Nnew//2)*sizenew/Nnew
+    M = np.exp(1j*math.pi*(xnew[:, None] - x[None, :])**2/(F.wavelength*z))
+    A = (np.exp(2j*3.141592654/F.wavelength*z)*(F.gridsize/F.N)**2/(1j*F.wavelength*z)
+         *M.dot(np.asarray(F)).dot(M.T))
+    ref = Init()
+    ref.setCacheSize(0)
+    B = LP.ScaledFresnel(z, sizenew, Nnew, F)
+    return (_agree(B, A, 1e-8) and np.array_equal(LP.ScaledFresnel(z, sizenew, Nnew, F), B)
+            and np.array_equal(ref.ScaledFresnel(z, sizenew, Nnew, F), B))
+
+def _check_farfield(LP):
+    # FarField is ScaledFresnel over f behind Lens(f), and a shifted
+    # window is part of a larger one
+    F = _testfield(LP)
+    A = LP.ScaledFresnel(2.0, 4e-3, 48, LP.Lens(2.0, 0, 0, F))
+    B = LP.FarField(2.0, 4e-3, 48, 0, 0, F)
+    d = 4e-3/48
+    C = LP.FarField(2.0, 8e-3, 96, 0, 0, F)[26:74, 21:69]
+    D = LP.FarField(2.0, 4e-3, 48, 2*d, -3*d, F)
+    ref = Init()
+    ref.setCacheSize(0)
+    return (_agree(B, A, 1e-6) and _agree(D, C, 1e-8)
+            and np.array_equal(ref.FarField(2.0, 4e-3, 48, 0, 0, F), B))
+
+def _check_fuse(LP):
+    # Fuse gives exactly the commands one after the other
+    ops = [(LP.CircAperture, 4e-3, 1e-4, 0), (LP.RectScreen, 1e-3, 5e-4, 2e-4, 0, 30),
+           (LP.RectAperture, 8e-3, 7e-3, 0, 1e-4, 10), (LP.GaussScreen, 1e-3, 0, 0, 0.3),
+           (LP.GaussAperture, 3e-3, 1e-4, 0, 0.8), (LP.Lens, 1.0, 1e-4, -2e-4),
+           (LP.Tilt, 1e-4, -2e-4), (LP.Axicon, 3.0, 1.5, 0, 0), (LP.Zernike, 4, 2, 3e-3, 1e-6),
+           (LP.IntAttenuator, 0.5), (LP.Gain, 1.0, 2.0, 0.1), (LP.CircScreen, 2e-4, 0, 0)]
+    for N, dtype in ((64, np.complex128), (63, np.complex64)):
+        F = _testfield(LP, N, dtype)
+        A = F
+        for op in ops:
+            A = op[0](*op[1:], A)
+        if not np.array_equal(LP.Fuse(ops, F), A):
+            return False
+    return True
+
+def _check_masks(LP):
+    # the rasterized apertures and screens zero the pixels of a per-pixel
+    # test on the grid, x along the rows, y along the columns
+    for N in (64, 63):
+        F = _testfield(LP, N)
+        x = (np.arange(N) - N//2)*F.gridsize/N
+        for R, xs, ys in ((2e-3, 1e-4, 0), (1.5e-3, -3e-4, 2.5e-4)):
+            inside = (x[:, None] - xs)**2 + (x[None, :] - ys)**2 <= R*R
+            if not (np.array_equal(LP.CircAperture(R, xs, ys, F), np.where(inside, F, 0))
+                    and np.array_equal(LP.CircScreen(R, xs, ys, F), np.where(inside, 0, F))):
+                return False
+        for sx, sy, xs, ys, angle in ((3e-3, 2e-3, 0, 1e-4, 0), (3e-3, 2e-3, 2e-4, -1e-4, 20),
+                                      (1e-3, 4e-3, -1e-4, 3e-4, -65)):
+            a = -angle*3.141592654/180
+            x0 = x[:, None] - xs
+            y0 = x[None, :] - ys
+            inside = ((np.abs(x0*math.cos(a) + y0*math.sin(a)) <= sx/2)
+                      & (np.abs(-x0*math.sin(a) + y0*math.cos(a)) <= sy/2))
+            if not (np.array_equal(LP.RectAperture(sx, sy, xs, ys, angle, F), np.where(inside, F, 0))
+                    and np.array_equal(LP.RectScreen(sx, sy, xs, ys, angle, F), np.where(inside, 0, F))):
+                return False
+    return True
+
+def _check_screens(LP):
+    # the cached transmissions of the phase elements give the same
+    # result as without cache
+    F = _testfield(LP)
+    ref = Init()
+    ref.setCacheSize(0)
+    for cmd, args in ((LP.Lens, (1.0, 1e-4, 0)), (LP.Tilt, (1e-4, 2e-4)),
+                      (LP.Axicon, (3.0, 1.5, 1e-4, 0)), (LP.Zernike, (3, 1, 3e-3, 1e-6))):
+        A = getattr(ref, cmd.__name__)(*args, F)
+        if not (np.array_equal(cmd(*args, F), A) and np.array_equal(cmd(*args, F), A)):
+            return False
+    return True
+
+def _check_zernikesum(LP):
+    # ZernikeSum is Zernike for each Noll index
+    F = _testfield(LP)
+    c = [0.0, 1e-7, -2e-7, 3e-7, 0.0, 1e-7, 2e-7, -1e-7, 5e-8, 1e-7, -3e-7]
+    A = F
+    for j in range(1, len(c) + 1):
+        n, m = LP.noll_to_zern(j)
+        A = LP.Zernike(n, m, 3e-3, c[j-1], A)
+    return _agree(LP.ZernikeSum(3e-3, c, F), A, 1e-10)
+
+def _check_setters(LP):
+    # setWavelength and setGridSize apply to the Fields made before them
+    F = _testfield(LP)
+    A = LP.Forvard(0.5, Field(F, 2*F.gridsize, 0.5*F.wavelength))
+    LP.setWavelength(0.5*F.wavelength)
+    LP.setGridSize(2*F.gridsize)
+    B = LP.Forvard(0.5, F)
+    return B.wavelength == A.wavelength and B.gridsize == A.gridsize and np.array_equal(B, A)
+
+def _check_forward(LP):
+    # Forward is the direct sum over all old pixels of the products of
+    # Fresnel integrals (as the original O(N^4) loop), for a full field
+    # and for a field whose nonzero box is off center
+    F = _testfield(LP, 16)
+    G = LP.RectAperture(2e-3, 1.5e-3, 1.5e-3, -1.5e-3, 0, F)
+    z, sizenew, Nnew = 0.5, 12e-3, 12
+    dx = F.gridsize/(F.N - 1)
+    dxnew = sizenew/(Nnew - 1)
+    xo = (np.arange(F.N) - F.N//2)*dx
+    xn = (np.arange(Nnew) - Nnew//2)*dxnew
+    R22 = math.sqrt(1/(2*F.wavelength*z))
+    d = 2*(xo[None, :] - xn[:, None])
+    # [i_new, i_old] for P1, P3 and [j_new, j_old] for P2, P4, broadcast
+    # to [i_new, j_new, i_old, j_old]
+    s1, c1 = [v[:, None, :, None] for v in LP.FresnelIntegrals(R22*(d + dx))]
+    s3, c3 = [v[:, None, :, None] for v in LP.FresnelIntegrals(R22*(d - dx))]
+    s2, c2 = [v[None, :, None, :] for v in LP.FresnelIntegrals(R22*(d - dx))]
+    s4, c4 = [v[None, :, None, :] for v in LP.FresnelIntegrals(R22*(d + dx))]
+    for H in (F, G):
+        fr = 0.5*np.asarray(H).real
+        fi = 0.5*np.asarray(H).imag
+        re = (fr*(c2*s3+c4*s1+s4*c1+s2*c3-c2*s1-s4*c3-s2*c1-c4*s3)
+              + fi*(-s2*s3+s2*s1+c2*c3-s4*s1-c4*c3+c4*c1+s4*s3-c2*c1))
+        im = (fr*(-c4*c1+s2*s3+c4*c3-s4*s3+c2*c1-s2*s1+s4*s1-c2*c3)
+              + fi*(c2*s3+s2*c3+c4*s1+s4*c1-c4*s3-s4*c3-c2*s1-s2*c1))
+        A = (re + 1j*im).sum(axis=(2, 3))
+        if not _agree(LP.Forward(z, sizenew, Nnew, H), A, 1e-12):
+            return False
+    return True
+
+def _check_fresnel_integrals(LP):
+    # the table interpolation of 'fast' agrees with 'exact' to 1e-10,
+    # also for large |x|
+    x = np.concatenate((np.linspace(-40, 40, 200001), np.logspace(-8, 6, 2000),
+                        -np.logspace(-8, 6, 2000), [0.0, 1e12, -1e12]))
+    S, C = LP.FresnelIntegrals(x, 'exact')
+    Sf, Cf = LP.FresnelIntegrals(x, 'fast')
+    return np.abs(Sf - S).max() <= 1e-10 and np.abs(Cf - C).max() <= 1e-10
+
+def _check_threads(LP):
+    # the transforms with several FFTW threads give the single thread
+    # result; N=256 is large enough for the threads to be used
+    LP1 = Init()
+    LP1.setThreads(1)
+    LP4 = Init()
+    LP4.setThreads(4)
+    F = _testfield(LP1, 256)
+    for cmd, args in (('Forvard', (0.5,)), ('Fresnel', (0.5,)), ('PipFFT', (1,))):
+        if not _agree(getattr(LP4, cmd)(*args, F), getattr(LP1, cmd)(*args, F), 1e-12):
+            return False
+    return True
+
+def _check_nogil(LP):
+    # the commands and the planner run without the GIL: a Python thread
+    # keeps ticking while this thread plans with 'measure' and another
+    # one calls commands, which wait for the planner
+    P = Init()
+    P.setPlanningEffort('measure')
+    F = _testfield(LP)
+    G = _testfield(LP, 256)
+    done = threading.Event()
+    gaps = []
+    def tick():
+        t = time.perf_counter()
+        while not done.is_set():
+            time.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - t)
+            t = now
+    def call():
+        while not done.is_set():
+            LP.Lens(1.0, 0, 0, F)
+            LP.Fresnel(0.5, G)
+    threads = [threading.Thread(target=f) for f in (tick, call)]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    try:
+        P.prePlan(48)
+    finally:
+        planning = time.perf_counter() - start
+        done.set()
+        for t in threads:
+            t.join()
+    # with wisdom for N=48 from before the planning takes no time
+    return not gaps or max(gaps) < max(planning/4, 0.05)
+
+_LPCHECKS = [
+    ('plans', _check_plans),
+    ('cache', _check_cache),
+    ('out', _check_out),
+    ('complex64', _check_single),
+    ('stacks', _check_stack),
+    ('ForvardScan', _check_forvardscan),
+    ('Propagate', _check_propagate),
+    ('ScaledFresnel', _check_scaledfresnel),
+    ('FarField', _check_farfield),
+    ('Fuse', _check_fuse),
+    ('masks', _check_masks),
+    ('element cache', _check_screens),
+    ('ZernikeSum', _check_zernikesum),
+    ('setters', _check_setters),
+    ('Forward', _check_forward),
+    ('FresnelIntegrals', _check_fresnel_integrals),
+    ('setThreads', _check_threads),
+    ('GIL', _check_nogil),
+]
@@ -7,9 +7,13 @@ __all__ = [
     'CircAperture',
     'CircScreen',
     'Convert',
+    'FarField',
     'Forward',
     'Forvard',
+    'ForvardScan',
     'Fresnel',
+    'FresnelIntegrals',
+    'Fuse',
     'Gain',
     'GaussAperture',
     'GaussScreen',
@@ -28,16 +32,19 @@ __all__ = [
     'PhaseUnwrap',
     'PipFFT',
     'Power',
+    'Propagate',
     'RandomIntensity',
     'RandomPhase',
     'RectAperture',
     'RectScreen',
+    'ScaledFresnel',
     'Steps',
     'Strehl',
     'SubIntensity',
     'SubPhase',
     'Tilt',
     'Zernike',
+    'ZernikeSum',
     'noll_to_zern',
     'ZernikeName',
     'getGridSize',
@@ -45,6 +52,18 @@ __all__ = [
     'getWavelength',
     'setWavelength',
     'getGridDimension',
+    'setPlanningEffort',
+    'getPlanningEffort',
+    'setFresnelAccuracy',
+    'getFresnelAccuracy',
+    'prePlan',
+    'setThreads',
+    'getThreads',
+    'setCacheSize',
+    'getCacheSize',
+    'clearCache',
+    'importWisdom',
+    'exportWisdom',
     'LPtest',
     'LPhelp',
     'GaussBeam',
@@ -60,6 +79,7 @@ LPversion=_version.__version__
 LP = Init() # noqa
 for name in __all__:
     locals()[name] = getattr(LP, name)
+__all__.append('Field')
 
 # define some units
 m = 1.0;mm=1e-3*m; cm=1e-2*m;um=1e-6*m;nm=1e-9*m
@@ -356,3 +356,120 @@ double p1evl( double x, const double *coef, int N ) {
 
 //return( ans );
 //}
+
+/*                                                      fresnl_batch
+ *
+ *      Fresnel integrals of an array
+ *
+ *
+ *
+ * SYNOPSIS:
+ *
+ * int n, accuracy;
+ * double x[n], S[n], C[n];
+ *
+ * fresnl_batch( x, n, S, C, accuracy );
+ *
+ *
+ * DESCRIPTION:
+ *
+ * Evaluates S(x[k]) and C(x[k]) for k = 0 .. n-1, for the kernel builders
+ * of the propagators.
+ *
+ * FRESNL_EXACT: fresnl() for every point.
+ *
+ * FRESNL_FAST: for |x| < FRESNL_XT cubic Hermite interpolation in a table
+ * of C(x), S(x) and their derivatives cos(pi/2 x**2), sin(pi/2 x**2), with
+ * FRESNL_TPU points per unit of x. For larger x the first three terms of
+ * the asymptotic expansions (Abramowitz and Stegun 7.3.27, 7.3.28)
+ *
+ * f(x) = 1/(pi x) (1 - 3/(pi x**2)**2 + 105/(pi x**2)**4)
+ * g(x) = 1/(pi**2 x**3) (1 - 15/(pi x**2)**2 + 945/(pi x**2)**4).
+ *
+ * ACCURACY:
+ *
+ *  Absolute error of FRESNL_FAST < 1e-10 for all x.
+ */
+
+#define FRESNL_XT  8
+#define FRESNL_TPU 1024
+
+namespace {
+struct fresnl_table {
+    int n;
+    double h;
+    double *cc, *ss, *dc, *ds;
+    fresnl_table(){
+        double PIO2 = 1.57079632679489661922;
+        n = FRESNL_XT*FRESNL_TPU + 2;
+        h = 1.0/FRESNL_TPU;
+        cc = new double[4*n];
+        ss = cc + n;
+        dc = ss + n;
+        ds = dc + n;
+        for (int k = 0; k < n; k++){
+            double x = k*h;
+            fresnl(x, &ss[k], &cc[k]);
+            dc[k] = cos(PIO2*x*x);
+            ds[k] = sin(PIO2*x*x);
+        }
+    }
+    ~fresnl_table(){ delete[] cc; }
+};
+}
+
+void fresnl_batch(const double *xa, int n, double *ssa, double *cca, int accuracy)
+{
+if (accuracy != FRESNL_FAST)
+	{
+	for (int k = 0; k < n; k++) fresnl(xa[k], &ssa[k], &cca[k]);
+	return;
+	}
+double PII= 3.14159265358979323844;
+double PIO2 = 1.57079632679489661922;
+// made once, on the first call:
+static const fresnl_table table;
+for (int k = 0; k < n; k++)
+	{
+	double x = fabs(xa[k]);
+	double cc, ss;
+	if (x < FRESNL_XT)
+		{
+		double xt = x*FRESNL_TPU;
+		int i = (int) xt;
+		double t = xt - i;
+		double t2 = t*t;
+		double t3 = t2*t;
+		double h00 = 2*t3 - 3*t2 + 1;
+		double h10 = (t3 - 2*t2 + t)*table.h;
+		double h01 = 3*t2 - 2*t3;
+		double h11 = (t3 - t2)*table.h;
+		cc = h00*table.cc[i] + h10*table.dc[i] + h01*table.cc[i+1] + h11*table.dc[i+1];
+		ss = h00*table.ss[i] + h10*table.ds[i] + h01*table.ss[i+1] + h11*table.ds[i+1];
+		}
+	else if (x > 36974.0)
+		{
+		cc = 0.5;
+		ss = 0.5;
+		}
+	else
+		{
+		double t = PII*x*x;
+		double u = 1.0/(t*t);
+		double f = (1.0 - u*(3.0 - 105.0*u))/(PII*x);
+		double g = (1.0 - u*(15.0 - 945.0*u))/(PII*t*x);
+		t = PIO2*x*x;
+		double c = cos(t);
+		double s = sin(t);
+		cc = 0.5 + f*s - g*c;
+		ss = 0.5 - f*c - g*s;
+		}
+	if (xa[k] < 0.0)
+		{
+		cc = -cc;
+		ss = -ss;
+		}
+	cca[k] = cc;
+	ssa[k] = ss;
+	}
+}
@@ -1 +1,6 @@
 extern int fresnl(double xxa, double *ssa, double *cca);
+
+/* accuracy of fresnl_batch: */
+#define FRESNL_EXACT 0
+#define FRESNL_FAST  1
+extern void fresnl_batch(const double *x, int n, double *ss, double *cc, int accuracy);
@@ -0,0 +1,87 @@
+#ifndef LPCACHE_H
+#define LPCACHE_H
+#include <list>
+#include <map>
+#include <vector>
+#include <utility>
+#include <memory>
+#include <mutex>
+
+namespace std {
+/***********************************************************************
+*  lpcache: least recently used cache for precomputed arrays, like the
+*  transfer functions of the propagators. The key is a list of doubles,
+*  typically (kind, N, size, lambda, z), the kind tells the type of the
+*  value. The cache holds at most maxbytes bytes, the least recently used
+*  arrays are dropped to make room. Values are shared, an array that is
+*  dropped stays valid for the callers that still hold it. All methods
+*  are thread safe.
+***********************************************************************/
+class lpcache {
+    public:
+        typedef vector<double> key_type;
+        lpcache(size_t maxbytes = 256*1024*1024) : maxbytes(maxbytes), nbytes(0) {}
+        // Returns the cached value, or an empty pointer.
+        template <class V> shared_ptr<V> find(const key_type &key){
+            lock_guard<mutex> guard(lock);
+            map<key_type, iterator>::iterator it = index.find(key);
+            if (it == index.end()) return shared_ptr<V>();
+            entries.splice(entries.begin(), entries, it->second);
+            return static_pointer_cast<V>(entries.front().value);
+        }
+        // Stores value, unless it is larger than the whole cache.
+        void insert(const key_type &key, const shared_ptr<void> &value, size_t bytes){
+            lock_guard<mutex> guard(lock);
+            if (bytes > maxbytes) return;
+            erase(key);
+            while (nbytes + bytes > maxbytes) pop();
+            entries.push_front(entry());
+            entries.front().key = key;
+            entries.front().value = value;
+            entries.front().bytes = bytes;
+            index[key] = entries.begin();
+            nbytes += bytes;
+        }
+        void clear(){
+            lock_guard<mutex> guard(lock);
+            entries.clear();
+            index.clear();
+            nbytes = 0;
+        }
+        void resize(size_t newmaxbytes){
+            lock_guard<mutex> guard(lock);
+            maxbytes = newmaxbytes;
+            while (nbytes > maxbytes) pop();
+        }
+        // The largest number of bytes the cache may hold.
+        size_t capacity(){
+            lock_guard<mutex> guard(lock);
+            return maxbytes;
+        }
+    private:
+        mutex lock;
+        size_t maxbytes;
+        struct entry {
+            key_type key;
+            shared_ptr<void> value;
+            size_t bytes;
+        };
+        typedef list<entry>::iterator iterator;
+        list<entry> entries;
+        map<key_type, iterator> index;
+        size_t nbytes;
+        void pop(){
+            nbytes -= entries.back().bytes;
+            index.erase(entries.back().key);
+            entries.pop_back();
+        }
+        void erase(const key_type &key){
+            map<key_type, iterator>::iterator it = index.find(key);
+            if (it == index.end()) return;
+            nbytes -= it->second->bytes;
+            entries.erase(it->second);
+            index.erase(it);
+        }
+};
+}
+#endif
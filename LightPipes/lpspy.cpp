@@ -20,104 +20,526 @@
 
 using namespace std;
 complex<double> _j (0.0 , 1.0);
-lpspy::lpspy(){
+bool lpspy::threads_ready = false;
+// The FFTW planner is not thread safe, planning, wisdom and destroying
+// plans are serialized over all instances; executing plans is safe.
+mutex lpengine::planner;
+lpengine::~lpengine(){
+    lock_guard<mutex> guard(planner);
+    for (map<vector<int>, fftw_plan>::iterator it = plans.begin(); it != plans.end(); ++it)
+        fftw_destroy_plan(it->second);
+    for (map<vector<int>, lpfftw<float>::plan>::iterator it = plansf.begin(); it != plansf.end(); ++it)
+        lpfftw<float>::destroy(it->second);
+}
+map<vector<int>, fftw_plan> &lpfftw<double>::plans(lpengine &engine){ return engine.plans; }
+map<vector<int>, lpfftw<float>::plan> &lpfftw<float>::plans(lpengine &engine){ return engine.plansf; }
+/***********************************************************************
+*  lpspy: the constructor only sets the grid, it takes no lock and makes
+*  no engine, so that the Python module can make a copy of its instance
+*  per command cheaply, with the GIL held. newEngine gives an instance
+*  its own FFT plans and cache; the copies share the engine of the
+*  instance they are copied from.
+***********************************************************************/
+lpspy::lpspy() {
     N = 100;
     lambda = 500e-9;
     size = 30e-3;
     doub1 = 0.0;
     int1 =  0;
+    planflags = FFTW_ESTIMATE;
+    nthreads = 1;
+    fresnlaccuracy = FRESNL_EXACT;
 }
-lpspy::~lpspy(){
+void lpspy::newEngine(){
+    engine = make_shared<lpengine>();
+    lock_guard<mutex> guard(lpengine::planner);
+    if (!threads_ready)
+        threads_ready = lpfftw<double>::init_threads() != 0 && lpfftw<float>::init_threads() != 0;
 }
-
-CMPLXVEC lpspy::Axicon(double phi, double n1, double x_shift, double y_shift, CMPLXVEC Field ){
-    double pi2, K, dx, x, x2, y, theta, Ktheta;
-    int n2;
-    pi2=Pi*2.;
-    K=pi2/lambda;
-    n2=(int) N/2;
-    dx=size/N;
-    theta=asin(n1*cos(phi/2)+phi/2-Pi/2);
-    Ktheta=K*theta;
-    for ( int i=0; i<N; i++)
+/***********************************************************************
+*  plan: returns an in-place 2-D FFTW plan for an n0 x n1 array with the
+*  same alignment as data, to be run with lpfftw<T>::execute(p, data).
+*  With n0 = 1 it is a 1-D transform of length n1. With howmany > 1 the
+*  plan transforms howmany consecutive n0 x n1 arrays at once. T = double
+*  gives an fftw_plan, T = float an fftwf_plan.
+*  Plans are made once, on a scratch array so that FFTW_MEASURE cannot
+*  overwrite the field, and are kept in the engine until the instance and
+*  its copies are deleted.
+*  Arrays smaller than 256 x 256 are transformed with one thread, for
+*  those the threads cost more than they gain.
+*  Throws bad_alloc if there is no memory for the scratch array and
+*  runtime_error if FFTW cannot make the plan, the Python module raises
+*  them as MemoryError and RuntimeError.
+***********************************************************************/
+template <class T> typename lpfftw<T>::plan lpspy::plan(int n0, int n1, int sign, complex<T> *data, int howmany){
+    typedef typename lpfftw<T>::plan plan_t;
+    int nt = ((long)n0*n1*howmany < 65536 || !threads_ready) ? 1 : nthreads;
+    lock_guard<mutex> guard(lpengine::planner);
+    map<vector<int>, plan_t> &plans = lpfftw<T>::plans(*engine);
+    vector<int> key(7);
+    key[0] = n0;
+    key[1] = n1;
+    key[2] = sign;
+    key[3] = lpfftw<T>::alignment(data);
+    key[4] = (int) planflags;
+    key[5] = nt;
+    key[6] = howmany;
+    typename map<vector<int>, plan_t>::iterator it = plans.find(key);
+    if (it != plans.end()) return it->second;
+    lpbuffer<complex<T> > scratch((size_t)n0*n1*howmany + 2);
+    if (scratch.data() == NULL) throw bad_alloc();
+    complex<T> *tmp = (complex<T> *)((char *) scratch.data() + key[3]);
+    plan_t p = lpfftw<T>::make(n0, n1, howmany, tmp, sign, planflags, threads_ready ? nt : 0);
+    if (p == NULL) throw runtime_error("FFTW cannot make a plan for this grid");
+    plans[key] = p;
+    return p;
+}
+/***********************************************************************
+*  prePlan: makes the plans for an NN x NN grid in advance, for Forvard
+*  and PipFFT (NN x NN) and for Fresnel (2NN x 2NN), for fields of
+*  complex<double> and of complex<float>.
+***********************************************************************/
+template <class T> void lpspy::prePlan(int NN){
+    lpbuffer<complex<T> > dummy(1);
+    plan(NN, NN, FFTW_FORWARD, dummy.data());
+    plan(NN, NN, FFTW_BACKWARD, dummy.data());
+    plan(2*NN, 2*NN, FFTW_FORWARD, dummy.data());
+    plan(2*NN, 2*NN, FFTW_BACKWARD, dummy.data());
+}
+void lpspy::prePlan(int NN){
+    prePlan<double>(NN);
+    prePlan<float>(NN);
+}
+/***********************************************************************
+*  FFTW wisdom is shared by all instances. The file holds the double
+*  precision wisdom followed by the single precision wisdom, so a file
+*  written by fftw_export_wisdom_to_filename, with the double one only,
+*  can be read too. Both return 1 on success.
+***********************************************************************/
+int lpspy::importWisdom(const char *filename){
+    FILE *file = fopen(filename, "rb");
+    if (file == NULL) return 0;
+    string text;
+    char buf[4096];
+    size_t n;
+    while ((n = fread(buf, 1, sizeof(buf), file)) > 0) text.append(buf, n);
+    fclose(file);
+    size_t f = text.find("fftwf_wisdom");
+    f = f == string::npos ? text.size() : text.rfind('(', f);
+    if (f == string::npos) return 0;
+    lock_guard<mutex> guard(lpengine::planner);
+    int ok = lpfftw<double>::import_wisdom(text.substr(0, f).c_str());
+    if (f < text.size()) ok = lpfftw<float>::import_wisdom(text.c_str() + f) && ok;
+    return ok;
+}
+int lpspy::exportWisdom(const char *filename){
+    string text;
     {
-        x=(i-n2)*dx-x_shift;
-        x2=x*x;
-        for ( int j=0;j<N; j++)
-        {
-            double fi;
-            y=(j-n2)*dx-y_shift;
-            fi=-Ktheta*sqrt(x2+y*y);
-            Field.at(i).at(j) = Field.at(i).at(j) * exp(_j * fi);
+        lock_guard<mutex> guard(lpengine::planner);
+        char *wisdom = lpfftw<double>::export_wisdom();
+        if (wisdom == NULL) return 0;
+        text = wisdom;
+        free(wisdom);
+        wisdom = lpfftw<float>::export_wisdom();
+        if (wisdom != NULL) text += wisdom;
+        free(wisdom);
+    }
+    FILE *file = fopen(filename, "wb");
+    if (file == NULL) return 0;
+    int ok = fwrite(text.data(), 1, text.size(), file) == text.size();
+    return fclose(file) == 0 && ok;
+}
+/***********************************************************************
+*  The transfer functions and kernels of the propagators are cached, see
+*  lpcache.h. These set and return the memory the cache may use.
+***********************************************************************/
+void lpspy::setCacheSize(double nbytes){
+    engine->cache.resize((size_t) nbytes);
+}
+double lpspy::getCacheSize(){
+    return (double) engine->cache.capacity();
+}
+void lpspy::clearCache(){
+    engine->cache.clear();
+}
+/***********************************************************************
+*  grid: the coordinates of the grid around (x_shift, y_shift), see
+*  lpgrid in lpspy.h, shared by the commands that need them. Cached on
+*  (N, size, x_shift, y_shift, polar). The polar arrays are left out if
+*  they would not fit in the cache, a temporary of 16 bytes per pixel
+*  would only cost memory.
+***********************************************************************/
+shared_ptr<lpgrid> lpspy::grid(double x_shift, double y_shift, bool polar){
+    if (polar && 2*(size_t)N*N*sizeof(double) > engine->cache.capacity()) polar = false;
+    vector<double> key(6);
+    key[0] = GRID;
+    key[1] = N;
+    key[2] = size;
+    key[3] = x_shift;
+    key[4] = y_shift;
+    key[5] = polar;
+    shared_ptr<lpgrid> g = engine->cache.find<lpgrid>(key);
+    if (g) return g;
+    g = make_shared<lpgrid>();
+    int n2 = N/2;
+    double dx = size/N;
+    g->x.resize(N);
+    g->y.resize(N);
+    for (int i = 0; i < N; i++){
+        g->x[i] = (i-n2)*dx-x_shift;
+        g->y[i] = (i-n2)*dx-y_shift;
+    }
+    if (polar){
+        g->r.resize((size_t)N*N);
+        g->phi.resize((size_t)N*N);
+        for (int i = 0; i < N; i++){
+            double x = g->x[i];
+            for (int j = 0; j < N; j++){
+                double y = g->y[j];
+                g->r[(size_t)i*N+j] = sqrt(x*x+y*y);
+                g->phi[(size_t)i*N+j] = phase(y,x);
+            }
         }
     }
-    return Field;
+    engine->cache.insert(key, g, (2*N + g->r.size() + g->phi.size())*sizeof(double));
+    return g;
 }
-CMPLXVEC lpspy::BeamMix(CMPLXVEC Field1, CMPLXVEC Field ){
-    for ( int  i=0; i<N; i++)
-    {
-        for ( int  j=0;j<N; j++)
-        {
-            Field.at(i).at(j) +=  Field1.at(i).at(j);
+/***********************************************************************
+*  rasterRow: the pixels j0 <= j < j1 of a row with inside(j), for a
+*  convex shape that covers ylo <= y[j] <= yhi. The interval from
+*  ylo, yhi is only a first guess, its ends are moved until inside(j)
+*  agrees, so the pixels are exactly those of the per pixel test.
+***********************************************************************/
+template <class F> static void rasterRow(const vector<double> &y, double dx, double ylo, double yhi, F inside, int &j0, int &j1){
+    int N = y.size();
+    double lo = max(-1., min((double)N, ceil((ylo - y[0])/dx) - 1));
+    double hi = max(-1., min((double)N, floor((yhi - y[0])/dx) + 1));
+    j0 = max(0, (int)lo);
+    j1 = min(N - 1, (int)hi);
+    while (j0 <= j1 && !inside(j0)) j0++;
+    if (j0 > j1){
+        j0 = j1 = 0;
+        return;
+    }
+    while (j0 > 0 && inside(j0 - 1)) j0--;
+    while (!inside(j1)) j1--;
+    while (j1 < N - 1 && inside(j1 + 1)) j1++;
+    j1++;
+}
+/***********************************************************************
+*  circMask, rectMask: the pixels inside the circle of CircAperture and
+*  CircScreen and inside the rectangle of RectAperture and RectScreen,
+*  with the same test per pixel as before. Cached on (N, size, and the
+*  arguments of the command).
+***********************************************************************/
+shared_ptr<lpmask> lpspy::circMask(double R, double x_shift, double y_shift){
+    vector<double> key(6);
+    key[0] = CIRC_MASK;
+    key[1] = N;
+    key[2] = size;
+    key[3] = R;
+    key[4] = x_shift;
+    key[5] = y_shift;
+    shared_ptr<lpmask> mask = engine->cache.find<lpmask>(key);
+    if (mask) return mask;
+    mask = make_shared<lpmask>();
+    mask->j0.resize(N);
+    mask->j1.resize(N);
+    shared_ptr<lpgrid> g = grid(x_shift, y_shift);
+    const vector<double> &y = g->y;
+    double RR = R*R, dx = size/N;
+    for (int i = 0; i < N; i++){
+        double x = g->x[i], half;
+        if (x*x > RR){
+            mask->j0[i] = mask->j1[i] = 0;
+            continue;
         }
+        half = sqrt(RR - x*x);
+        rasterRow(y, dx, -half, half, [&](int j){ return (x*x + y[j]*y[j]) <= RR; },
+                  mask->j0[i], mask->j1[i]);
     }
-    return Field;
+    engine->cache.insert(key, mask, 2*N*sizeof(int));
+    return mask;
 }
-CMPLXVEC lpspy::Begin(double Size, double Lambda, int NN){
-    CMPLXVEC Field;
-    Field.resize(NN, vector<complex<double> >(NN,1.0));
-    N=NN;
-    size = Size;
-    lambda = Lambda;
-    int1 = 0;
-    doub1 = 0.0;
-    return Field;
+// the interval of y with |a*y + b| <= h
+static void slab(double a, double b, double h, double &ylo, double &yhi){
+    if (a == 0.){
+        ylo = fabs(b) <= h ? -HUGE_VAL : HUGE_VAL;
+        yhi = -ylo;
+        return;
+    }
+    ylo = min((-h - b)/a, (h - b)/a);
+    yhi = max((-h - b)/a, (h - b)/a);
 }
-CMPLXVEC lpspy::CircAperture(double R, double x_shift, double y_shift, CMPLXVEC Field ){
-    double RR, dx, x, y;
-    int i2;
-    RR=R*R;
-    dx = size/N;
-    i2 = (int ) N/2+1;
-    for ( int  i=0; i<N; i++)
-    {
-        for ( int  j=0;j<N; j++)
-        {
-            x=(i - i2 + 1) * dx - x_shift;
-            y=(j - i2 + 1) * dx - y_shift;
-            if((x*x + y*y) > RR)
-            {
-                Field.at(i).at(j) = 0.0;
-            
+shared_ptr<lpmask> lpspy::rectMask(double sx, double sy, double x_shift, double y_shift, double angle){
+    vector<double> key(8);
+    key[0] = RECT_MASK;
+    key[1] = N;
+    key[2] = size;
+    key[3] = sx;
+    key[4] = sy;
+    key[5] = x_shift;
+    key[6] = y_shift;
+    key[7] = angle;
+    shared_ptr<lpmask> mask = engine->cache.find<lpmask>(key);
+    if (mask) return mask;
+    mask = make_shared<lpmask>();
+    mask->j0.resize(N);
+    mask->j1.resize(N);
+    shared_ptr<lpgrid> g = grid(x_shift, y_shift);
+    const vector<double> &y = g->y;
+    double dx = size/N, cc, ss, ylo1, yhi1, ylo2, yhi2;
+    angle *= -Pi/180.;
+    cc=cos(angle);
+    ss=sin(angle);
+    for (int i = 0; i < N; i++){
+        double x0 = g->x[i];
+        if (angle == 0.0){
+            if (fabs(x0) > sx/2.){
+                mask->j0[i] = mask->j1[i] = 0;
+                continue;
             }
+            rasterRow(y, dx, -sy/2., sy/2., [&](int j){ return fabs(y[j]) <= sy/2.; },
+                      mask->j0[i], mask->j1[i]);
+        }
+        else {
+            slab(ss, x0*cc, sx/2., ylo1, yhi1);
+            slab(cc, -x0*ss, sy/2., ylo2, yhi2);
+            rasterRow(y, dx, max(ylo1, ylo2), min(yhi1, yhi2), [&](int j){
+                    double x = x0*cc+y[j]*ss, yy = -x0*ss+y[j]*cc;
+                    return fabs(x) <= sx/2. && fabs(yy) <= sy/2.; },
+                      mask->j0[i], mask->j1[i]);
         }
     }
-    return Field;
+    engine->cache.insert(key, mask, 2*N*sizeof(int));
+    return mask;
 }
-CMPLXVEC lpspy::CircScreen(double R, double x_shift, double y_shift, CMPLXVEC Field ){
-    double RR, dx, x, y;
-    int i2;
-    RR=R*R;
-    dx = size/N;
-    i2 = (int ) N/2+1;
-    for ( int  i=0; i<N; i++)
-    {
-        for ( int  j=0;j<N; j++)
-        {
-            x=(i - i2 + 1) * dx - x_shift;
-            y=(j - i2 + 1) * dx - y_shift;
-            if((x*x + y*y) <= RR)
-            {
-                Field.at(i).at(j) = 0.0;
-            }
+/***********************************************************************
+*  applyElement: applies the element e to all rows of the field.
+***********************************************************************/
+template <class T> void lpspy::applyElement(lpelement<T> &e, complex<T> *Field){
+    for (int i=0;i<N; i++) e.apply(i, Field + (size_t)i*N);
+}
+/***********************************************************************
+*  screen: the element that multiplies the field by exp(i*phase(i,j)),
+*  the transmission of a phase element. The transmission is cached on
+*  key, which holds the kind of element, the grid and the arguments, so
+*  a repeated call is a single complex multiplication per pixel. A
+*  transmission that does not fit in the cache is computed row by row
+*  while it is applied, without storing it.
+***********************************************************************/
+template <class T, class P> shared_ptr<lpelement<T> > lpspy::screen(const vector<double> &key, P phase){
+    int n = N;
+    size_t NN = (size_t)N*N;
+    if (NN*sizeof(complex<double>) > engine->cache.capacity())
+        return rowelement<T>([=](int i, complex<T> *row) mutable {
+                for (int j=0;j<n; j++) row[j] *= exp(_j * phase(i, j)); });
+    shared_ptr<vector<complex<double> > > s = engine->cache.find<vector<complex<double> > >(key);
+    if (!s){
+        s = make_shared<vector<complex<double> > >(NN);
+        for (int i=0;i<N; i++)
+            for (int j=0;j<N; j++) (*s)[i*N+j] = exp(_j * phase(i, j));
+        engine->cache.insert(key, s, NN*sizeof(complex<double>));
+    }
+    return rowelement<T>([=](int i, complex<T> *row){
+            const complex<double> *t = &(*s)[(size_t)i*n];
+            for (int j=0;j<n; j++) row[j] *= t[j]; });
+}
+/***********************************************************************
+*  separableScreen: the same for a phase phasex(i) + phasey(j), only the
+*  2N factors exp(i*phasex(i)) and exp(i*phasey(j)) are cached.
+***********************************************************************/
+template <class T, class Px, class Py> shared_ptr<lpelement<T> > lpspy::separableScreen(const vector<double> &key, Px phasex, Py phasey){
+    int n = N;
+    shared_ptr<vector<complex<double> > > s = engine->cache.find<vector<complex<double> > >(key);
+    if (!s){
+        s = make_shared<vector<complex<double> > >(2*N);
+        for (int i=0;i<N; i++){
+            (*s)[i] = exp(_j * phasex(i));
+            (*s)[N+i] = exp(_j * phasey(i));
         }
+        engine->cache.insert(key, s, 2*N*sizeof(complex<double>));
     }
-    return Field;
+    return rowelement<T>([=](int i, complex<T> *row){
+            const complex<double> tx = (*s)[i], *ty = &(*s)[n];
+            for (int j=0;j<n; j++) row[j] *= tx*ty[j]; });
+}
+/***********************************************************************
+*  element: the element of op, see Fuse. The apertures and screens zero
+*  the pixels outside or inside their cached mask, only the pixels that
+*  change are written.
+***********************************************************************/
+template <class T> shared_ptr<lpelement<T> > lpspy::element(const lpop &op){
+    const double *p = op.p;
+    double K;
+    int n = N;
+    switch (op.kind){
+        case FUSE_CIRC_APERTURE: case FUSE_CIRC_SCREEN:
+        case FUSE_RECT_APERTURE: case FUSE_RECT_SCREEN: {
+            bool screen = op.kind == FUSE_CIRC_SCREEN || op.kind == FUSE_RECT_SCREEN;
+            shared_ptr<lpmask> mask;
+            if (op.kind == FUSE_CIRC_APERTURE || op.kind == FUSE_CIRC_SCREEN)
+                mask = circMask(p[0], p[1], p[2]);
+            else
+                mask = rectMask(p[0], p[1], p[2], p[3], p[4]);
+            return rowelement<T>([=](int i, complex<T> *row){
+                    int j0 = mask->j0[i], j1 = mask->j1[i];
+                    if (screen) fill(row + j0, row + j1, complex<T>(0));
+                    else {
+                        fill(row, row + j0, complex<T>(0));
+                        fill(row + j1, row + n, complex<T>(0));
+                    } });
+        }
+        case FUSE_GAIN: {
+            double Isat = p[0], gain = p[1], L = p[2];
+            return rowelement<T>([=](int i, complex<T> *row){
+                    double Io, Ii, ampl;
+                    for (int j=0;j<n; j++){
+                        Ii = norm(row[j]);
+                        if (Isat == 0.0) Io = Ii;
+                        else Io =  Ii*exp(gain*L/(1 + 2.0 * Ii/Isat));
+                        if (Ii == 0.0) ampl = 0.0;
+                        else ampl = sqrt(Io/Ii);
+                        row[j] *= ampl;
+                    } });
+        }
+        case FUSE_GAUSS_APERTURE: {
+            double w2 = p[0]*p[0]*2, SqrtR = sqrt(p[3]);
+            shared_ptr<lpgrid> g = grid(p[1], p[2]);
+            return rowelement<T>([=](int i, complex<T> *row){
+                    double x2 = g->x[i]*g->x[i];
+                    for (int j=0;j<n; j++)
+                        row[j] *= SqrtR*exp(-(x2+g->y[j]*g->y[j])/w2); });
+        }
+        case FUSE_GAUSS_SCREEN: {
+            double w2 = p[0]*p[0], T0 = p[3];
+            shared_ptr<lpgrid> g = grid(p[1], p[2]);
+            return rowelement<T>([=](int i, complex<T> *row){
+                    double x2 = g->x[i]*g->x[i];
+                    for (int j=0;j<n; j++)
+                        row[j] *= sqrt(1-(1-T0)*exp(-(x2+g->y[j]*g->y[j])/w2)); });
+        }
+        case FUSE_INT_ATTENUATOR: {
+            double r = sqrt(p[0]);
+            return rowelement<T>([=](int i, complex<T> *row){
+                    for (int j=0;j<n; j++) row[j] *= r; });
+        }
+        case FUSE_AXICON: {
+            double phi = p[0], n1 = p[1], x_shift = p[2], y_shift = p[3];
+            double pi2, theta, Ktheta;
+            pi2=Pi*2.;
+            K=pi2/lambda;
+            theta=asin(n1*cos(phi/2)+phi/2-Pi/2);
+            Ktheta=K*theta;
+            vector<double> key(8);
+            key[0] = AXICON_SCREEN;
+            key[1] = N;
+            key[2] = size;
+            key[3] = lambda;
+            key[4] = phi;
+            key[5] = n1;
+            key[6] = x_shift;
+            key[7] = y_shift;
+            // the grid is only needed to make the transmission:
+            shared_ptr<lpgrid> g;
+            return screen<T>(key, [=](int i, int j) mutable {
+                    if (!g) g = grid(x_shift, y_shift, true);
+                    return -Ktheta*g->radius(i, j); });
+        }
+        case FUSE_LENS: {
+            double f = p[0], x_shift = p[1], y_shift = p[2];
+            double pi2;
+            if (doub1 != 0.) printf("error in Lens: Spherical coordinates! Use Convert first\n");
+            pi2=3.1415926*2.;
+            K=pi2/lambda;
+            vector<double> key(7);
+            key[0] = LENS_SCREEN;
+            key[1] = N;
+            key[2] = size;
+            key[3] = lambda;
+            key[4] = f;
+            key[5] = x_shift;
+            key[6] = y_shift;
+            shared_ptr<lpgrid> g = grid(x_shift, y_shift);
+            const double *x = &g->x[0], *y = &g->y[0];
+            return separableScreen<T>(key, [&](int i){ return -K*(x[i]*x[i])/(2.*f); },
+                                           [&](int j){ return -K*(y[j]*y[j])/(2.*f); });
+        }
+        case FUSE_TILT: {
+            double tx = p[0], ty = p[1];
+            K=2*Pi/lambda;
+            vector<double> key(6);
+            key[0] = TILT_SCREEN;
+            key[1] = N;
+            key[2] = size;
+            key[3] = lambda;
+            key[4] = tx;
+            key[5] = ty;
+            shared_ptr<lpgrid> g = grid(0., 0.);
+            const double *x = &g->x[0], *y = &g->y[0];
+            return separableScreen<T>(key, [&](int i){ return -(tx*x[i])*K; },
+                                           [&](int j){ return -(ty*y[j])*K; });
+        }
+        case FUSE_ZERNIKE: {
+            int n = (int)p[0], m = (int)p[1];
+            double R = p[2], A = p[3], Nnm;
+            K=2*Pi/lambda;
+            if (m == 0) Nnm=sqrt((double)n+1);
+            else Nnm=sqrt(2.0*(n+1));
+            vector<double> key(8);
+            key[0] = ZERNIKE_SCREEN;
+            key[1] = N;
+            key[2] = size;
+            key[3] = lambda;
+            key[4] = n;
+            key[5] = m;
+            key[6] = R;
+            key[7] = A;
+            shared_ptr<lpgrid> g;
+            return screen<T>(key, [=](int i, int j) mutable {
+                    if (!g) g = grid(0., 0., true);
+                    return -A*K*Nnm*zernike(n,m,g->radius(i, j)/R,g->angle(i, j) + Pi); });
+        }
+    }
+    // the kinds are checked by Fuse in _LightPipes.pyx, an unknown kind does nothing:
+    return rowelement<T>([](int i, complex<T> *row){});
+}
+template <class T> void lpspy::Axicon(double phi, double n1, double x_shift, double y_shift, complex<T> *Field ){
+    lpop op = {FUSE_AXICON, {phi, n1, x_shift, y_shift}};
+    Fuse(1, &op, Field);
+    return;
+}
+template <class T> void lpspy::BeamMix(complex<T> *Field1, complex<T> *Field ){
+    size_t NN = (size_t)N*N;
+    for ( size_t ik=0; ik<NN; ik++)
+    {
+        Field[ik] +=  Field1[ik];
     }
-    CMPLXVEC lpspy::Convert( CMPLXVEC Field ){
+    return;
+}
+template <class T> void lpspy::Begin(double Size, double Lambda, int NN, complex<T> *Field ){
+    fill(Field, Field + (size_t)NN*NN, 1.0);
+    N=NN;
+    size = Size;
+    lambda = Lambda;
+    int1 = 0;
+    doub1 = 0.0;
+    return;
+}
+template <class T> void lpspy::CircAperture(double R, double x_shift, double y_shift, complex<T> *Field ){
+    lpop op = {FUSE_CIRC_APERTURE, {R, x_shift, y_shift}};
+    Fuse(1, &op, Field);
+    return;
+}
+template <class T> void lpspy::CircScreen(double R, double x_shift, double y_shift, complex<T> *Field ){
+    lpop op = {FUSE_CIRC_SCREEN, {R, x_shift, y_shift}};
+    Fuse(1, &op, Field);
+    return;
+    }
+    template <class T> void lpspy::Convert( complex<T> *Field ){
     double x,x2,y,dx,pi2,K,f;
     int n2;
-    if (doub1 == 0.) return Field;
+    if (doub1 == 0.) return;
     f = -1./doub1;
     pi2=3.1415926*2.;
     K=pi2/lambda;
@@ -130,462 +552,390 @@ CMPLXVEC lpspy::CircScreen(double R, double x_shift, double y_shift, CMPLXVEC Fi
             double fi;
             y=(j-n2)*dx;
             fi=K*(x2+y*y)/(2.*f);
-            Field.at(i).at(j) *= exp(_j * fi);
+            Field[i*N+j] *= exp(_j * fi);
         }
     }
     doub1 = 0.0;
-    return Field;
-    }
-    CMPLXVEC lpspy::Forward(double z, double new_size, int new_n, CMPLXVEC Field ){
-    CMPLXVEC FieldNew;
-    FieldNew.resize(new_n, vector<complex<double> >(new_n,1.0));
-    int i_old, i_new, j_old, j_new;
-    int old_n,  on21, nn21;
-    double old_size;
-    double  x_new, y_new, dx_new, dx_old;
-    double  P1, P2, P3, P4, R22, dum; 
-    double fc1, fs1, fc2, fs2, fc3, fs3, fc4, fs4, fr, fi;
-    double c4c1, c2c3, c4s1, s4c1, s2c3, c2s1, s4c3, s2c1, c4s3, s2s3, s2s1, c2s3, s4s1, c4c3, s4s3, c2c1;
+    return;
+    }
+/***********************************************************************
+*  ForwardMatrix: the integral of Forward is separable. With the complex
+*  Fresnel integral E = C+iS and the 1-D matrix
+*      M(i_new, i_old) = E(P1) - E(P3),
+*  P1,3 = R22*(2*(dx_old*io-x_new) +/- dx_old), the result is
+*      Fout = -0.5i * M Fin M^T,
+*  the same M serves both axes. Only the columns of the old pixels
+*  i0 <= i_old < i1 are computed, M is a new_n x (i1-i0) array.
+*  Forward in the Python module does the products with BLAS, on the
+*  bounding box of the nonzero pixels.
+***********************************************************************/
+void lpspy::ForwardMatrix(double z, double new_size, int new_n, int i0, int i1, complex<double> *M ){
+    int old_n, on21, nn21, nc;
+    double x_new, dx_new, dx_old, R22;
 
-    old_size = size;
     old_n    = N;
-
     on21     = (int)old_n/2 + 1;
     nn21     = (int)new_n/2 + 1;
     dx_new   = new_size/(new_n-1);
-    dx_old   = old_size/(old_n-1);
-
-    R22=sqrt(1./(2.*lambda*z));          
-    fs1=fc1=fs2=fc2=fs3=fc3=fs4=fc4=0.; /* to make the compiler happy */    
+    dx_old   = size/(old_n-1);
+    R22=sqrt(1./(2.*lambda*z));
+    nc = i1 - i0;
+    // P3 of pixel i_old is P1 of pixel i_old-1, so a row of M needs the
+    // Fresnel integrals of nc+1 points:
+    vector<double> P(nc+1), fs(nc+1), fc(nc+1);
 
-    for (i_new = 0; i_new < new_n; i_new++){
-        x_new = (i_new - nn21 + 1) * dx_new; 
-        for (j_new = 0; j_new < new_n; j_new++){
-            y_new = (j_new - nn21 + 1) * dx_new; 
-            FieldNew.at(i_new).at(j_new) = complex<double>(0.,0.);
-            for (i_old = 0; i_old < old_n; i_old++){
-                int io=i_old-on21+1; /* bug repaired: +1 added to formula */
-                for (j_old = 0; j_old < old_n; j_old++){
-                    int jo=j_old-on21+1; /* bug repaired: +1 added to formula */   
-                    P1=R22*(2*(dx_old*io-x_new)+dx_old);
-                    P2=R22*(2*(dx_old*jo-y_new)-dx_old);
-                    P3=R22*(2*(dx_old*io-x_new)-dx_old);
-                    P4=R22*(2*(dx_old*jo-y_new)+dx_old);
-                    dum=fresnl(P1,&fs1, &fc1);
-                    dum=fresnl(P2,&fs2, &fc2);
-                    dum=fresnl(P3,&fs3, &fc3);
-                    dum=fresnl(P4,&fs4, &fc4);
-                    fr=0.5*real(Field.at(i_old).at(j_old));
-                    fi=0.5*imag(Field.at(i_old).at(j_old));
-                    c4c1=fc4*fc1;
-                    c2s3=fc2*fs3;
-                    c4s1=fc4*fs1;
-                    s4c1=fs4*fc1;
-                    s2c3=fs2*fc3;
-                    c2s1=fc2*fs1;
-                    s4c3=fs4*fc3;
-                    s2c1=fs2*fc1;
-                    c4s3=fc4*fs3;
-                    s2s3=fs2*fs3;
-                    s2s1=fs2*fs1;
-                    c2c3=fc2*fc3;
-                    s4s1=fs4*fs1;
-                    c4c3=fc4*fc3;
-                    c4c1=fc4*fc1;
-                    s4s3=fs4*fs3;
-                    c2c1=fc2*fc1;
-//                    FieldNew.at(i_new).at(j_new) = complex<double>(
-//														real(FieldNew.at(i_new).at(j_new)) +  
-//                                                        fr*( c2s3+c4s1+s4c1+s2c3-c2s1-s4c3-s2c1-c4s3) +
-//                                                        fi*(-s2s3+s2s1+c2c3-s4s1-c4c3+c4c1+s4s3-c2c1),
-//                                                        imag(FieldNew.at(i_new).at(j_new)) + 
-//                                                        fr*(-c4c1+s2s3+c4c3-s4s3+c2c1-s2s1+s4s1-c2c3) +
-//                                                        fi*( c2s3+s2c3+c4s1+s4c1-c4s3-s4c3-c2s1-s2c1)
-//                                                        );
-                    
-                    FieldNew.at(i_new).at(j_new) += complex<double>(
-                                                        fr*( c2s3+c4s1+s4c1+s2c3-c2s1-s4c3-s2c1-c4s3) +
-                                                        fi*(-s2s3+s2s1+c2c3-s4s1-c4c3+c4c1+s4s3-c2c1), 
-                                                        fr*(-c4c1+s2s3+c4c3-s4s3+c2c1-s2s1+s4s1-c2c3) +
-                                                        fi*( c2s3+s2c3+c4s1+s4c1-c4s3-s4c3-c2s1-s2c1)
-                                                        );                                                        
-                    
-                    
-//                    FieldNew.at(i_new).at(j_new).real(
-//                                                        real(FieldNew.at(i_new).at(j_new)) + 
-//                                                        fr*( c2s3+c4s1+s4c1+s2c3-c2s1-s4c3-s2c1-c4s3)
-//                                                     );
-//                                                     
-//                    FieldNew.at(i_new).at(j_new).real(
-//                                                        real(FieldNew.at(i_new).at(j_new)) + 
-//                                                        fi*(-s2s3+s2s1+c2c3-s4s1-c4c3+c4c1+s4s3-c2c1)
-//                                                     );
-//                                                     
-//                    FieldNew.at(i_new).at(j_new).imag(
-//                                                        imag(FieldNew.at(i_new).at(j_new)) + 
-//                                                        fr*(-c4c1+s2s3+c4c3-s4s3+c2c1-s2s1+s4s1-c2c3)
-//                                                     );
-//                                                     
-//                    FieldNew.at(i_new).at(j_new).imag(
-//                                                        imag(FieldNew.at(i_new).at(j_new)) + 
-//                                                        fi*( c2s3+s2c3+c4s1+s4c1-c4s3-s4c3-c2s1-s2c1)
-//                                                     ); 
-                }
-            }
+    for (int i_new = 0; i_new < new_n; i_new++){
+        x_new = (i_new - nn21 + 1) * dx_new;
+        complex<double> *row = M + (size_t)i_new*nc;
+        int io = i0 - on21 + 1; /* bug repaired: +1 added to formula */
+        P[0] = R22*(2*(dx_old*io-x_new)-dx_old);
+        for (int i_old = i0; i_old < i1; i_old++){
+            io = i_old - on21 + 1;
+            P[i_old - i0 + 1] = R22*(2*(dx_old*io-x_new)+dx_old);
         }
+        fresnl_batch(&P[0], nc+1, &fs[0], &fc[0], fresnlaccuracy);
+        for (int k = 0; k < nc; k++)
+            row[k] = complex<double>(fc[k+1] - fc[k], fs[k+1] - fs[k]);
     }
-    size=new_size;
-    N=new_n;
-    return FieldNew;
-    }
-    CMPLXVEC lpspy::Forvard(double zz, CMPLXVEC Field ){
-    fftw_complex* in_out = (fftw_complex*) fftw_malloc(sizeof(fftw_complex) * N * N);
-    if (in_out == NULL) return Field;
-    int ii, ij, n12;
-    long ik, ir;
-    double z,z1,cc;
-    double sw, sw1, bus, abus, pi2, cab, sab, kz, cokz, sikz;
-
+    return;
+}
+/***********************************************************************
+*  forvardFilter: the transfer function of Forvard is separable,
+*  H(u,v) = h(u)*h(v), so only the N values of h are computed, with the
+*  factor exp(i*k*z)/N^2 split over h(u) and h(v). For even N h is stored
+*  in FFT order, which does the same as the +1,-1 checkerboards that
+*  center the spectrum. For odd N it is centered and Forvard applies the
+*  checkerboards. The filters are cached on (N, size, lambda, z).
+***********************************************************************/
+shared_ptr<vector<complex<double> > > lpspy::forvardFilter(double zz){
+    vector<double> key(5);
+    key[0] = FORVARD_FILTER;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = zz;
+    shared_ptr<vector<complex<double> > > h = engine->cache.find<vector<complex<double> > >(key);
+    if (h) return h;
+    h = make_shared<vector<complex<double> > >(N);
+    int n12, u;
+    long ir;
+    double z, z1, sw, bus, abus, pi2, kz;
+    complex<double> scale;
     pi2=2.*3.141592654;
     z=fabs(zz);
     kz = pi2/lambda*z;
-    cokz = cos(kz);
-    sikz = sin(kz);
-    ik=0;
-    ii=ij=1;
+    z1=z*lambda/2.;
+    n12=int(N/2);
+    scale = exp(_j * (kz/2.)) / (double)N;
+    // Spatial filter, (c)  Gleb Vdovin  1986:
     for (int i=0;i<N; i++){
+        if (N % 2 == 0) u = (i < n12) ? i : i - N;
+        else u = i - n12;
+        sw=(u/size);
+        sw *= sw;
+        bus=z1*sw;
+        ir = (long) bus;
+        abus=pi2*(ir- bus);
+        if (zz < 0.) abus = -abus;
+        (*h)[i] = scale * complex<double>(cos(abus), sin(abus));
+    }
+    engine->cache.insert(key, h, N*sizeof(complex<double>));
+    return h;
+}
+    template <class T> void lpspy::Forvard(double zz, complex<T> *Field, int K ){
+    bool odd = (N % 2 != 0);
+    size_t NN = (size_t)N*N;
+    typename lpfftw<T>::plan planF = plan(N, N, FFTW_FORWARD, Field, K);
+    typename lpfftw<T>::plan planB = plan(N, N, FFTW_BACKWARD, Field, K);
+    shared_ptr<vector<complex<double> > > filter = forvardFilter(zz);
+    const complex<double> *h = &(*filter)[0];
+    if (odd) for (int k=0; k<K; k++) checkerboard(Field + k*NN);
+    if (zz>=0.) lpfftw<T>::execute(planF, Field);
+    else lpfftw<T>::execute(planB, Field);
+    for (long i=0;i<(long)K*N; i++){
+        complex<T> *row = Field + (size_t)i*N;
+        complex<double> hi = h[i % N];
         for (int j=0;j<N; j++){
-            in_out[ik][0] = Field.at(i).at(j).real()*ii*ij;
-            in_out[ik][1] = Field.at(i).at(j).imag()*ii*ij; 
-            ik++;
-            ij=-ij;
-        }
-        ii=-ii;
-    }
-    fftw_plan planF = fftw_plan_dft_2d (N, N, in_out, in_out, FFTW_FORWARD, FFTW_ESTIMATE);
-    if (planF == NULL) return Field;
-    fftw_plan planB = fftw_plan_dft_2d (N, N, in_out, in_out, FFTW_BACKWARD, FFTW_ESTIMATE);
-    if (planB == NULL) return Field;  
-    // Spatial filter, (c)  Gleb Vdovin  1986:  
-    if (zz>=0.) fftw_execute(planF);
-    else fftw_execute(planB);
-    if(zz >= 0.){
-       z1=z*lambda/2.;
-       n12=int(N/2);
-       ik=0;
-       for (int i=0;i<N; i++){
-           for (int j=0;j<N; j++){ 
-               sw=((i-n12)/size);
-               sw *= sw;
-               sw1=((j-n12)/size);
-               sw1 *= sw1;
-               sw += sw1; 
-               bus=z1*sw;
-               ir = (long) bus;
-               abus=pi2*(ir- bus);
-               cab=cos(abus);
-               sab=sin(abus);
-               cc=in_out[ik][0]*cab-in_out[ik][1]*sab;
-               in_out[ik][1]=in_out[ik][0]*sab+in_out[ik][1]*cab;
-               in_out[ik][0]=cc;
-               ik++;
-           }
-       }
-    }
-    else { 
-      z1=z*lambda/2.;
-      n12=int(N/2);
-      ik=0;
-      for (int i=0;i<N; i++){
-        for (int j=0;j<N; j++){ 
-            sw=((i-n12)/size);
-            sw *= sw;
-            sw1=((j-n12)/size);
-            sw1 *= sw1;
-            sw += sw1; 
-            bus=z1*sw;
-            ir = (long) bus;
-            abus=pi2*(ir- bus);
-            cab=cos(abus);
-            sab=sin(abus);
-            cc=in_out[ik][0]*cab + in_out[ik][1]*sab;
-            in_out[ik][1]= in_out[ik][1]*cab-in_out[ik][0]*sab;
-            in_out[ik][0]=cc;
-            ik++;
+            row[j] *= hi * h[j];
         }
-      }
     }
-    if (zz>=0.) fftw_execute(planB);
-    else fftw_execute(planF);
-    ik=0;
-    ii=ij=1;
-    for (int i=0;i<N; i++){    
-        for (int j=0;j<N; j++ ){
-            Field.at(i).at(j) = complex<double>((in_out[ik][0]*ii*ij * cokz - in_out[ik][1]*ii*ij * sikz)/N/N,\
-                                               ( in_out[ik][1]*ii*ij * cokz + in_out[ik][0]*ii*ij * sikz)/N/N );
-            ij=-ij;
-            ik++;
+    if (zz>=0.) lpfftw<T>::execute(planB, Field);
+    else lpfftw<T>::execute(planF, Field);
+    if (odd) for (int k=0; k<K; k++) checkerboard(Field + k*NN);
+    return;
+    }
+/***********************************************************************
+*  ForvardScan: Forvard of Fin to the nz distances z[k]. The spectrum of
+*  Fin is computed once for all distances (twice if there are distances
+*  of both signs), each plane costs one filter pass and one inverse FFT.
+*  The fields go to the nz x N x N array Fout or, if Fout is NULL, their
+*  intensities, as by Intensity(0, ...), go to I. Fin is not changed.
+***********************************************************************/
+template <class T> void lpspy::ForvardScan(int nz, const double *z, complex<T> *Field, complex<T> *Fout, double *I){
+    bool odd = (N % 2 != 0), pos = false, neg = false;
+    size_t NN = (size_t)N*N;
+    for (int k=0; k<nz; k++){
+        if (z[k] >= 0.) pos = true;
+        else neg = true;
+    }
+    // spectra for z >= 0 (forward FFT) and for z < 0 (backward FFT):
+    lpbuffer<complex<T> > Sp(pos ? NN : 0), Sn(neg ? NN : 0), work(Fout ? 0 : NN);
+    if (Sp.data() == NULL || Sn.data() == NULL || work.data() == NULL) return;
+    for (int s=0; s<2; s++){
+        if (s == 0 ? !pos : !neg) continue;
+        complex<T> *S = s == 0 ? Sp.data() : Sn.data();
+        typename lpfftw<T>::plan p = plan(N, N, s == 0 ? FFTW_FORWARD : FFTW_BACKWARD, S);
+        copy(Field, Field + NN, S);
+        if (odd) checkerboard(S);
+        lpfftw<T>::execute(p, S);
+    }
+    for (int k=0; k<nz; k++){
+        const complex<T> *S = z[k] >= 0. ? Sp.data() : Sn.data();
+        complex<T> *F = Fout ? Fout + k*NN : work.data();
+        typename lpfftw<T>::plan p = plan(N, N, z[k] >= 0. ? FFTW_BACKWARD : FFTW_FORWARD, F);
+        shared_ptr<vector<complex<double> > > filter = forvardFilter(z[k]);
+        const complex<double> *h = &(*filter)[0];
+        for (int i=0;i<N; i++){
+            const complex<T> *srow = S + (size_t)i*N;
+            complex<T> *row = F + (size_t)i*N;
+            complex<double> hi = h[i];
+            for (int j=0;j<N; j++){
+                row[j] = srow[j];
+                row[j] *= hi * h[j];
+            }
         }
-        ii=-ii;
-    }
-    fftw_destroy_plan(planF);
-    fftw_destroy_plan(planB);
-    fftw_free(in_out);
-    fftw_cleanup();
-    return Field;
-    }
-CMPLXVEC lpspy::Fresnel(double z, CMPLXVEC Field ){
-    int i,j,fn2, fn22,io,jo,no2,ii,ij,iiij;
-    long ik, ik1, ik2, ik3, ik4;
-    double  RR, dx, pi2, kz, cokz, sikz, FR, FI;
-    double cc, fc1, fs1, fc2, fs2, fc3, fs3, fc4, fs4, R1, R2, R3, R4;
-    double c4c1, c2c3, c4s1, s4c1, s2c3, c2s1, s4c3, s2c1, c4s3, s2s3, s2s1, c2s3, s4s1, c4c3, s4s3, c2c1, sh;
-    pi2=2.*3.141592654;
-
-    dx=size/(N-1.);
-   
-    kz = pi2/lambda*z;
-    cokz = cos(kz);
-    sikz = sin(kz);
-
-/*  Allocating a LOT OF MEMORY */
+        lpfftw<T>::execute(p, F);
+        if (odd) checkerboard(F);
+        if (!Fout) Intensity(0, F, I + k*NN);
+    }
+    return;
+}
+/***********************************************************************
+*  checkerboard: multiplies the field with +1,-1, which moves the center
+*  of the grid to the corners of its spectrum.
+***********************************************************************/
+template <class T> void lpspy::checkerboard(complex<T> *Field){
+    for (int i=0;i<N; i++){
+        complex<T> *row = Field + (size_t)i*N;
+        int j = (i & 1) ? 0 : 1;
+        for (; j<N; j+=2) row[j] = -row[j];
+    }
+}
+/***********************************************************************
+*  fresnelKernel: the 2N x 2N convolution kernel of Fresnel is separable,
+*  K(i,j) = -0.5i*a(i)*a(j), with a(i) = E(R3)-E(R1) the difference of the
+*  complex Fresnel integral E = C+iS over pixel i. Its Fourier transform
+*  is -0.5i*w(k)*w(l), with w the 1-D FFT of a, so only N+1 Fresnel
+*  integrals and one FFT of length 2N are needed. The +1,-1 checkerboards
+*  Fresnel applies to the kernel and to the product with the field
+*  spectrum are included in w. It depends on (N, size, lambda, z) only
+*  and is cached.
+***********************************************************************/
+shared_ptr<vector<complex<double> > > lpspy::fresnelKernel(double z){
+    int i, fn2, fn22, io, no2, ii;
+    double  RR, dx;
+    vector<double> key(6);
+    key[0] = FRESNEL_KERNEL;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = z;
+    key[5] = fresnlaccuracy;
+    shared_ptr<vector<complex<double> > > w = engine->cache.find<vector<complex<double> > >(key);
+    if (w) return w;
 
     fn2=N*2;
-    fftw_complex* in_outF = (fftw_complex*) fftw_malloc(sizeof(fftw_complex) * fn2 * fn2);
-    fftw_complex* in_outK = (fftw_complex*) fftw_malloc(sizeof(fftw_complex) * fn2 * fn2);
-    for (int i = 0;i<fn2*fn2;i++){
-        in_outK[i][0]=0.0; in_outK[i][1]=0.0;
-        in_outF[i][0]=0.0; in_outF[i][1]=0.0;
-        }
-    if (in_outF == NULL) return Field;
-    if (in_outK == NULL) return Field;
-    fftw_plan planFF = fftw_plan_dft_2d (fn2, fn2, in_outF, in_outF, FFTW_FORWARD, FFTW_ESTIMATE);
-    if (planFF == NULL) return Field;
-    fftw_plan planFB = fftw_plan_dft_2d (fn2, fn2, in_outF, in_outF, FFTW_BACKWARD, FFTW_ESTIMATE);
-    if (planFB == NULL) return Field; 
-    fftw_plan planKF = fftw_plan_dft_2d (fn2, fn2, in_outK, in_outK, FFTW_FORWARD, FFTW_ESTIMATE);
-    if (planKF == NULL) return Field;
-    fftw_plan planKB = fftw_plan_dft_2d (fn2, fn2, in_outK, in_outK, FFTW_BACKWARD, FFTW_ESTIMATE);
-    if (planKB == NULL) return Field;
+    lpbuffer<complex<double> > buf(fn2);
+    if (buf.data() == NULL) return w;
+    fftw_plan planF = plan(1, fn2, FFTW_FORWARD, buf.data());
+    fill(buf.data(), buf.data() + fn2, 0.0);
 
-    sh= +.5;
+    dx=size/(N-1.);
     fn22=N+1;
     no2=N/2;
     RR=sqrt(1./(2.0*lambda*z))*dx*2.0;    
 
-    ii=ij=1;
-    ik=0;
+    // R1 of pixel i is R3 of pixel i-1:
+    vector<double> R(2*no2+1), fs(2*no2+1), fc(2*no2+1);
+    for (i=0; i<=2*no2; i++) R[i] = RR*(i - no2);
+    fresnl_batch(&R[0], 2*no2+1, &fs[0], &fc[0], fresnlaccuracy);
+    ii=1;
     for (i=fn22-no2;i <= fn22+no2-1; i++){
-       io=i-fn22;
-       R1=RR*(io - .5 + sh);
-       R3=RR*(io + .5 + sh);
-       for (j=fn22-no2;j <= fn22+no2-1; j++){
-          iiij=ii*ij;
-          jo=j-fn22;
-          ik1=(i-1)*fn2+j-1;
-          /* Fresnel staff  */
-          R2=RR*(jo - .5 + sh);
-          R4=RR*(jo + .5 + sh);
-          fresnl(R1,&fs1, &fc1);
-          fresnl(R2,&fs2, &fc2);
-          fresnl(R3,&fs3, &fc3);
-          fresnl(R4,&fs4, &fc4);
+       io=i-fn22+no2;
+       buf[i-1] = complex<double>(fc[io+1] - fc[io], fs[io+1] - fs[io])*(double)ii;
+       ii=-ii;
+    }
 
-          c4c1=fc4*fc1;
-          c2s3=fc2*fs3;
-          c4s1=fc4*fs1;
-          s4c1=fs4*fc1;
-          s2c3=fs2*fc3;
-          c2s1=fc2*fs1;
-          s4c3=fs4*fc3;
-          s2c1=fs2*fc1;
-          c4s3=fc4*fs3;
+    lpfftw<double>::execute(planF, buf.data());
+    w = make_shared<vector<complex<double> > >(buf.data(), buf.data() + fn2);
+    for (i=1; i<fn2; i+=2) (*w)[i] = -(*w)[i];
+    engine->cache.insert(key, w, fn2*sizeof(complex<double>));
+    return w;
+}
+/***********************************************************************
+*  Fresnel: convolution with the kernel of fresnelKernel on a zero padded
+*  2N x 2N grid. A stack of K fields is transformed in batches of kb
+*  fields with one FFTW plan, the padded arrays take at most 256 MB or
+*  one field.
+***********************************************************************/
+template <class T> void lpspy::Fresnel(double z, complex<T> *Field, int K ){
+    int i,j,fn2, fn22,no2,ii,ij,iiij,kb,nk;
+    long ik1, ik2, ik3, ik4;
+    double  pi2, kz;
+    complex<double> eikz, F;
+    pi2=2.*3.141592654;
 
-          s2s3=fs2*fs3;
-          s2s1=fs2*fs1;
-          c2c3=fc2*fc3;
-          s4s1=fs4*fs1;
-          c4c3=fc4*fc3;
-          c4c1=fc4*fc1;
-          s4s3=fs4*fs3;
-          c2c1=fc2*fc1;
-          
-          in_outK[ik1][0]=0.5*(c4s3+s4c3-c4s1-s4c1-c2s3-s2c3+c2s1+s2c1)*iiij;
-          in_outK[ik1][1]=0.5*(-c4c3+s4s3+c4c1-s4s1+c2c3-s2s3-c2c1+s2s1)*iiij;
+    kz = pi2/lambda*z;
+    eikz = complex<double>(cos(kz), sin(kz));
 
-          /* Field staff */ 
-          in_outF[ik1][0] = Field.at(i - no2 - 1).at(j - no2 - 1).real()*iiij;
-          in_outF[ik1][1] = Field.at(i - no2 - 1).at(j - no2 - 1).imag()*iiij;
+/*  Allocating a LOT OF MEMORY */
 
-          ik++;
-          ij=-ij;
-       }
-       ii=-ii;
-    }
+    fn2=N*2;
+    size_t NN = (size_t)N*N, fnn = (size_t)fn2*fn2;
+    kb = (int) max((size_t)1, min((size_t)K, ((size_t)256 << 20)/(fnn*sizeof(complex<T>))));
+    lpbuffer<complex<T> > bufF(fnn*kb);
+    if (bufF.data() == NULL) return;
+    complex<T> *in_outF = bufF.data();
+    shared_ptr<vector<complex<double> > > kernel = fresnelKernel(z);
+    if (!kernel) return;
+    const complex<double> *w = &(*kernel)[0];
 
-    fftw_execute(planKF);
-    fftw_execute(planFF);
+    fn22=N+1;
+    no2=N/2;
 
-    ik=0;
-    ii=ij=1;
-    for(i=1; i<=fn2; i++){
-       for(j=1; j<=fn2; j++){
-          iiij=ii*ij;
-          cc = in_outK[ik][0]*in_outF[ik][0]-in_outK[ik][1]*in_outF[ik][1];
-          in_outF[ik][1] = (in_outK[ik][0]*in_outF[ik][1]+in_outF[ik][0]*in_outK[ik][1])*iiij;
-          in_outF[ik][0]=cc*iiij;
-          ik++;
-          ij=-ij;
-       } 
-       ii=-ii;
-    }
-    fftw_execute(planFB);
-    ik=0;
-    ii=ij=1;
-    for(i=fn22-no2; i<=fn22+no2-1; i++){
-       for(j=fn22-no2; j<=fn22+no2-1; j++){
-          ik1=(i-1)*fn2+j-1;
-          ik2=(i-2)*fn2+j-1;
-          ik3=(i-2)*fn2+j-2;
-          ik4=(i-1)*fn2+j-2;
-          iiij=ii*ij;
-          FR = 0.25*(in_outF[ik1][0]-in_outF[ik2][0]+in_outF[ik3][0]-in_outF[ik4][0])*iiij;
-          FI = 0.25*(in_outF[ik1][1]-in_outF[ik2][1]+in_outF[ik3][1]-in_outF[ik4][1])*iiij;
-          Field.at(i - no2 - 1).at(j- no2 - 1) = complex<double>( (FR * cokz - FI * sikz)/fn2/fn2, (FI * cokz + FR * sikz)/fn2/fn2);
-          ik++;
-          ij=-ij;
-       }
-       ii=-ii;
-    }
-    fftw_destroy_plan(planFF);
-    fftw_destroy_plan(planFB);
-    fftw_destroy_plan(planKF);
-    fftw_destroy_plan(planKB);
-    fftw_free(in_outF);
-    fftw_free(in_outK);
-    fftw_cleanup();
-    return Field;
-}
-CMPLXVEC lpspy::Gain( double Isat, double gain, double L, CMPLXVEC Field ){
-    double Io, Ii, ampl;;
-    for (int i=0;i< N; i++){
-        for (int j=0;j< N; j++){
-            Ii = norm(Field.at(i).at(j));
-            if (Isat == 0.0) Io = Ii;
-            else Io =  Ii*exp(gain*L/(1 + 2.0 * Ii/Isat));
-            if (Ii == 0.0) ampl = 0.0;
-            else ampl = sqrt(Io/Ii);
-            Field.at(i).at(j) *= ampl;
+    for (int k0=0; k0<K; k0+=kb){
+        nk = min(kb, K-k0);
+        typename lpfftw<T>::plan planF = plan(fn2, fn2, FFTW_FORWARD, in_outF, nk);
+        typename lpfftw<T>::plan planB = plan(fn2, fn2, FFTW_BACKWARD, in_outF, nk);
+        fill(in_outF, in_outF + fnn*nk, complex<T>(0));
+
+        for (int k=0; k<nk; k++){
+            complex<T> *Fk = Field + (k0+k)*NN, *Bk = in_outF + k*fnn;
+            ii=ij=1;
+            for (i=fn22-no2;i <= fn22+no2-1; i++){
+               for (j=fn22-no2;j <= fn22+no2-1; j++){
+                  iiij=ii*ij;
+                  ik1=(i-1)*fn2+j-1;
+                  /* Field staff */ 
+                  Bk[ik1] = Fk[(i - no2 - 1)*N+j - no2 - 1]*(T)iiij;
+                  ij=-ij;
+               }
+               ii=-ii;
+            }
         }
-    }
-    return Field;
-}
-CMPLXVEC lpspy::GaussAperture( double w, double x_shift, double y_shift, double R, CMPLXVEC Field ){
-    int n2;
-    double x,y,dx,w2,cc,SqrtR,x2,y2;
-    n2=(int)N/2;
-    w2=w*w*2;
-    SqrtR=sqrt(R);
-    dx = size/N;
-    for (int i=0;i< N; i++){
-        x=(i-n2)*dx-x_shift;
-        x2=x*x;
-        for (int j=0;j< N; j++){
-            y=(j-n2)*dx-y_shift;
-            y2=y*y;
-            cc=SqrtR*exp(-(x2+y2)/w2);
-            Field.at(i).at(j) *= cc;
+
+        lpfftw<T>::execute(planF, in_outF);
+        for (long r=0; r<(long)nk*fn2; r++){
+            complex<T> *row = in_outF + (size_t)r*fn2;
+            complex<double> wi = -0.5*_j*w[r % fn2];
+            for (j=0; j<fn2; j++) row[j] *= wi*w[j];
+        }
+        lpfftw<T>::execute(planB, in_outF);
+
+        for (int k=0; k<nk; k++){
+            complex<T> *Fk = Field + (k0+k)*NN, *Bk = in_outF + k*fnn;
+            ii=ij=1;
+            for(i=fn22-no2; i<=fn22+no2-1; i++){
+               for(j=fn22-no2; j<=fn22+no2-1; j++){
+                  ik1=(i-1)*fn2+j-1;
+                  ik2=(i-2)*fn2+j-1;
+                  ik3=(i-2)*fn2+j-2;
+                  ik4=(i-1)*fn2+j-2;
+                  iiij=ii*ij;
+                  F = 0.25*(complex<double>(Bk[ik1])-complex<double>(Bk[ik2])
+                           +complex<double>(Bk[ik3])-complex<double>(Bk[ik4]))*(double)iiij;
+                  Fk[(i - no2 - 1)*N+j- no2 - 1] = F*eikz/(double)fn2/(double)fn2;
+                  ij=-ij;
+               }
+               ii=-ii;
+            }
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::GaussScreen( double w, double x_shift, double y_shift, double T, CMPLXVEC Field ){
-    int n2;
-    double x,y,dx,w2,cc,x2,y2;
-    n2=(int)N/2;
-    w2=w*w;
-    dx = size/N;
-    for (int i=0;i< N; i++){
-        x=(i-n2)*dx-x_shift;
-        x2=x*x;
-        for (int j=0;j< N; j++){
-            y=(j-n2)*dx-y_shift;
-            y2=y*y;
-            cc=sqrt(1-(1-T)*exp(-(x2+y2)/w2));
-            Field.at(i).at(j) *= cc;
-        }
+/***********************************************************************
+*  Fuse: applies the elementwise commands ops[0], ..., ops[nops-1] in one
+*  sweep over the field, all of them to one row before the next row, so
+*  the row stays in the cache. The commands themselves are a Fuse of one
+*  op, they apply the same elements, see lpspy::element, and give the
+*  same result as the fused chain.
+***********************************************************************/
+template <class T> void lpspy::Fuse(int nops, const lpop *ops, complex<T> *Field ){
+    vector<shared_ptr<lpelement<T> > > e(nops);
+    for (int k = 0; k < nops; k++) e[k] = element<T>(ops[k]);
+    for (int i = 0; i < N; i++){
+        complex<T> *row = Field + (size_t)i*N;
+        for (int k = 0; k < nops; k++) e[k]->apply(i, row);
     }
-    return Field;
+    return;
+}
+template <class T> void lpspy::Gain( double Isat, double gain, double L, complex<T> *Field ){
+    lpop op = {FUSE_GAIN, {Isat, gain, L}};
+    Fuse(1, &op, Field);
+    return;
+}
+template <class T> void lpspy::GaussAperture( double w, double x_shift, double y_shift, double R, complex<T> *Field ){
+    lpop op = {FUSE_GAUSS_APERTURE, {w, x_shift, y_shift, R}};
+    Fuse(1, &op, Field);
+    return;
+}
+template <class T> void lpspy::GaussScreen( double w, double x_shift, double y_shift, double T0, complex<T> *Field ){
+    lpop op = {FUSE_GAUSS_SCREEN, {w, x_shift, y_shift, T0}};
+    Fuse(1, &op, Field);
+    return;
 }
-CMPLXVEC lpspy::GaussHermite( int n, int m, double A, double w0, CMPLXVEC Field ){
-    int    n2;
-    double sqrt2w0,sqrt2xw0,sqrt2yw0,w02,x,y,dx,x2,y2;
+template <class T> void lpspy::GaussHermite( int n, int m, double A, double w0, complex<T> *Field ){
+    double sqrt2w0,sqrt2xw0,sqrt2yw0,w02,x,y,x2,y2;
 
     sqrt2w0=sqrt(2.0)/w0;
     w02=w0*w0;
-    n2=N/2;
-    dx=size/N;
+    shared_ptr<lpgrid> g = grid(0., 0.);
 
     for (int i=0;i< N; i++){
-        x=(i-n2)*dx;
+        x=g->x[i];
         x2=x*x;
         sqrt2xw0=sqrt2w0*x;
         for (int j=0;j< N; j++){
-            y=(j-n2)*dx;
+            y=g->y[j];
             y2=y*y;
             sqrt2yw0=sqrt2w0*y;
-            Field.at(i).at(j) = complex<double> (A*exp(-(x2+y2)/w02)*H(m,sqrt2xw0)*H(n,sqrt2yw0) , 0.0);
+            Field[i*N+j] = complex<double> (A*exp(-(x2+y2)/w02)*H(m,sqrt2xw0)*H(n,sqrt2yw0) , 0.0);
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::GaussLaguerre( int p, int m, double A, double w0, CMPLXVEC Field ){
-    int    n2, ma;
-    double r,rho,theta,w02,x,y,dx,x2,y2;
+template <class T> void lpspy::GaussLaguerre( int p, int m, double A, double w0, complex<T> *Field ){
+    int    ma;
+    double r,rho,theta,w02,x,y,x2,y2;
 
     w02=w0*w0;
-    n2=N/2;
-    dx=size/N;
     ma=abs(m);
+    shared_ptr<lpgrid> g = grid(0., 0., true);
     for (int i=0;i< N; i++){
-        x=(i-n2)*dx;
+        x=g->x[i];
         x2=x*x;
         for (int j=0;j< N; j++){
-            y=(j-n2)*dx;
+            y=g->y[j];
             y2=y*y;
-            r=sqrt(x2+y2);
+            r=g->radius(i, j);
+            // the angle from the y-axis, acos(y/r), only enters cos(m*theta);
+            // phi is an atan2, measured with the exact pi:
             if (r==0.0)
                 if (y>0.0) theta=Pi/2;
                 else theta=-Pi/2;
-            else theta=acos(y/r);
+            else theta=1.57079632679489662-g->angle(i, j);
             rho=2*(x2+y2)/w02;
-            Field.at(i).at(j) = complex<double>( A*pow((rho/2),ma/2)*Laguerre1(p,m,rho)*exp(-rho/2)*cos(m*theta) , 0.0 );
+            Field[i*N+j] = complex<double>( A*pow((rho/2),ma/2)*Laguerre1(p,m,rho)*exp(-rho/2)*cos(m*theta) , 0.0 );
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::Lens( double f, double x_shift, double y_shift, CMPLXVEC Field ){
-    double x,x2,y,dx,pi2,K;
-    int n2;
-    if (doub1 != 0.) printf("error in Lens: Spherical coordinates! Use Convert first\n");
-    pi2=3.1415926*2.;
-    K=pi2/lambda;
-    n2=(int) N/2;
-    dx=size/N;
-    for (int i=0;i< N; i++){
-        x=(i-n2)*dx-x_shift;
-        x2=x*x;
-        for (int j=0;j< N; j++){ 
-            double fi;
-            y=(j-n2)*dx-y_shift;
-            fi=-K*(x2+y*y)/(2.*f);
-            Field.at(i).at(j) *= exp(_j * fi);
-        }
-    }
-    return Field;
+template <class T> void lpspy::Lens( double f, double x_shift, double y_shift, complex<T> *Field ){
+    lpop op = {FUSE_LENS, {f, x_shift, y_shift}};
+    Fuse(1, &op, Field);
+    return;
 }
-CMPLXVEC lpspy::LensForvard(double f, double z, CMPLXVEC Field ){
-    CMPLXVEC FieldTmp;
+template <class T> void lpspy::LensForvard(double f, double z, complex<T> *Field ){
     double z1,f1,ampl_scale;
     double LARGENUMBER = 10000000.;
     f1=0.;
@@ -596,32 +946,22 @@ CMPLXVEC lpspy::LensForvard(double f, double z, CMPLXVEC Field ){
     if ((z-f) == 0 ) z1 = LARGENUMBER;
     else z1= -z*f/(z-f);
 
-    FieldTmp=Forvard(z1,Field);
+    Forvard(z1,Field);
 
     ampl_scale= (f-z)/f ;
     size *= ampl_scale;
     doub1= -1./(z-f);
 
-    if (z1>=0.){
-        for (int i=0;i<N; i++){
-            for (int j=0;j<N; j++){	
-                Field.at(i).at(j) = FieldTmp.at(i).at(j)/ampl_scale;
-            }
-        }
-    }
-    else{
-        for (int i=0;i<N; i++){
-            for (int j=0;j<N; j++){
-                int i_i, j_i;
-                i_i = N-i-1;
-                j_i = N-j-1;
-                Field.at(i).at(j) = FieldTmp.at(i_i).at(j_i) / ampl_scale;
-            }
-        }
+    // z1<0: the field is upside down, rotating it over 180 degrees
+    // is the same as reversing the row-major pixel order.
+    if (z1<0.) reverse(Field, Field + (size_t)N*N);
+    size_t NN = (size_t)N*N;
+    for (size_t ik=0;ik<NN; ik++){
+        Field[ik] /= ampl_scale;
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::LensFresnel(double f, double z, CMPLXVEC Field ){
+template <class T> void lpspy::LensFresnel(double f, double z, complex<T> *Field ){
     double z1,f1,ampl_scale;
     double LARGENUMBER = 10000000.;
     double TINY_NUMBER = 1.0e-100;
@@ -635,85 +975,74 @@ CMPLXVEC lpspy::LensFresnel(double f, double z, CMPLXVEC Field ){
     z1= -z*f/(z-f);
     if (z1 < 0.0){
             cout << "error in LensFresnel: Behind focus" << endl;
-            return Field;
+            return;
     }
 
-    Field=Fresnel(z1,Field);
+    Fresnel(z1,Field);
 
     ampl_scale= (f-z)/f ;
     size *= ampl_scale;
     doub1= -1./(z-f);
 
-    for (int i=0;i<N; i++){
-        for (int j=0;j<N; j++){	
-            Field.at(i).at(j) /= ampl_scale;
-        }
+    size_t NN = (size_t)N*N;
+    for (size_t ik=0;ik<NN; ik++){
+        Field[ik] /= ampl_scale;
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::IntAttenuator( double R, CMPLXVEC Field ){
-    double r;
-    r=sqrt(R);
-    for (int i=0;i< N; i++){
-        for (int j=0;j< N; j++){ 
-            Field.at(i).at(j) *= r;
-        }
-    }
-    return Field;
+template <class T> void lpspy::IntAttenuator( double R, complex<T> *Field ){
+    lpop op = {FUSE_INT_ATTENUATOR, {R}};
+    Fuse(1, &op, Field);
+    return;
 }
-CMPLXVEC lpspy::MultIntensity( vector<vector<double> > Intens, CMPLXVEC Field ){
+template <class T> void lpspy::MultIntensity( double *Intens, int nx, int ny, complex<T> *Field ){
     double Intens2;
-    if ((int)Intens.at(0).size() != N || (int)Intens.size() != N){
+    if (ny != N || nx != N){
         printf( "Error in MultIntensity(Intens, Fin): array 'Intens' must be square and must have %d x %d elements\n",N,N);
-        return Field;
+        return;
     }
     for (int i=0;i< N; i++){
         for (int j=0;j< N; j++){
-            Intens2=sqrt(Intens.at(j).at(i));
-            Field.at(i).at(j) *= Intens2;
+            Intens2=sqrt(Intens[j*N+i]);
+            Field[i*N+j] *= Intens2;
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::MultPhase( vector<vector<double> > Phase, CMPLXVEC Field ){
+template <class T> void lpspy::MultPhase( double *Phase, int nx, int ny, complex<T> *Field ){
     double phi;
-    if ((int)Phase.at(0).size() != N || (int)Phase.size() != N){
+    if (ny != N || nx != N){
         printf( "Error in MultPhase(Phase, Fin): array 'Phase' must be square and must have %d x %d elements\n",N,N);
-        return Field;
+        return;
     }
     for (int i=0;i< N; i++){
         for (int j=0;j< N; j++){
-            phi=Phase.at(j).at(i);
-            Field.at(i).at(j) *= exp(_j * phi);
+            phi=Phase[j*N+i];
+            Field[i*N+j] *= exp(_j * phi);
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::Normal( CMPLXVEC Field ){
+template <class T> void lpspy::Normal( complex<T> *Field ){
     double sum, dx, dx2, asum;
     sum=0;
     dx =size/N;
     dx2 = dx*dx;
-    for (int i=0;i< N; i++){
-        for (int j=0;j< N; j++){
-            sum += norm(Field.at(i).at(j)) * dx2;
-        }
+    size_t NN = (size_t)N*N;
+    for (size_t ik=0;ik< NN; ik++){
+        sum += norm(complex<double>(Field[ik])) * dx2;
     }
     if (sum == 0.0){
         printf("Error in 'Normal(Fin)': Zero beam power!");
-        return Field;
+        return;
     }
     asum=sqrt(1./sum);
-    for (int i=0;i< N; i++){
-        for (int j=0;j< N; j++){
-           Field.at(i).at(j) *= asum;
-        }
-    }   	
-    return Field;
+    for (size_t ik=0;ik< NN; ik++){
+       Field[ik] *= asum;
+    }
+    return;
 }
-CMPLXVEC lpspy::Interpol( double new_size, int new_number, double x_shift, double y_shift, double angle, double magnif, CMPLXVEC Fin ){
-    CMPLXVEC Fout;
-    Fout.resize(new_number, vector<complex<double> > (new_number));
+template <class T> void lpspy::Interpol( double new_size, int new_number, double x_shift, double y_shift, double angle, double magnif, complex<T> *Fin, complex<T> *Fout ){
     double dx_new, dx_old, x_new, x_old, size_old,
        y_new, y_old, lower, upper, ss, cc, x0, y0;
     int i_old, j_old, old_number, on21, nn21;
@@ -741,266 +1070,420 @@ CMPLXVEC lpspy::Interpol( double new_size, int new_number, double x_shift, doubl
             j_old=(int) floor(y_new/dx_old+on21);
             y_old=(j_old-on21)*dx_old;
             if((x_new > lower) && (x_new < upper) && (y_new >lower) && (y_new < upper)){
-                Fout.at(i).at(j)= complex<double> (
+                Fout[i*new_number+j]= complex<double> (
                     Inv_Squares(x_old, y_old, dx_old,
-                        Fin.at(i_old-1).at(j_old-1).real(),
-                        Fin.at(i_old).at(j_old-1).real(),
-                        Fin.at(i_old-1).at(j_old).real(),
-                        Fin.at(i_old).at(j_old).real(),
+                        Fin[(i_old-1)*N+j_old-1].real(),
+                        Fin[i_old*N+j_old-1].real(),
+                        Fin[(i_old-1)*N+j_old].real(),
+                        Fin[i_old*N+j_old].real(),
                         x_new, y_new)/magnif , 
                     Inv_Squares(x_old, y_old, dx_old,
-                        Fin.at(i_old-1).at(j_old-1).imag(),
-                        Fin.at(i_old).at(j_old-1).imag(),
-                        Fin.at(i_old-1).at(j_old).imag(),
-                        Fin.at(i_old).at(j_old).imag(),  
+                        Fin[(i_old-1)*N+j_old-1].imag(),
+                        Fin[i_old*N+j_old-1].imag(),
+                        Fin[(i_old-1)*N+j_old].imag(),
+                        Fin[i_old*N+j_old].imag(),  
                         x_new, y_new)/magnif );
             }
             else{
-                Fout.at(i).at(j)= complex<double>(0.0, 0.0);
+                Fout[i*new_number+j]= complex<double>(0.0, 0.0);
             }
         }
     }
     N=new_number;
     size=new_size;
-    return Fout;
+    return;
 }
-vector<vector<double> > lpspy::Intensity(int flag, CMPLXVEC Field ){
-    vector<vector<double> > I;
-    I.resize(N, vector<double> (N));
+template <class T> void lpspy::Intensity(int flag, complex<T> *Field, double *I ){
     for (int  i=0; i<N; i++)
     {
         for (int  j=0;j<N; j++)
         {
-            I.at(i).at(j) = norm(Field.at(j).at(i));	
+            I[i*N+j] = norm(Field[j*N+i]);	
         }
     }
-    if (flag == 0) return I;
+    if (flag == 0) return;
     double Imax=0.0;
     for (int  i=0;i<N ; i++){
       for (int  j=0;j<N ; j++){
-        if (I.at(i).at(j) > Imax ) Imax=I.at(i).at(j);
+        if (I[i*N+j] > Imax ) Imax=I[i*N+j];
       }
     }
     if (Imax == 0.0){
       printf(" in Intensity: cannot normalize because of zero beam power.\n");
-      return I;
+      return;
     }
     double InvImax=1/Imax;
     for (int  i=0;i<N ; i++){
         for (int  j=0;j<N; j++){
-            I.at(i).at(j) *= InvImax;
-            if (flag == 2 ) I.at(i).at(j) *= 255.0;
+            I[i*N+j] *= InvImax;
+            if (flag == 2 ) I[i*N+j] *= 255.0;
         }
     }
-    return I;
+    return;
 }
-vector<vector<double> > lpspy::Phase(CMPLXVEC Field ){
-    vector<vector<double> > Phi;
-    Phi.resize(N, vector<double> (N));
+template <class T> void lpspy::Phase(complex<T> *Field, double *Phi ){
     for (int  i=0; i<N; i++)
     {
         for (int  j=0;j<N; j++)
         {
-            Phi.at(i).at(j)=arg(Field.at(j).at(i));
-        }
-    }
-    return Phi;
-}
-vector<vector<double> > lpspy::PhaseUnwrap(vector<vector<double> > Phi ){
-    double *x, *y;
-    x=(double*)calloc(N*N,sizeof(double));
-	if (x == NULL){
-        printf("Error in 'PhaseUnwrap(Phi)': unsufficient memory!");
-		return Phi;
-    }
-    y=(double*)calloc(N*N,sizeof(double));
-	if (y == NULL){
-        printf("Error in 'PhaseUnwrap(Phi)': unsufficient memory!");
-        free(x);
-		return Phi;
-    }    
-    int ik=0;
-	for(int i=0; i<N; i++){
-		for (int j=0; j<N; j++){
-		  x[ik]=Phi[i][j];
-		  ik++;
-		}
-	}
-	phaseunwrap(x, y ,N, N);
-	ik=0;
-	for(int i=0; i<N; i++){
-		for (int j=0; j<N; j++){
-		  Phi[i][j]=y[ik];
-		  ik++;
-		}
-	}
-    free(x);
-    free(y);
-    return Phi;
-}
-CMPLXVEC lpspy::PipFFT( int ind, CMPLXVEC Field ){
-    int i,j;  
-    int  ii, ij, iiij;
-    long ik;
-    fftw_complex* in_out = (fftw_complex*) fftw_malloc(sizeof(fftw_complex) * N * N);
-    if (in_out == NULL) return Field;
-    fftw_plan planF = fftw_plan_dft_2d (N, N, in_out, in_out, FFTW_FORWARD, FFTW_ESTIMATE);
-    if (planF == NULL) return Field;
-    fftw_plan planB = fftw_plan_dft_2d (N, N, in_out, in_out, FFTW_BACKWARD, FFTW_ESTIMATE);
-    if (planB == NULL) return Field;
-    ik=0;
-    for (i=0;i<N; i++){
-        for (j=0;j<N; j++){
-            in_out[ik][0] = (double) Field.at(i).at(j).real();
-            in_out[ik][1] = (double) Field.at(i).at(j).imag(); 
-            ik++;
+            Phi[i*N+j]=arg(Field[j*N+i]);
         }
     }
+    return;
+}
+void lpspy::PhaseUnwrap(double *Phi, double *PhiOut ){
+	phaseunwrap(Phi, PhiOut ,N, N);
+    return;
+}
+template <class T> void lpspy::PipFFT( int ind, complex<T> *Field, int K ){
+    double ii;
+    typename lpfftw<T>::plan planF = plan(N, N, FFTW_FORWARD, Field, K);
+    typename lpfftw<T>::plan planB = plan(N, N, FFTW_BACKWARD, Field, K);
     int1 += ind;
     if ( int1 != 0 ){ 
-        ik=0;
-        ii=ij=1;
-        for (i=0;i<N; i++){
-            for (j=0;j<N; j++){
-                iiij=ii*ij;
-                in_out[ik][0] *= iiij;
-                in_out[ik][1] *= iiij; 
-                ik++;
-                ij=-ij;
+        for (long i=0;i<(long)K*N; i++){
+            complex<T> *row = Field + (size_t)i*N;
+            ii = ((i % N) & 1) ? -1. : 1.;
+            for (int j=0;j<N; j++){
+                row[j] *= (j & 1) ? -ii : ii;
             }
-            ii=-ii;
         }
     }
-    if (ind == 1)  fftw_execute(planF);
-    if (ind == -1) fftw_execute(planB);
+    if (ind == 1)  lpfftw<T>::execute(planF, Field);
+    if (ind == -1) lpfftw<T>::execute(planB, Field);
     if(int1 == 0){
-        ik=0;
-        ii=ij=1;
-        for (i=0;i<N; i++){    
-            for (j=0;j<N; j++ ){
-                iiij=ii*ij;
-                in_out[ik][0] *= iiij;
-                in_out[ik][1] *= iiij;
-                ik++;
-                ij=-ij;
+        for (long i=0;i<(long)K*N; i++){    
+            complex<T> *row = Field + (size_t)i*N;
+            ii = ((i % N) & 1) ? -1. : 1.;
+            for (int j=0;j<N; j++ ){
+                row[j] *= (j & 1) ? -ii : ii;
             }
-            ii=-ii;
-        }
-    }
-    ik=0;
-    for (i=0;i< N; i++){
-        for (j=0;j< N; j++){
-            Field.at(i).at(j) = complex<double>(in_out[ik][0] , in_out[ik][1]);
-            ik++;
         }
     }
-    fftw_destroy_plan(planF);
-    fftw_destroy_plan(planB);
-    fftw_free(in_out);
-    fftw_cleanup();
-    return Field;
+    return;
 }
-double lpspy::Power( CMPLXVEC Field ){
+template <class T> double lpspy::Power( complex<T> *Field ){
     double sum;
     sum=0.0;
-    for (int i=0; i< N ;i++){
-        for (int j=0;j < N ;j++){
-            sum += norm(Field.at(i).at(j));
-        }
+    size_t NN = (size_t)N*N;
+    for (size_t ik=0; ik< NN ;ik++){
+        sum += norm(complex<double>(Field[ik]));
     }
     return sum;
 }
-CMPLXVEC lpspy::RectAperture(double sx, double sy, double x_shift, double y_shift, double angle, CMPLXVEC Field ){
-    double dx,x,y,x0,y0,cc,ss;
-    int i2;
-    dx =size/N;
-    i2=N/2+1;
-    angle *= -Pi/180.;
-    cc=cos(angle);
-    ss=sin(angle);
-    if(angle==0.0){
-        for (int i=0;i<N ;i++){
-            for (int j=0;j<N ;j++){
-                x=(i-i2+1)*dx-x_shift;
-                y=(j-i2+1)*dx-y_shift;
-                if(fabs(x) > sx/2. || fabs(y) > sy/2. ) {
-                    Field.at(i).at(j) = 0.0;
-                }
-            }
-        }
-    }
-    else{
-        for (int i=0;i<N ;i++){
-            for (int j=0;j<N ;j++){
-                x0=(i-i2+1)*dx-x_shift;
-                y0=(j-i2+1)*dx-y_shift;
-                x=x0*cc+y0*ss;
-                y=-x0*ss+y0*cc; 
-                if(fabs(x) > sx/2. || fabs(y) > sy/2. ){
-                    Field.at(i).at(j) = 0.0;
-                }
-            }
+/***********************************************************************
+*  propagateFilter: the angular spectrum transfer function
+*      H(u,v) = exp(i*2*Pi*z*sqrt(1/lambda^2 - u^2 - v^2)),
+*  band limited to |u|,|v| < 1/(lambda*sqrt((2*z/size)^2 + 1)), where
+*  the phase of H changes too fast to be sampled with du = 1/size
+*  (Matsushima and Shimobaba, Opt. Express 17, 19662 (2009)). This also
+*  removes the evanescent waves. H is not separable, the N x N array is
+*  stored in FFT order, with exp(i*k*z)/N^2 included, and cached on
+*  (N, size, lambda, z).
+***********************************************************************/
+shared_ptr<vector<complex<double> > > lpspy::propagateFilter(double z){
+    vector<double> key(5);
+    key[0] = PROPAGATE_FILTER;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = z;
+    shared_ptr<vector<complex<double> > > H = engine->cache.find<vector<complex<double> > >(key);
+    if (H) return H;
+    H = make_shared<vector<complex<double> > >((size_t)N*N, 0.0);
+    double pi2, kz, flimit, fmax2, fx, fy, f2, bus, abus;
+    complex<double> scale;
+    pi2=2.*3.141592654;
+    kz = pi2/lambda*z;
+    scale = exp(_j * kz) / ((double)N*N);
+    flimit = 1./(lambda*sqrt(4.*z*z/(size*size) + 1.));
+    fmax2 = 1./(lambda*lambda);
+    for (int i=0;i<N; i++){
+        fx = ((i < (N+1)/2) ? i : i - N)/size;
+        if (fabs(fx) >= flimit) continue;
+        complex<double> *row = &(*H)[(size_t)i*N];
+        for (int j=0;j<N; j++){
+            fy = ((j < (N+1)/2) ? j : j - N)/size;
+            f2 = fx*fx + fy*fy;
+            if (fabs(fy) >= flimit || f2 >= fmax2) continue;
+            // k*z*sqrt(1-(lambda*f)^2) - k*z in cycles, without cancellation:
+            bus = z*lambda*f2/(1. + sqrt(1. - lambda*lambda*f2));
+            abus = pi2*((long) bus - bus);
+            row[j] = scale * complex<double>(cos(abus), sin(abus));
         }
     }
-    return Field;
+    engine->cache.insert(key, H, (size_t)N*N*sizeof(complex<double>));
+    return H;
 }
-CMPLXVEC lpspy::RectScreen(double sx, double sy, double x_shift, double y_shift, double angle, CMPLXVEC Field ){
-    double dx,x,y,x0,y0,cc,ss;
-    int i2;
-    dx =size/N;
-    i2=N/2+1;
-    angle *= -Pi/180.;
-    cc=cos(angle);
-    ss=sin(angle);
-    if(angle==0.0){
-        for (int i=0;i<N ;i++){
-            for (int j=0;j<N ;j++){
-                x=(i-i2+1)*dx-x_shift;
-                y=(j-i2+1)*dx-y_shift;
-                if(fabs(x) <= sx/2. && fabs(y) <= sy/2. ) {
-                    Field.at(i).at(j) = 0.0;
-                }
-            }
-        }
-    }
-    else {
-        for (int i=0;i<N ;i++){
-            for (int j=0;j<N ;j++){
-                x0=(i-i2+1)*dx-x_shift;
-                y0=(j-i2+1)*dx-y_shift;
-                x=x0*cc+y0*ss;
-                y=-x0*ss+y0*cc; 
-                if(fabs(x) <= sx/2. && fabs(y) <= sy/2. ) {
-                    Field.at(i).at(j) = 0.0;
-                }
-            }
-        }
+/***********************************************************************
+*  Propagate: non-paraxial propagation with the angular spectrum of the
+*  field, with the same FFT plans as Forvard.
+***********************************************************************/
+template <class T> void lpspy::Propagate(double z, complex<T> *Field, int K ){
+    size_t NN = (size_t)N*N;
+    typename lpfftw<T>::plan planF = plan(N, N, FFTW_FORWARD, Field, K);
+    typename lpfftw<T>::plan planB = plan(N, N, FFTW_BACKWARD, Field, K);
+    shared_ptr<vector<complex<double> > > filter = propagateFilter(z);
+    const complex<double> *H = &(*filter)[0];
+    lpfftw<T>::execute(planF, Field);
+    for (int k=0; k<K; k++){
+        complex<T> *Fk = Field + k*NN;
+        for (size_t ij=0; ij<NN; ij++) Fk[ij] *= H[ij];
     }
-    return Field;
+    lpfftw<T>::execute(planB, Field);
+    return;
+}
+template <class T> void lpspy::RectAperture(double sx, double sy, double x_shift, double y_shift, double angle, complex<T> *Field ){
+    lpop op = {FUSE_RECT_APERTURE, {sx, sy, x_shift, y_shift, angle}};
+    Fuse(1, &op, Field);
+    return;
+}
+template <class T> void lpspy::RectScreen(double sx, double sy, double x_shift, double y_shift, double angle, complex<T> *Field ){
+    lpop op = {FUSE_RECT_SCREEN, {sx, sy, x_shift, y_shift, angle}};
+    Fuse(1, &op, Field);
+    return;
 }
-CMPLXVEC lpspy::RandomIntensity(double seed, double noise_level, CMPLXVEC Field ){
+template <class T> void lpspy::RandomIntensity(double seed, double noise_level, complex<T> *Field ){
     double rnd_int;
     srand((unsigned int)seed);	
     for (int i=0;i<N ;i++){
         for (int j=0;j<N ;j++){
             rnd_int=((double)rand())/((double) RAND_MAX);
-            Field.at(i).at(j) += rnd_int * noise_level;
+            Field[i*N+j] += rnd_int * noise_level;
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::RandomPhase(double seed, double max, CMPLXVEC Field ){
+template <class T> void lpspy::RandomPhase(double seed, double max, complex<T> *Field ){
     double fi;
     srand((unsigned int)seed);	
     for (int i=0;i<N ;i++){
         for (int j=0;j<N ;j++){
             fi=( ((double)rand())/((double) RAND_MAX) - 0.5 )*max;
-            Field.at(i).at(j) *= exp(_j * fi);
+            Field[i*N+j] *= exp(_j * fi);
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
+/***********************************************************************
+*  fftlength: the smallest m >= n without prime factors above 7, a length
+*  FFTW transforms fast.
+***********************************************************************/
+static int fftlength(int n){
+    for (int m = n; ; m++){
+        int r = m;
+        for (int p = 2; p <= 7; p++) while (r % p == 0) r /= p;
+        if (r == 1) return m;
+    }
+}
+/***********************************************************************
+*  chirp: exp(s*i*Pi*alpha*t^2), with the phase reduced to one cycle
+*  before it is multiplied by 2*Pi.
+***********************************************************************/
+static complex<double> chirp(double alpha, int s, double t){
+    double c = 0.5*alpha*t*t;
+    c -= floor(c);
+    return polar(1.0, s*2.*Pi*c);
+}
+/***********************************************************************
+*  chirpz: sets up op (see lpspy.h) for the chirp-z transform with
+*  kernel exp(s*i*2*Pi*alpha*n'*m'), with pre = post = 1 apart from the
+*  chirps of Bluestein's algorithm, n'*m' = (n'^2 + m'^2 - (m'-n')^2)/2.
+*  Returns false if there is no memory or FFTW plan.
+***********************************************************************/
+bool lpspy::chirpz(lpchirpz &op, int nin, int nout, double alpha, int s){
+    op.nin = nin;
+    op.nout = nout;
+    op.L = fftlength(nin + nout - 1);
+    op.shift = 0;
+    op.pre.resize(nin);
+    op.post.resize(nout);
+    for (int n = 0; n < nin; n++) op.pre[n] = chirp(alpha, s, n - nin/2);
+    for (int m = 0; m < nout; m++) op.post[m] = chirp(alpha, s, m - nout/2);
+    lpbuffer<complex<double> > k(op.L);
+    if (k.data() == NULL) return false;
+    fftw_plan planF = plan(1, op.L, FFTW_FORWARD, k.data());
+    fill(k.data(), k.data() + op.L, 0.0);
+    // m'-n' = m-n + nin/2-nout/2, for -nin < m-n < nout:
+    int d = nin/2 - nout/2;
+    for (int j = 1 - nin; j < nout; j++) k[(j + op.L) % op.L] = chirp(alpha, -s, j + d);
+    lpfftw<double>::execute(planF, k.data());
+    op.kernel.assign(k.data(), k.data() + op.L);
+    for (int j = 0; j < op.L; j++) op.kernel[j] /= (double)op.L;
+    return true;
+}
+/***********************************************************************
+*  czt: the chirp-z transform op of the rows of the rows x op.nin array
+*  in to the rows x op.nout array out, all rows with one FFTW plan.
+***********************************************************************/
+template <class T> void lpspy::czt(const lpchirpz &op, int rows, const complex<T> *in, complex<T> *out){
+    int L = op.L, nin = op.nin, nout = op.nout;
+    lpbuffer<complex<T> > buf((size_t)rows*L);
+    if (buf.data() == NULL) return;
+    typename lpfftw<T>::plan planF = plan(1, L, FFTW_FORWARD, buf.data(), rows);
+    typename lpfftw<T>::plan planB = plan(1, L, FFTW_BACKWARD, buf.data(), rows);
+    for (int r = 0; r < rows; r++){
+        complex<T> *row = buf.data() + (size_t)r*L;
+        const complex<T> *x = in + (size_t)r*nin;
+        for (int n = 0; n < nin; n++){
+            int k = n + op.shift;
+            row[n] = x[k < nin ? k : k - nin];
+            row[n] *= op.pre[n];
+        }
+        fill(row + nin, row + L, complex<T>(0));
+    }
+    lpfftw<T>::execute(planF, buf.data());
+    for (int r = 0; r < rows; r++){
+        complex<T> *row = buf.data() + (size_t)r*L;
+        for (int t = 0; t < L; t++) row[t] *= op.kernel[t];
+    }
+    lpfftw<T>::execute(planB, buf.data());
+    for (int r = 0; r < rows; r++){
+        const complex<T> *row = buf.data() + (size_t)r*L;
+        complex<T> *y = out + (size_t)r*nout;
+        for (int m = 0; m < nout; m++){
+            y[m] = row[m];
+            y[m] *= op.post[m];
+        }
+    }
+}
+/***********************************************************************
+*  czt2: the separable 2-D chirp-z transform of the op.nin x op.nin
+*  array Fin to the op.nout x op.nout array Fout, opx along the first
+*  index (x, rows) and opy along the second (y, columns).
+***********************************************************************/
+template <class T> void lpspy::czt2(const lpchirpz &opx, const lpchirpz &opy, const complex<T> *Fin, complex<T> *Fout){
+    int nin = opy.nin, nout = opy.nout;
+    vector<complex<T> > G((size_t)max(nin, nout)*nout), Gt((size_t)nin*nout);
+    czt(opy, nin, Fin, &G[0]);
+    for (int i = 0; i < nin; i++)
+        for (int l = 0; l < nout; l++) Gt[(size_t)l*nin + i] = G[(size_t)i*nout + l];
+    czt(opx, nout, &Gt[0], &G[0]);
+    for (int l = 0; l < nout; l++)
+        for (int m = 0; m < nout; m++) Fout[(size_t)m*nout + l] = G[(size_t)l*nout + m];
+}
+/***********************************************************************
+*  scaledFresnelOp: the 1-D chirp-z transform of ScaledFresnel, the same
+*  for x and y. The grids are those of the other commands, x = (i-N/2)*dx
+*  with dx = size/N. With the Fresnel number of the grid N*dx^2/(lambda*z)
+*  above 1 (near field) the transfer function of Forvard is applied to
+*  the spectrum of the field (op.shift != 0, the input of op is the FFT
+*  of the field), and the new grid is sampled by a scaled inverse DFT.
+*  Otherwise (far field) the Fresnel integral is evaluated as a chirp, a
+*  scaled DFT and a chirp. Cached on (N, size, lambda, z, sizenew, Nnew).
+***********************************************************************/
+shared_ptr<lpchirpz> lpspy::scaledFresnelOp(double z, double new_size, int new_n){
+    vector<double> key(7);
+    key[0] = SCALED_FRESNEL;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = z;
+    key[5] = new_size;
+    key[6] = new_n;
+    shared_ptr<lpchirpz> op = engine->cache.find<lpchirpz>(key);
+    if (op) return op;
+    op = make_shared<lpchirpz>();
+    double dx, dx_new, kz, x;
+    dx = size/N;
+    dx_new = new_size/new_n;
+    kz = 2.*Pi/lambda*z;
+    if (fabs(lambda*z) < N*dx*dx){
+        if (!chirpz(*op, N, new_n, dx_new/(N*dx), 1)) return shared_ptr<lpchirpz>();
+        op->shift = N - N/2;
+        // the FFT has its origin at pixel 0 instead of N/2:
+        for (int n = 0; n < N; n++)
+            op->pre[n] *= exp(_j*(kz/2. + 2.*Pi*(n - N/2)*(N/2)/N))
+                          *chirp(lambda*z, -1, (n - N/2)/size)/(double)N;
+    }
+    else {
+        if (!chirpz(*op, N, new_n, dx*dx_new/(lambda*z), -1)) return shared_ptr<lpchirpz>();
+        complex<double> q = sqrt(exp(_j*kz)*dx*dx/(_j*lambda*z));
+        for (int n = 0; n < N; n++){
+            x = (n - N/2)*dx;
+            op->pre[n] *= q*chirp(1./(lambda*z), 1, x);
+        }
+        for (int m = 0; m < new_n; m++){
+            x = (m - new_n/2)*dx_new;
+            op->post[m] *= chirp(1./(lambda*z), 1, x);
+        }
+    }
+    engine->cache.insert(key, op, (N + new_n + op->L)*sizeof(complex<double>));
+    return op;
+}
+/***********************************************************************
+*  ScaledFresnel: Fresnel propagation from the N x N grid of Fin to the
+*  new_n x new_n grid of new_size, with chirp-z transforms in
+*  O(N^2 log N) operations. Fin is overwritten.
+***********************************************************************/
+template <class T> void lpspy::ScaledFresnel(double z, double new_size, int new_n, complex<T> *Field, complex<T> *FieldNew ){
+    shared_ptr<lpchirpz> op = scaledFresnelOp(z, new_size, new_n);
+    if (!op) return;
+    if (op->shift != 0){
+        typename lpfftw<T>::plan planF = plan(N, N, FFTW_FORWARD, Field);
+        lpfftw<T>::execute(planF, Field);
+    }
+    czt2(*op, *op, Field, FieldNew);
+    size = new_size;
+    N = new_n;
+    return;
+}
+/***********************************************************************
+*  farFieldOp: the 1-D chirp-z transform of FarField along one axis, for
+*  the window of new_n points of new_size centred at shift. The window
+*  offset is a tilt of the input, exp(-i*2*Pi*x*shift/(lambda*f)), and a
+*  chirp of the output. Cached on (N, size, lambda, f, sizenew, Nnew,
+*  shift).
+***********************************************************************/
+shared_ptr<lpchirpz> lpspy::farFieldOp(double f, double new_size, int new_n, double shift){
+    vector<double> key(8);
+    key[0] = FAR_FIELD;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = f;
+    key[5] = new_size;
+    key[6] = new_n;
+    key[7] = shift;
+    shared_ptr<lpchirpz> op = engine->cache.find<lpchirpz>(key);
+    if (op) return op;
+    op = make_shared<lpchirpz>();
+    double dx, dx_new, x, c;
+    dx = size/N;
+    dx_new = new_size/new_n;
+    if (!chirpz(*op, N, new_n, dx*dx_new/(lambda*f), -1)) return shared_ptr<lpchirpz>();
+    complex<double> q = sqrt(exp(_j*2.*Pi/lambda*f)*dx*dx/(_j*lambda*f));
+    for (int n = 0; n < N; n++){
+        x = (n - N/2)*dx;
+        c = x*shift/(lambda*f);
+        c -= floor(c);
+        op->pre[n] *= q*polar(1.0, -2.*Pi*c);
+    }
+    for (int m = 0; m < new_n; m++){
+        x = (m - new_n/2)*dx_new + shift;
+        op->post[m] *= chirp(1./(lambda*f), 1, x);
+    }
+    engine->cache.insert(key, op, (N + new_n + op->L)*sizeof(complex<double>));
+    return op;
+}
+/***********************************************************************
+*  FarField: the field in the back focal plane of a lens with focal
+*  length f at the plane of Fin (the Fraunhofer pattern), sampled on a
+*  window of new_n x new_n points of size new_size centred at (x_shift,
+*  y_shift). The same as Lens(f) followed by Fresnel propagation over f,
+*  but only the window is computed, in O(N^2 log N) operations.
+***********************************************************************/
+template <class T> void lpspy::FarField(double f, double new_size, int new_n, double x_shift, double y_shift, complex<T> *Field, complex<T> *FieldNew ){
+    shared_ptr<lpchirpz> opx = farFieldOp(f, new_size, new_n, x_shift);
+    if (!opx) return;
+    shared_ptr<lpchirpz> opy = farFieldOp(f, new_size, new_n, y_shift);
+    if (!opy) return;
+    czt2(*opx, *opy, Field, FieldNew);
+    size = new_size;
+    N = new_n;
+    return;
+}
+template <class T> void lpspy::Steps(double z, int nstep, complex<double> *refr, complex<T> *Field ){
     double  delta, delta2, Pi4lz, AA, band_pow, K, dist, fi,i_left, i_right;
     std::complex<double> uij, uij1, uij_1, ui1j, ui_1j, medium;
     int i, j, jj, ii;
@@ -1008,7 +1491,7 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
     vectors v; //the structure vectors is used to pass a lot of variables to function elim
     if (doub1 !=0.){
         printf("error in 'Steps(z,nsteps, refr, Fin)': Spherical coordinates. Use Fout=Convert(Fin) first.\n");
-        return Field;
+        return;
     }
     v.a.resize(N+3);
     v.b.resize(N+3);
@@ -1051,8 +1534,8 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
         for (i=0; i< N; i++){
             for( j=0; j< N; j++){
                 double  fi;
-                fi=0.25*K*z*(refr.at(i).at(j).real()-1.0);
-                Field.at(i).at(j) *= exp(_j * fi);
+                fi=0.25*K*z*(refr[i*N+j].real()-1.0);
+                Field[i*N+j] *= exp(_j * fi);
             }
         }
 
@@ -1060,15 +1543,15 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
             j=jj;
             for (i=2; i <= N-1; i++){
 
-                uij=Field.at(i-1).at(j-1);
-                uij1=Field.at(i-1).at(j);
-                uij_1=Field.at(i-1).at(j-2);
+                uij=Field[(i-1)*N+j-1];
+                uij1=Field[(i-1)*N+j];
+                uij_1=Field[(i-1)*N+j-2];
                 v.p.at(i) = -1.0/delta2 * (uij_1 + uij1 -2.0 * uij) + imPi4lz * uij;           
             }
             for ( i=1; i <= N; i++){
                 
-                if (refr.at(i-1).at(j-1).imag() == 0.0) medium = std::complex<double> (medium.real() , 0.0);				
-                else medium = std::complex<double>(medium.real() , -2.0 * Pi * refr.at(i-1).at(j-1).imag() / lambda);                              
+                if (refr[(i-1)*N+j-1].imag() == 0.0) medium = std::complex<double> (medium.real() , 0.0);				
+                else medium = std::complex<double>(medium.real() , -2.0 * Pi * refr[(i-1)*N+j-1].imag() / lambda);                              
 
                 v.c.at(i) = std::complex<double>( -2.0 / delta2, Pi4lz + medium.imag() );
  
@@ -1088,19 +1571,19 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
 
             elim(v,N);
             for ( i=1; i<= N; i++){
-                Field.at(i-1).at(j-2) = v.u2.at(i);
+                Field[(i-1)*N+j-2] = v.u2.at(i);
                 v.u2.at(i)=v.u.at(i);
             }
             j=jj+1;
             for ( i=2; i <= N-1; i++){
-                uij=Field.at(i-1).at(j-1);
-                uij1=Field.at(i-1).at(j);
-                uij_1=Field.at(i-1).at(j-2);
+                uij=Field[(i-1)*N+j-1];
+                uij1=Field[(i-1)*N+j];
+                uij_1=Field[(i-1)*N+j-2];
                 v.p.at(i) = -1.0/delta2 * (uij_1 + uij1 -2.0 * uij) + imPi4lz * uij;
             }
             for ( i=1; i <= N; i++){
-                if (refr.at(i-1).at(j-1).imag() == 0.0) medium = std::complex<double>( medium.real() , 0.0 );
-                else medium = std::complex<double>(medium.real() ,  -2.*Pi*refr.at(i-1).at(j-1).imag()/lambda);
+                if (refr[(i-1)*N+j-1].imag() == 0.0) medium = std::complex<double>( medium.real() , 0.0 );
+                else medium = std::complex<double>(medium.real() ,  -2.*Pi*refr[(i-1)*N+j-1].imag()/lambda);
                 v.c.at(i) = std::complex<double>(-2.0/delta2, Pi4lz + medium.imag());
 
 ///* absorption borders are formed here */
@@ -1119,17 +1602,17 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
             }
             elim(v,N);
             for ( i=1; i <= N; i++){
-                Field.at(i-1).at(j-2) = v.u2.at(i);
+                Field[(i-1)*N+j-2] = v.u2.at(i);
                 v.u2.at(i)=v.u.at(i);
             }
         }
         for ( i=1; i <= N; i++){
-            Field.at(i-1).at(N-1) = v.u2.at(i);
+            Field[(i-1)*N+N-1] = v.u2.at(i);
         }
         for ( i=0; i < N; i++){
             for( j=0; j < N; j++){
-                fi=0.5*K*z*(refr.at(i).at(j).real()-1.0);
-                Field.at(i).at(j) *= exp(_j * fi);
+                fi=0.5*K*z*(refr[i*N+j].real()-1.0);
+                Field[i*N+j] *= exp(_j * fi);
             }
         }
 
@@ -1141,14 +1624,14 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
         for(ii=2; ii <= N-2; ii += 2){
             i=ii;
             for ( j=2; j <= N-1; j++){
-                uij=Field.at(i-1).at(j-1);
-                ui1j=Field.at(i).at(j-1);
-                ui_1j=Field.at(i-2).at(j-1);
+                uij=Field[(i-1)*N+j-1];
+                ui1j=Field[i*N+j-1];
+                ui_1j=Field[(i-2)*N+j-1];
                 v.p.at(j) = -1.0/delta2 * (ui_1j + ui1j -2.0 * uij) + imPi4lz * uij;
             }
             for ( j=1; j <= N; j++){
-                if (refr.at(i-1).at(j-1).imag() == 0.0) medium =std::complex<double>(medium.real() , 0.0);
-                else medium= std::complex<double>( medium.real() , -2.0 * Pi * refr.at(i-1).at(j-1).imag() / lambda );
+                if (refr[(i-1)*N+j-1].imag() == 0.0) medium =std::complex<double>(medium.real() , 0.0);
+                else medium= std::complex<double>( medium.real() , -2.0 * Pi * refr[(i-1)*N+j-1].imag() / lambda );
                 v.c.at(j) = std::complex<double>( -2.0 / delta2 , Pi4lz + medium.imag() );	
 
 
@@ -1168,19 +1651,19 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
             elim(v,N);
 
             for ( j=1; j<= N; j++){
-                Field.at(i-2).at(j-1) = v.u2.at(j);
+                Field[(i-2)*N+j-1] = v.u2.at(j);
                 v.u2.at(j)=v.u.at(j);
             }
             i=ii+1;
             for ( j=2; j <= N-1; j++){
-                uij=Field.at(i-1).at(j-1);
-                ui1j=Field.at(i).at(j-1);
-                ui_1j=Field.at(i-2).at(j-1);
+                uij=Field[(i-1)*N+j-1];
+                ui1j=Field[i*N+j-1];
+                ui_1j=Field[(i-2)*N+j-1];
                 v.p.at(j) = -1.0/delta2 * (ui_1j + ui1j -2.0 * uij) + imPi4lz * uij;
             }
             for ( j=1; j <= N; j++){
-                if (refr.at(i-1).at(j-1).imag() == 0.0) medium = std::complex<double>( medium.real() , 0.0);
-                    else medium = std::complex<double>( medium.real() , -2.*Pi*refr.at(i-1).at(j-1).imag()/lambda );
+                if (refr[(i-1)*N+j-1].imag() == 0.0) medium = std::complex<double>( medium.real() , 0.0);
+                    else medium = std::complex<double>( medium.real() , -2.*Pi*refr[(i-1)*N+j-1].imag()/lambda );
                     v.c.at(j) = std::complex<double>( -2.0/delta2 , Pi4lz + medium.imag() );
 /* absorption borders are formed here */
                 if( j <= i_left){
@@ -1198,13 +1681,13 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
 
             elim(v,N);
             for ( j=1; j <= N; j++){
-                Field.at(i-2).at(j-1) = v.u2.at(j);
+                Field[(i-2)*N+j-1] = v.u2.at(j);
                 v.u2.at(j)=v.u.at(j);
             }
         }
 
         for ( j=2; j <= N; j++){
-            Field.at(i-1).at(j-2) = v.u2.at(j);
+            Field[(i-1)*N+j-2] = v.u2.at(j);
         }
 
 ///* end j */ 
@@ -1212,24 +1695,23 @@ CMPLXVEC lpspy::Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Field ){
         }
         for ( i=0; i < N; i++){
             for(j=0; j < N; j++){
-                fi=0.25*K*z*(refr.at(i).at(j).real()-1.0);
-                Field.at(i).at(j) *=  exp(_j * fi);
+                fi=0.25*K*z*(refr[i*N+j].real()-1.0);
+                Field[i*N+j] *=  exp(_j * fi);
             }
         }
-    return Field;
+    return;
     
     
 }
-double lpspy::Strehl( CMPLXVEC Field ){
+template <class T> double lpspy::Strehl( complex<T> *Field ){
     double sum,sum1r,sum1i,sum1;
 
     sum=sum1r=sum1i=0.0;
-    for (int i=0; i< N ;i++){
-        for (int j=0;j < N ;j++){
-            sum += abs(Field.at(i).at(j));
-            sum1r += Field.at(i).at(j).real();
-            sum1i += Field.at(i).at(j).imag();
-        }
+    size_t NN = (size_t)N*N;
+    for (size_t ik=0; ik< NN ;ik++){
+        sum += abs(complex<double>(Field[ik]));
+        sum1r += Field[ik].real();
+        sum1i += Field[ik].imag();
     }
     sum1=(sum1r*sum1r+sum1i*sum1i);
     if (sum == 0){
@@ -1238,78 +1720,148 @@ double lpspy::Strehl( CMPLXVEC Field ){
     }
     return sum1/sum/sum;
 }
-CMPLXVEC lpspy::SubIntensity( vector<vector<double> > Intens, CMPLXVEC Field ){
+template <class T> void lpspy::SubIntensity( double *Intens, int nx, int ny, complex<T> *Field ){
     double Intens2, phi;
-    if ((int)Intens.at(0).size() != N || (int)Intens.size() != N){
+    if (ny != N || nx != N){
         printf( "Error in SubIntensity(Intens, Fin): array 'Intens' must be square and must have %d x %d elements\n",N,N);
         exit(1);
     }
     for (int i=0;i< N; i++){
         for (int j=0;j< N; j++){
-            phi=arg(Field.at(i).at(j));
-            Intens2=sqrt(Intens.at(j).at(i));
-            Field.at(i).at(j) = Intens2 * exp(_j * phi);
+            phi=arg(Field[i*N+j]);
+            Intens2=sqrt(Intens[j*N+i]);
+            Field[i*N+j] = Intens2 * exp(_j * phi);
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::SubPhase( vector<vector<double> > Phase, CMPLXVEC Field ){
+template <class T> void lpspy::SubPhase( double *Phase, int nx, int ny, complex<T> *Field ){
     double Intens2, phi;
-    if ((int)Phase.at(0).size() != N || (int)Phase.size() != N){
+    if (ny != N || nx != N){
         printf( "Error in SubPhase(Phase, Fin): array 'Phase' must be square and must have %d x %d elements\n",N,N);
         exit(1);
     }
     for (int i=0;i< N; i++){
         for (int j=0;j< N; j++){
-            phi=Phase.at(j).at(i);
-            Intens2=abs(Field.at(i).at(j));
-            Field.at(i).at(j) = Intens2 * exp(_j * phi);
+            phi=Phase[j*N+i];
+            Intens2=abs(Field[i*N+j]);
+            Field[i*N+j] = Intens2 * exp(_j * phi);
         }
     }
-    return Field;
+    return;
 }
-CMPLXVEC lpspy::Tilt(double tx, double ty, CMPLXVEC Field ){
-    int n2;
-    double fi, K, dx, x, y;
-    dx =size/N;
-    n2=N/2;
-    K=2*Pi/lambda;
-    for (int i=0;i<N; i++){
-        x=(i-n2)*dx;
-        for (int j=0;j<N; j++){
-            y=(j-n2)*dx;
-            fi= -(tx*x+ty*y)*K;
-            Field.at(i).at(j) *= exp(_j * fi);
-        }
-    }
-    return Field;
+template <class T> void lpspy::Tilt(double tx, double ty, complex<T> *Field ){
+    lpop op = {FUSE_TILT, {tx, ty}};
+    Fuse(1, &op, Field);
+    return;
 }
-CMPLXVEC lpspy::Zernike(int n, int m, double R, double A, CMPLXVEC Field ){
-    int  n2, ncheck, ind;
-    double rho, phi, fi, K, dx, x, y, Nnm;
+template <class T> void lpspy::Zernike(int n, int m, double R, double A, complex<T> *Field ){
+    int  ncheck, ind;
     ind=0;
     for(ncheck=n; ncheck >= -n; ncheck -= 2)
     if (ncheck == m ) ind=1;
     if (ind == 0){
         cout << "error in 'Zernike(n ,m, R, A, Fin)': n must be larger than zero, |m| <= n and n-|m| must be even."<<endl;
-        return Field;
+        return;
+    }
+    lpop op = {FUSE_ZERNIKE, {(double)n, (double)m, R, A}};
+    Fuse(1, &op, Field);
+    return;
+}
+/***********************************************************************
+*  nollToZern: the Zernike indices (n, m) of Noll index j >= 1, the same
+*  as noll_to_zern in _LightPipes.pyx.
+***********************************************************************/
+static void nollToZern(int j, int &n, int &m){
+    int j1 = j-1;
+    n = 0;
+    while (j1 > n){
+        n++;
+        j1 -= n;
     }
+    m = (n % 2) + 2*((j1 + (n+1) % 2)/2);
+    if (j % 2) m = -m;
+}
+/***********************************************************************
+*  ZernikeSum: the phase of Zernike(n, m, R, A[j-1]) summed over the Noll
+*  indices j = 1, ..., nterms and applied in one pass. The radial
+*  polynomials of equal |m| are summed into one polynomial in rho^2 per
+*  cos(|m| phi) and sin(|m| phi) before the loop over the pixels, which
+*  evaluates them with Horner's rule and cos(m phi), sin(m phi) with the
+*  recurrence of a rotation. The transmission is cached as in Zernike.
+***********************************************************************/
+template <class T> void lpspy::ZernikeSum(int nterms, const double *A, double R, complex<T> *Field ){
+    int n, m, ma, mmax;
+    double K, Nnm, w, c;
     K=2*Pi/lambda;
-    n2=N/2;
-    dx=size/N;
-    if (m == 0) Nnm=sqrt((double)n+1);
-    else Nnm=sqrt(2.0*(n+1));
-    for (int i=0;i< N; i++){
-        x=(i-n2)*dx;
-        for (int j=0;j< N; j++){
-            y=(j-n2)*dx;
-            rho=sqrt((x*x+y*y)/(R*R));
-            phi=phase(y,x) + Pi;
-            fi= -A*K*Nnm*zernike(n,m,rho,phi);
-            Field.at(i).at(j) *= exp(_j * fi);
+    // C[ma][k], S[ma][k]: the coefficient of rho^(ma+2k) cos(ma phi), sin(ma phi)
+    vector<vector<double> > C, S;
+    mmax = -1;
+    for (int j = 1; j <= nterms; j++){
+        if (A[j-1] == 0.) continue;
+        nollToZern(j, n, m);
+        ma = abs(m);
+        if (ma > mmax){
+            mmax = ma;
+            C.resize(mmax+1);
+            S.resize(mmax+1);
+        }
+        if (m == 0) Nnm=sqrt((double)n+1);
+        else Nnm=sqrt(2.0*(n+1));
+        w = -A[j-1]*K*Nnm;
+        // zernike() in subs.cpp: -sin(m phi) = sin(|m| phi) for m < 0
+        vector<double> &P = m >= 0 ? C[ma] : S[ma];
+        if ((int)P.size() < (n-ma)/2+1) P.resize((n-ma)/2+1, 0.);
+        // (-1)^s (n-s)! / (s! ((n+ma)/2-s)! ((n-ma)/2-s)!) for rho^(n-2s):
+        for (int s = 0; s <= (n-ma)/2; s++){
+            c = s % 2 ? -1. : 1.;
+            for (int t = 1; t <= n-s; t++) c *= t;
+            for (int t = 1; t <= s; t++) c /= t;
+            for (int t = 1; t <= (n+ma)/2-s; t++) c /= t;
+            for (int t = 1; t <= (n-ma)/2-s; t++) c /= t;
+            P[(n-ma)/2-s] += w*c;
         }
     }
-    return Field;
+    vector<double> key(5 + nterms);
+    key[0] = ZERNIKE_SUM_SCREEN;
+    key[1] = N;
+    key[2] = size;
+    key[3] = lambda;
+    key[4] = R;
+    for (int j = 0; j < nterms; j++) key[5+j] = A[j];
+    // the grid is only needed to make the transmission:
+    shared_ptr<lpgrid> g;
+    shared_ptr<lpelement<T> > e = screen<T>(key, [=](int i, int j) mutable {
+            if (!g) g = grid(0., 0., true);
+            double rho, rho2, phi, c1, s1, cm, sm, rm, t, fi;
+            rho = g->radius(i, j)/R;
+            rho2 = rho*rho;
+            phi = g->angle(i, j) + Pi;
+            c1 = cos(phi);
+            s1 = sin(phi);
+            cm = 1.;
+            sm = 0.;
+            rm = 1.;
+            fi = 0.;
+            for (int ma = 0; ma <= mmax; ma++){
+                if (!C[ma].empty()){
+                    double p = 0.;
+                    for (int k = C[ma].size()-1; k >= 0; k--) p = p*rho2 + C[ma][k];
+                    fi += rm*p*cm;
+                }
+                if (!S[ma].empty()){
+                    double p = 0.;
+                    for (int k = S[ma].size()-1; k >= 0; k--) p = p*rho2 + S[ma][k];
+                    fi += rm*p*sm;
+                }
+                t = cm*c1 - sm*s1;
+                sm = sm*c1 + cm*s1;
+                cm = t;
+                rm *= rho;
+            }
+            return fi; });
+    applyElement(*e, Field);
+    return;
 }
 void lpspy::test(){
     cout << test_string << endl;
@@ -1331,3 +1883,52 @@ void lpspy::setWavelength(double newWavelength){
 int lpspy::getGridDimension(){
     return N;
 }
+
+/***********************************************************************
+*  The commands for fields of complex<double> and of complex<float>.
+***********************************************************************/
+#define LP_INSTANTIATE(T) \
+    template lpfftw<T>::plan lpspy::plan(int, int, int, complex<T>*, int); \
+    template void   lpspy::Axicon(double, double, double, double, complex<T>*); \
+    template void   lpspy::BeamMix(complex<T>*, complex<T>*); \
+    template void   lpspy::Begin(double, double, int, complex<T>*); \
+    template void   lpspy::CircAperture(double, double, double, complex<T>*); \
+    template void   lpspy::CircScreen(double, double, double, complex<T>*); \
+    template void   lpspy::Convert(complex<T>*); \
+    template void   lpspy::FarField(double, double, int, double, double, complex<T>*, complex<T>*); \
+    template void   lpspy::Forvard(double, complex<T>*, int); \
+    template void   lpspy::ForvardScan(int, const double*, complex<T>*, complex<T>*, double*); \
+    template void   lpspy::Fresnel(double, complex<T>*, int); \
+    template void   lpspy::Fuse(int, const lpop*, complex<T>*); \
+    template void   lpspy::Gain(double, double, double, complex<T>*); \
+    template void   lpspy::GaussAperture(double, double, double, double, complex<T>*); \
+    template void   lpspy::GaussScreen(double, double, double, double, complex<T>*); \
+    template void   lpspy::GaussHermite(int, int, double, double, complex<T>*); \
+    template void   lpspy::GaussLaguerre(int, int, double, double, complex<T>*); \
+    template void   lpspy::IntAttenuator(double, complex<T>*); \
+    template void   lpspy::Intensity(int, complex<T>*, double*); \
+    template void   lpspy::Interpol(double, int, double, double, double, double, complex<T>*, complex<T>*); \
+    template void   lpspy::Lens(double, double, double, complex<T>*); \
+    template void   lpspy::LensForvard(double, double, complex<T>*); \
+    template void   lpspy::LensFresnel(double, double, complex<T>*); \
+    template void   lpspy::MultIntensity(double*, int, int, complex<T>*); \
+    template void   lpspy::MultPhase(double*, int, int, complex<T>*); \
+    template void   lpspy::Normal(complex<T>*); \
+    template void   lpspy::Phase(complex<T>*, double*); \
+    template void   lpspy::PipFFT(int, complex<T>*, int); \
+    template double lpspy::Power(complex<T>*); \
+    template void   lpspy::Propagate(double, complex<T>*, int); \
+    template void   lpspy::RandomIntensity(double, double, complex<T>*); \
+    template void   lpspy::RandomPhase(double, double, complex<T>*); \
+    template void   lpspy::RectAperture(double, double, double, double, double, complex<T>*); \
+    template void   lpspy::RectScreen(double, double, double, double, double, complex<T>*); \
+    template void   lpspy::ScaledFresnel(double, double, int, complex<T>*, complex<T>*); \
+    template void   lpspy::Steps(double, int, complex<double>*, complex<T>*); \
+    template double lpspy::Strehl(complex<T>*); \
+    template void   lpspy::SubIntensity(double*, int, int, complex<T>*); \
+    template void   lpspy::SubPhase(double*, int, int, complex<T>*); \
+    template void   lpspy::Tilt(double, double, complex<T>*); \
+    template void   lpspy::Zernike(int, int, double, double, complex<T>*); \
+    template void   lpspy::ZernikeSum(int, const double*, double, complex<T>*);
+LP_INSTANTIATE(double)
+LP_INSTANTIATE(float)
@@ -2,60 +2,316 @@
 #include "subs.h"
 #include <complex>
 #include <vector>
+#include <algorithm>
+#include <map>
+#include <stdint.h>
+#include <mutex>
+#include <string>
+#include <new>
+#include <stdexcept>
 #include "fftw3.h"
+#include "lpcache.h"
 
-#define CMPLXVEC vector<vector<complex<double> > >
+// Fields are flat, row-major N x N arrays, Field[i*N+j], owned by the
+// caller (numpy arrays in _LightPipes.pyx). All commands work in place.
+// The commands are templates for fields of complex<double> and of
+// complex<float>; phases and sums are computed in double for both.
+// The Python side allocates them on LP_ALIGN bytes, so FFTW can transform
+// a field in place with its SIMD code. Forvard, Fresnel, Propagate and
+// PipFFT also take a stack of K fields with the same grid, K x N x N, as
+// one array.
+#define LP_ALIGN 64
 
 namespace std {
+/***********************************************************************
+*  lpbuffer: contiguous, LP_ALIGN-byte aligned work array, e.g. for the
+*  zero padded 2N x 2N arrays of Fresnel. Freed when it goes out of scope.
+***********************************************************************/
+template <class T> class lpbuffer {
+    public:
+        lpbuffer(size_t n){
+            raw = malloc(n*sizeof(T) + LP_ALIGN);
+            ptr = raw ? (T*)(((uintptr_t)raw + LP_ALIGN) & ~(uintptr_t)(LP_ALIGN-1)) : NULL;
+            len = n;
+        }
+        ~lpbuffer(){ free(raw); }
+        T*       data(){ return ptr; }
+        size_t   size(){ return len; }
+        T&       operator[](size_t i){ return ptr[i]; }
+    private:
+        void  *raw;
+        T     *ptr;
+        size_t len;
+        lpbuffer(const lpbuffer&);
+        lpbuffer& operator=(const lpbuffer&);
+};
+
+class lpengine;
+/***********************************************************************
+*  lpfftw: the FFTW interface for fields of complex<double> (fftw_) and
+*  of complex<float> (fftwf_), so that the commands can be written once
+*  for both precisions.
+***********************************************************************/
+template <class T> struct lpfftw;
+template <> struct lpfftw<double> {
+    typedef fftw_plan    plan;
+    typedef fftw_complex cpx;
+    static map<vector<int>, plan> &plans(lpengine &engine);
+    static int  init_threads(){ return fftw_init_threads(); }
+    static int  alignment(complex<double> *data){ return fftw_alignment_of((double *) data); }
+    static plan make(int n0, int n1, int howmany, complex<double> *data, int sign, unsigned flags, int nt){
+        int n[2] = {n0, n1};
+        if (nt > 0) fftw_plan_with_nthreads(nt);
+        if (howmany == 1) return fftw_plan_dft_2d(n0, n1, (cpx *) data, (cpx *) data, sign, flags);
+        return fftw_plan_many_dft(2, n, howmany, (cpx *) data, NULL, 1, n0*n1,
+                                (cpx *) data, NULL, 1, n0*n1, sign, flags);
+    }
+    static void execute(plan p, complex<double> *data){ fftw_execute_dft(p, (cpx *) data, (cpx *) data); }
+    static void destroy(plan p){ fftw_destroy_plan(p); }
+    static int  import_wisdom(const char *text){ return fftw_import_wisdom_from_string(text); }
+    static char *export_wisdom(){ return fftw_export_wisdom_to_string(); }
+};
+#ifndef LP_NO_FFTWF
+template <> struct lpfftw<float> {
+    typedef fftwf_plan    plan;
+    typedef fftwf_complex cpx;
+    static map<vector<int>, plan> &plans(lpengine &engine);
+    static int  init_threads(){ return fftwf_init_threads(); }
+    static int  alignment(complex<float> *data){ return fftwf_alignment_of((float *) data); }
+    static plan make(int n0, int n1, int howmany, complex<float> *data, int sign, unsigned flags, int nt){
+        int n[2] = {n0, n1};
+        if (nt > 0) fftwf_plan_with_nthreads(nt);
+        if (howmany == 1) return fftwf_plan_dft_2d(n0, n1, (cpx *) data, (cpx *) data, sign, flags);
+        return fftwf_plan_many_dft(2, n, howmany, (cpx *) data, NULL, 1, n0*n1,
+                                (cpx *) data, NULL, 1, n0*n1, sign, flags);
+    }
+    static void execute(plan p, complex<float> *data){ fftwf_execute_dft(p, (cpx *) data, (cpx *) data); }
+    static void destroy(plan p){ fftwf_destroy_plan(p); }
+    static int  import_wisdom(const char *text){ return fftwf_import_wisdom_from_string(text); }
+    static char *export_wisdom(){ return fftwf_export_wisdom_to_string(); }
+};
+#else
+/***********************************************************************
+*  Without the single precision library fftw3f (the Windows binaries in
+*  fftw3_win32 and fftw3_win64 are double precision only), fields of
+*  complex<float> are transformed with a double precision plan, through
+*  a complex<double> copy made for each transform.
+***********************************************************************/
+struct lpfplan {
+    fftw_plan p;
+    size_t n;
+};
+template <> struct lpfftw<float> {
+    typedef lpfplan *plan;
+    static map<vector<int>, plan> &plans(lpengine &engine);
+    static int  init_threads(){ return 1; }
+    static int  alignment(complex<float> *data){ return 0; }
+    static plan make(int n0, int n1, int howmany, complex<float> *data, int sign, unsigned flags, int nt){
+        size_t n = (size_t)n0*n1*howmany;
+        complex<double> *tmp = (complex<double> *) fftw_malloc(n*sizeof(fftw_complex));
+        if (tmp == NULL) throw bad_alloc();
+        fftw_plan p = lpfftw<double>::make(n0, n1, howmany, tmp, sign, flags, nt);
+        fftw_free(tmp);
+        if (p == NULL) return NULL;
+        plan fp = new lpfplan;
+        fp->p = p;
+        fp->n = n;
+        return fp;
+    }
+    static void execute(plan p, complex<float> *data){
+        complex<double> *tmp = (complex<double> *) fftw_malloc(p->n*sizeof(fftw_complex));
+        if (tmp == NULL) throw bad_alloc();
+        copy(data, data + p->n, tmp);
+        lpfftw<double>::execute(p->p, tmp);
+        for (size_t i = 0; i < p->n; i++) data[i] = complex<float>(tmp[i]);
+        fftw_free(tmp);
+    }
+    static void destroy(plan p){ fftw_destroy_plan(p->p); delete p; }
+    // the plans are double precision plans, their wisdom is the double one
+    static int  import_wisdom(const char *text){ return 1; }
+    static char *export_wisdom(){ return NULL; }
+};
+#endif
+
+/***********************************************************************
+*  lpengine: the FFT plans and the cache of transfer functions. Copies of
+*  an lpspy share one engine, while each copy has its own grid (N, size,
+*  lambda, doub1, int1), so a copy per field can be used in any thread.
+***********************************************************************/
+class lpengine {
+    public:
+        ~lpengine();
+        map<vector<int>, fftw_plan> plans;
+        map<vector<int>, lpfftw<float>::plan> plansf;
+        lpcache cache;
+        static mutex planner;
+};
+
+/***********************************************************************
+*  lpchirpz: a 1-D chirp-z transform from nin to nout samples,
+*      y[m] = post[m] * sum_n pre[n] * x[(n+shift) % nin] * exp(s*i*2*Pi*alpha*n'*m'),
+*  n' = n - nin/2, m' = m - nout/2, evaluated with Bluestein's algorithm
+*  as a convolution of length L >= nin+nout-1. kernel is the FFT of the
+*  convolution kernel, divided by L. pre and post include the chirps of
+*  the algorithm.
+***********************************************************************/
+struct lpchirpz {
+    int nin, nout, L, shift;
+    vector<complex<double> > pre, post, kernel;
+};
+
+/***********************************************************************
+*  lpgrid: the coordinates of the pixels of an N x N grid around a
+*  center (x_shift, y_shift), x[i] = (i-N/2)*dx - x_shift and y[j] the
+*  same with y_shift. With polar, also the N x N arrays of the radius
+*  r[i*N+j] = sqrt(x^2+y^2) and the angle phi = phase(y,x) (subs.h),
+*  unless they do not fit in the cache. radius() and angle() return them
+*  either way, computed from x and y if the arrays are empty.
+*  x^2+y^2 itself is not stored, it is faster to compute than to load.
+***********************************************************************/
+struct lpgrid {
+    vector<double> x, y, r, phi;
+    double radius(int i, int j) const {
+        return r.empty() ? sqrt(x[i]*x[i]+y[j]*y[j]) : r[(size_t)i*y.size()+j];
+    }
+    double angle(int i, int j) const {
+        return phi.empty() ? phase(y[j],x[i]) : phi[(size_t)i*y.size()+j];
+    }
+};
+
+/***********************************************************************
+*  lpmask: a convex aperture rasterized on the grid, row i has the
+*  pixels j0[i] <= j < j1[i] inside, none if j0[i] == j1[i].
+***********************************************************************/
+struct lpmask {
+    vector<int> j0, j1;
+};
+
+/***********************************************************************
+*  lpop: one elementwise command for Fuse, kind is one of the FUSE_
+*  constants and p are its arguments, in the order of the command.
+***********************************************************************/
+enum { FUSE_AXICON, FUSE_CIRC_APERTURE, FUSE_CIRC_SCREEN, FUSE_GAIN,
+       FUSE_GAUSS_APERTURE, FUSE_GAUSS_SCREEN, FUSE_INT_ATTENUATOR,
+       FUSE_LENS, FUSE_RECT_APERTURE, FUSE_RECT_SCREEN, FUSE_TILT,
+       FUSE_ZERNIKE };
+struct lpop {
+    int kind;
+    double p[6];
+};
+
+/***********************************************************************
+*  lpelement: an elementwise command, ready to be applied to a field row
+*  by row with the cached arrays it needs. The commands and Fuse apply
+*  the same elements, made by lpspy::element, so that they give the same
+*  results. rowelement wraps a function f(i, row) in an element.
+***********************************************************************/
+template <class T> class lpelement {
+    public:
+        virtual ~lpelement(){}
+        // applies the element to row i of the field
+        virtual void apply(int i, complex<T> *row) = 0;
+};
+template <class T, class F> class lprowelement : public lpelement<T> {
+    public:
+        lprowelement(F f) : f(f) {}
+        void apply(int i, complex<T> *row){ f(i, row); }
+    private:
+        F f;
+};
+template <class T, class F> shared_ptr<lpelement<T> > rowelement(F f){
+    return make_shared<lprowelement<T, F> >(f);
+}
+
 class lpspy {
     public:
         int  N;
         int int1;
         double size, lambda, doub1;
+        unsigned planflags;
+        int nthreads;
+        int fresnlaccuracy;
         lpspy();
-        ~lpspy();
-        CMPLXVEC Axicon(double phi, double n1, double x_shift, double y_shift, CMPLXVEC Fin);
-        CMPLXVEC BeamMix(CMPLXVEC Fin1, CMPLXVEC Fin2 );
-        CMPLXVEC Begin(double size, double lambda, int NN);
-        CMPLXVEC CircAperture(double R, double x_shift, double y_shift, CMPLXVEC Fin);
-        CMPLXVEC CircScreen(double R, double x_shift, double y_shift, CMPLXVEC Fin);
-        CMPLXVEC Convert( CMPLXVEC Fin );
-        CMPLXVEC Forward(double z, double sizenew, int Nnew, CMPLXVEC Field );
-        CMPLXVEC Forvard(double z, CMPLXVEC Fin);
-        CMPLXVEC Fresnel(double z, CMPLXVEC Fin);
-        CMPLXVEC Gain( double Isat, double gain, double L, CMPLXVEC Fin );
-        CMPLXVEC GaussAperture( double w, double x_shift, double y_shift, double R, CMPLXVEC Fin );
-        CMPLXVEC GaussScreen( double w, double x_shift, double y_shift, double T, CMPLXVEC Fin );
-        CMPLXVEC GaussHermite( int n, int m, double A, double w0, CMPLXVEC Fin );
-        CMPLXVEC GaussLaguerre( int p, int m, double A, double w0, CMPLXVEC Fin );
-        CMPLXVEC IntAttenuator( double R, CMPLXVEC Fin );
-        vector<vector<double> > Intensity(int flag,CMPLXVEC Fin );
-        CMPLXVEC Interpol( double new_size, int new_number, double x_shift, double y_shift, double angle, double magnif, CMPLXVEC Fin );
-        CMPLXVEC Lens( double f, double x_shift, double y_shift, CMPLXVEC Fin );
-        CMPLXVEC LensForvard(double f, double z, CMPLXVEC Fin );
-        CMPLXVEC LensFresnel(double f, double z, CMPLXVEC Fin );
-        CMPLXVEC MultIntensity( vector<vector<double> > Intens, CMPLXVEC Fin );
-        CMPLXVEC MultPhase( vector<vector<double> > Phase, CMPLXVEC Fin );
-        CMPLXVEC Normal( CMPLXVEC Fin );
-        vector<vector<double> > Phase(CMPLXVEC Fin );
-        vector<vector<double> > PhaseUnwrap(vector<vector<double> > Phi );
-        CMPLXVEC PipFFT( int ind, CMPLXVEC Fin );
-        double   Power( CMPLXVEC Fin );
-        CMPLXVEC RandomIntensity(double seed, double noise_level, CMPLXVEC Fin );
-        CMPLXVEC RandomPhase(double seed, double max, CMPLXVEC Fin );
-        CMPLXVEC RectAperture(double sx, double sy, double x_shift, double y_shift, double angle, CMPLXVEC Fin );
-        CMPLXVEC RectScreen(double sx, double sy, double x_shift, double y_shift, double angle, CMPLXVEC Fin );        
-        CMPLXVEC Steps(double z, int nstep, CMPLXVEC refr, CMPLXVEC Fin );
-        double   Strehl( CMPLXVEC Fin );
-        CMPLXVEC SubIntensity( vector<vector<double> > Intens, CMPLXVEC Fin );
-        CMPLXVEC SubPhase( vector<vector<double> > Phase, CMPLXVEC Fin );
-        CMPLXVEC Tilt(double tx, double ty, CMPLXVEC Fin );
-        CMPLXVEC Zernike(int n, int m, double R, double A, CMPLXVEC Fin );
+        void     newEngine();
+        template <class T> typename lpfftw<T>::plan plan(int n0, int n1, int sign, complex<T> *data, int howmany = 1);
+        void     prePlan(int NN);
+        int      importWisdom(const char *filename);
+        int      exportWisdom(const char *filename);
+        void     setCacheSize(double nbytes);
+        double   getCacheSize();
+        void     clearCache();
+        template <class T> void     Axicon(double phi, double n1, double x_shift, double y_shift, complex<T> *Fin);
+        template <class T> void     BeamMix(complex<T> *Fin1, complex<T> *Fin2 );
+        template <class T> void     Begin(double size, double lambda, int NN, complex<T> *Fout);
+        template <class T> void     CircAperture(double R, double x_shift, double y_shift, complex<T> *Fin);
+        template <class T> void     CircScreen(double R, double x_shift, double y_shift, complex<T> *Fin);
+        template <class T> void     Convert( complex<T> *Fin );
+        template <class T> void     FarField(double f, double sizenew, int Nnew, double x_shift, double y_shift, complex<T> *Fin, complex<T> *Fout);
+        void     ForwardMatrix(double z, double sizenew, int Nnew, int i0, int i1, complex<double> *M );
+        template <class T> void     Forvard(double z, complex<T> *Fin, int K = 1);
+        template <class T> void     ForvardScan(int nz, const double *z, complex<T> *Fin, complex<T> *Fout, double *I);
+        template <class T> void     Fresnel(double z, complex<T> *Fin, int K = 1);
+        template <class T> void     Fuse(int nops, const lpop *ops, complex<T> *Fin);
+        template <class T> void     Gain( double Isat, double gain, double L, complex<T> *Fin );
+        template <class T> void     GaussAperture( double w, double x_shift, double y_shift, double R, complex<T> *Fin );
+        template <class T> void     GaussScreen( double w, double x_shift, double y_shift, double T0, complex<T> *Fin );
+        template <class T> void     GaussHermite( int n, int m, double A, double w0, complex<T> *Fin );
+        template <class T> void     GaussLaguerre( int p, int m, double A, double w0, complex<T> *Fin );
+        template <class T> void     IntAttenuator( double R, complex<T> *Fin );
+        template <class T> void     Intensity(int flag, complex<T> *Fin, double *I );
+        template <class T> void     Interpol( double new_size, int new_number, double x_shift, double y_shift, double angle, double magnif, complex<T> *Fin, complex<T> *Fout );
+        template <class T> void     Lens( double f, double x_shift, double y_shift, complex<T> *Fin );
+        template <class T> void     LensForvard(double f, double z, complex<T> *Fin );
+        template <class T> void     LensFresnel(double f, double z, complex<T> *Fin );
+        template <class T> void     MultIntensity( double *Intens, int nx, int ny, complex<T> *Fin );
+        template <class T> void     MultPhase( double *Phase, int nx, int ny, complex<T> *Fin );
+        template <class T> void     Normal( complex<T> *Fin );
+        template <class T> void     Phase(complex<T> *Fin, double *Phi );
+        void     PhaseUnwrap(double *Phi, double *PhiOut );
+        template <class T> void     PipFFT( int ind, complex<T> *Fin, int K = 1 );
+        template <class T> double   Power( complex<T> *Fin );
+        template <class T> void     Propagate(double z, complex<T> *Fin, int K = 1);
+        template <class T> void     RandomIntensity(double seed, double noise_level, complex<T> *Fin );
+        template <class T> void     RandomPhase(double seed, double max, complex<T> *Fin );
+        template <class T> void     RectAperture(double sx, double sy, double x_shift, double y_shift, double angle, complex<T> *Fin );
+        template <class T> void     RectScreen(double sx, double sy, double x_shift, double y_shift, double angle, complex<T> *Fin );
+        template <class T> void     ScaledFresnel(double z, double sizenew, int Nnew, complex<T> *Fin, complex<T> *Fout);
+        template <class T> void     Steps(double z, int nstep, complex<double> *refr, complex<T> *Fin );
+        template <class T> double   Strehl( complex<T> *Fin );
+        template <class T> void     SubIntensity( double *Intens, int nx, int ny, complex<T> *Fin );
+        template <class T> void     SubPhase( double *Phase, int nx, int ny, complex<T> *Fin );
+        template <class T> void     Tilt(double tx, double ty, complex<T> *Fin );
+        template <class T> void     Zernike(int n, int m, double R, double A, complex<T> *Fin );
+        template <class T> void     ZernikeSum(int nterms, const double *A, double R, complex<T> *Fin );
         void     test();
         double   getGridSize();
         void     setGridSize(double newSize);
         double   getWavelength();
         void     setWavelength(double newWavelength);
         int      getGridDimension();
+    private:
+        static bool threads_ready;
+        shared_ptr<lpengine> engine;
+        template <class T> void prePlan(int NN);
+        // kinds of arrays in the cache, the first element of their key:
+        enum { FORVARD_FILTER, FRESNEL_KERNEL, PROPAGATE_FILTER, SCALED_FRESNEL, FAR_FIELD, GRID, CIRC_MASK, RECT_MASK,
+               AXICON_SCREEN, LENS_SCREEN, TILT_SCREEN, ZERNIKE_SCREEN,
+               ZERNIKE_SUM_SCREEN };
+        shared_ptr<vector<complex<double> > > forvardFilter(double z);
+        shared_ptr<vector<complex<double> > > fresnelKernel(double z);
+        shared_ptr<vector<complex<double> > > propagateFilter(double z);
+        shared_ptr<lpchirpz> scaledFresnelOp(double z, double sizenew, int Nnew);
+        shared_ptr<lpgrid> grid(double x_shift, double y_shift, bool polar = false);
+        shared_ptr<lpmask> circMask(double R, double x_shift, double y_shift);
+        shared_ptr<lpmask> rectMask(double sx, double sy, double x_shift, double y_shift, double angle);
+        template <class T, class P> shared_ptr<lpelement<T> > screen(const vector<double> &key, P phase);
+        template <class T, class Px, class Py> shared_ptr<lpelement<T> > separableScreen(const vector<double> &key, Px phasex, Py phasey);
+        template <class T> shared_ptr<lpelement<T> > element(const lpop &op);
+        template <class T> void     applyElement(lpelement<T> &e, complex<T> *Fin);
+        shared_ptr<lpchirpz> farFieldOp(double f, double sizenew, int Nnew, double shift);
+        bool     chirpz(lpchirpz &op, int nin, int nout, double alpha, int s);
+        template <class T> void     czt(const lpchirpz &op, int rows, const complex<T> *in, complex<T> *out);
+        template <class T> void     czt2(const lpchirpz &opx, const lpchirpz &opy, const complex<T> *Fin, complex<T> *Fout);
+        template <class T> void     checkerboard(complex<T> *Fin);
     };
 }
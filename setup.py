@@ -34,10 +34,16 @@ if SYSTEM == 'Windows':
         libraries = ['./LightPipes/fftw3_win64/libfftw3-3']
     data_files = [('lib/site-packages/LightPipes', [_lpfile(fftw3dir, 'libfftw3-3.dll')])]
     library_dirs = [fftw3dir]
+    extra_compile_args = []
+    # only the double precision FFTW binaries are shipped, complex64
+    # fields are transformed in double precision (see lpspy.h)
+    define_macros = [('LP_NO_FFTWF', None)]
 else:  # Linux, Darwin
     data_files = None
-    libraries = ['fftw3']
+    libraries = ['fftw3_threads', 'fftw3', 'fftw3f_threads', 'fftw3f']
     library_dirs = ['/usr/local/fftw/lib/']
+    extra_compile_args = ['-std=c++11']
+    define_macros = []
 
 ext = Extension(
     'LightPipes._LightPipes',
@@ -45,8 +51,9 @@ ext = Extension(
     include_dirs=[numpy.get_include()],
     library_dirs=library_dirs,
     libraries=libraries,
+    define_macros=define_macros,
     language="c++",
-    #extra_compile_args=['-std=c++11','-Wunused-value'],
+    extra_compile_args=extra_compile_args,
 )
 extensions = cythonize([ext],language_level = "3")
 #extensions = cythonize([ext])